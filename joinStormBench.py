@@ -0,0 +1,103 @@
+"""
+Join storm benchmark: N clients connect at once, pipeline "NEW:<room>" in
+their first packet and we time how long until each sees "Joined room:".
+
+    python joinStormBench.py                 # spawns a local newServer.py
+    python joinStormBench.py --host 1.2.3.4  # against a running server
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+async def join_one(host, port, room, t0, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(f"NEW:{room}\n".encode('utf-8'))
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                raise ConnectionError("closed before join")
+            if line.startswith(b"Joined room:"):
+                return time.perf_counter() - t0, (reader, writer)
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def storm(host, port, clients, rooms, timeout):
+    t0 = time.perf_counter()
+    tasks = [join_one(host, port, f"bench-{i % rooms}", t0, timeout) for i in range(clients)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    total = time.perf_counter() - t0
+
+    latencies = sorted(r[0] for r in results if not isinstance(r, BaseException))
+    errors = [r for r in results if isinstance(r, BaseException)]
+    for r in results:
+        if not isinstance(r, BaseException):
+            r[1][1].close()
+    return total, latencies, errors
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def raise_fd_limit(needed):
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default=None, help="server to hit (default: spawn newServer.py locally)")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--clients", type=int, default=1000)
+    ap.add_argument("--rooms", type=int, default=10)
+    ap.add_argument("--timeout", type=float, default=30.0)
+    args = ap.parse_args()
+
+    raise_fd_limit(args.clients + 64)
+
+    server_proc = None
+    host = args.host
+    if host is None:
+        host = "127.0.0.1"
+        env = dict(os.environ, VOICECHAT_PORT=str(args.port), VOICECHAT_LISTEN_BACKLOG=str(max(args.clients, 128)))
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "newServer.py")
+        server_proc = subprocess.Popen([sys.executable, server_script], env=env, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+
+    try:
+        total, latencies, errors = asyncio.run(storm(host, args.port, args.clients, args.rooms, args.timeout))
+    finally:
+        if server_proc is not None:
+            server_proc.terminate()
+            server_proc.wait()
+
+    print(f"clients: {args.clients}  rooms: {args.rooms}")
+    print(f"joined:  {len(latencies)}  failed: {len(errors)}")
+    print(f"total:   {total * 1000:.1f} ms")
+    print(f"p50:     {percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"p99:     {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"max:     {percentile(latencies, 100) * 1000:.1f} ms")
+    if errors:
+        print("first error:", repr(errors[0]))
+
+
+if __name__ == "__main__":
+    main()
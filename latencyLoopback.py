@@ -0,0 +1,196 @@
+"""
+End-to-end latency through a server, measured with a synthetic click.
+
+A sender feeds a CapturePipeline from a fake mic that produces real-time
+chunks of silence with a click every --click-every seconds; a receiver in the
+same room queues what arrives into a jitter buffer that is played out, like
+the clients do, by a paced fake output device after --prefill chunks. The
+time from a click entering the fake mic to it leaving the fake speaker is the
+mouth-to-ear latency, shown next to the per-stage breakdown the clients use.
+
+    python latencyLoopback.py                      # spawns a local newServer.py
+    python latencyLoopback.py --host 1.2.3.4       # through a running server
+    python latencyLoopback.py --chunk 1024 --prefill 1
+
+Real devices add their own buffering; pass --device-latency to include an estimate.
+"""
+import argparse
+import array
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from joinStormBench import percentile
+from voiceChatMedia import CapturePipeline, LatencyBreakdown, full_rate_payload, pcm_samples, unpack_media
+from voiceChatProtocol import encode_line, encode_media
+
+CLICK_AMPLITUDE = 20000
+CLICK_THRESHOLD = 10000
+CLICK_SAMPLES = 32
+
+
+class ClickSource:
+    """ Fake mic: returns a chunk when a real one would be ready, clicks at set times. """
+
+    def __init__(self, rate, chunk, every):
+        self.rate = rate
+        self.chunk = chunk
+        self.every = int(every * rate)
+        self.start = None
+        self.pos = 0
+        self.clicks = deque()  # monotonic times the clicks "hit the mic"
+
+    def read(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        delay = self.start + (self.pos + self.chunk) / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        samples = array.array('h', bytes(2 * self.chunk))
+        first = -(-self.pos // self.every) * self.every  # next click at or after pos
+        for click in range(first, self.pos + self.chunk, self.every):
+            if click == 0:
+                continue  # give the receiver time to prefill first
+            for i in range(click - self.pos, min(self.chunk, click - self.pos + CLICK_SAMPLES)):
+                samples[i] = CLICK_AMPLITUDE
+            self.clicks.append(self.start + click / self.rate)
+        self.pos += self.chunk
+        if sys.byteorder != "little":
+            samples.byteswap()
+        return samples.tobytes()
+
+
+class LoopbackReceiver:
+    def __init__(self, sock, rate, chunk, prefill, device_latency, source):
+        self.sock = sock
+        self.rate = rate
+        self.chunk = chunk
+        self.prefill = prefill
+        self.device_latency = device_latency
+        self.source = source
+        self.buffer = deque()
+        self.breakdown = LatencyBreakdown(rate)
+        self.latencies = []
+        self.stopped = threading.Event()
+
+    def reader(self):
+        f = self.sock.makefile('rb')
+        while not self.stopped.is_set():
+            line = f.readline()
+            if not line:
+                return
+            line = line.strip()
+            if line.startswith(b"MEDIA:"):
+                body = f.read(int(line.split(b":")[2]))
+                frame = unpack_media(body)
+                received_at = time.monotonic()
+                self.breakdown.on_arrival(frame, time.time(), self.chunk)
+                self.buffer.append((full_rate_payload(frame, self.chunk), received_at))
+            elif line.startswith(b"PING:"):
+                self.sock.sendall(encode_line("PONG:" + line[5:].decode('utf-8')))
+
+    def playout(self):
+        """ Paced like an output device: one chunk per chunk duration once prefilled. """
+        while not self.stopped.is_set() and len(self.buffer) < self.prefill:
+            time.sleep(0.001)
+        period = self.chunk / self.rate
+        start = time.monotonic()
+        k = 0
+        while not self.stopped.is_set():
+            due = start + k * period
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            k += 1
+            if not self.buffer:
+                continue  # underrun: the device plays silence
+            pcm, received_at = self.buffer.popleft()
+            played = time.monotonic()
+            self.breakdown.on_playout(played - received_at, self.device_latency)
+            samples = pcm_samples(pcm)
+            for idx, x in enumerate(samples):
+                if x > CLICK_THRESHOLD:
+                    heard = played + idx / self.rate + self.device_latency
+                    # drop clicks that were lost on the way
+                    while len(self.source.clicks) > 1 and heard - self.source.clicks[1] > 0:
+                        self.source.clicks.popleft()
+                    if self.source.clicks:
+                        self.latencies.append(heard - self.source.clicks.popleft())
+                    break
+
+
+def join(host, port, room):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(encode_line(f"NEW:{room}"))
+    return sock
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default=None, help="server to go through (default: spawn newServer.py locally)")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--seconds", type=float, default=10.0)
+    ap.add_argument("--click-every", type=float, default=1.0)
+    ap.add_argument("--rate", type=int, default=44100)
+    ap.add_argument("--chunk", type=int, default=4096, help="frames per chunk (the clients' Chunks)")
+    ap.add_argument("--prefill", type=int, default=2, help="jitter buffer prefill (BUFFER_FILL_THRESHOLD)")
+    ap.add_argument("--device-latency", type=float, default=0.0, help="seconds of output device buffering to add")
+    args = ap.parse_args()
+
+    server_proc = None
+    host = args.host
+    if host is None:
+        host = "127.0.0.1"
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "newServer.py")
+        server_proc = subprocess.Popen([sys.executable, server_script, "--port", str(args.port)],
+                                       stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+
+    try:
+        room = f"loopback-{os.getpid()}"
+        receiver_sock = join(host, args.port, room)
+        sender_sock = join(host, args.port, room)
+        time.sleep(0.2)
+
+        source = ClickSource(args.rate, args.chunk, args.click_every)
+        receiver = LoopbackReceiver(receiver_sock, args.rate, args.chunk, args.prefill,
+                                    args.device_latency, source)
+        for target in (receiver.reader, receiver.playout):
+            threading.Thread(target=target, daemon=True).start()
+        capture = CapturePipeline(
+            read_chunk=source.read,
+            send_body=lambda body: sender_sock.sendall(encode_media(body)),
+            frames_per_chunk=args.chunk,
+            rate=args.rate).start()
+
+        time.sleep(args.seconds)
+        capture.stop()
+        receiver.stopped.set()
+        for sock in (sender_sock, receiver_sock):
+            try:
+                sock.sendall(encode_line("BYE"))
+                sock.close()
+            except OSError:
+                pass
+    finally:
+        if server_proc is not None:
+            server_proc.terminate()
+            server_proc.wait()
+
+    values = sorted(receiver.latencies)
+    print(f"chunk {args.chunk} frames ({args.chunk / args.rate * 1000:.0f} ms), prefill {args.prefill}")
+    print(f"clicks heard: {len(values)}")
+    if values:
+        print(f"end-to-end:   min {values[0] * 1000:.0f} ms, avg {sum(values) / len(values) * 1000:.0f} ms, "
+              f"p95 {percentile(values, 95) * 1000:.0f} ms, max {values[-1] * 1000:.0f} ms")
+    print(f"breakdown:    {receiver.breakdown.stats_text()}")
+    print(f"sender:       {capture.stats_text()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,213 +1,30 @@
-import socket
-import threading
-import pyaudio
 import sys
-import time
 
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
-from collections import deque
 
-########################################################################
-#                       AUDIO / NETWORK CONFIG                         #
-########################################################################
-
-host = "16.170.201.66"  # <-- Put your server's public IP
-port = 5000
-
-Format = pyaudio.paInt16
-Chunks = 4096
-Channels = 1
-Rate = 44100
-
-stop_audio_threads = False       # Controls mic & playback
-stop_parsing_messages = False    # Controls parse_server_messages
-
-output_streams = {}   # user_id -> (pyaudio_instance, output_stream)
-jitter_buffers = {}   # user_id -> deque()
-playback_threads = {} # user_id -> thread
-
-my_client_id = None
-
-BUFFER_FILL_THRESHOLD = 2
-
-
-########################################################################
-#                           CLIENT FUNCTIONS                           #
-########################################################################
-
-def send_text_command(client_socket, cmd_str):
-    """ Sends a command to server if not empty. """
-    if cmd_str:
-        client_socket.send(cmd_str.encode('utf-8'))
-
-def parse_server_messages(client_socket, gui):
-    """
-    Reads lines from server in a loop:
-      - ID:<id>
-      - ROOM_LIST:...
-      - DATA:<client_id>:<length>
-      - "Joined room:"
-      - ...
-    """
-    global stop_parsing_messages, my_client_id
-    f = client_socket.makefile('rb')
-
-    while True:
-        if stop_parsing_messages:
-            break
-        try:
-            line = f.readline()
-            if not line:
-                break
-            line = line.strip()
-
-            if line.startswith(b"DATA:"):
-                # parse audio
-                parts = line.decode('utf-8').split(':')
-                if len(parts) == 3:
-                    _, sid_str, length_str = parts
-                    sid = int(sid_str)
-                    length = int(length_str)
-                    audio_data = f.read(length)
-                    if not audio_data or len(audio_data) < length:
-                        break
-                    play_audio_data_for_user(sid, audio_data)
-
-            elif line.startswith(b"ID:"):
-                my_client_id = int(line.decode('utf-8').split("ID:")[-1])
-                gui.append_log(f"Assigned Client ID: {my_client_id}")
-
-            elif line.startswith(b"ROOM_LIST:"):
-                line_str = line.decode('utf-8')
-                rooms_str = line_str.split("ROOM_LIST:", 1)[1].strip()
-                gui.update_room_list(rooms_str)
-
-            else:
-                # Some text
-                text = line.decode('utf-8')
-                gui.append_log(text)
-
-                # If we see "Joined room:", auto-start mic
-                if text.startswith("Joined room:"):
-                    gui.start_mic_stream()
-
-        except Exception as e:
-            print("Error in parse_server_messages:", e)
-            break
-
-    print("[parse_server_messages] ended.")
-
-
-########################################################################
-#                         AUDIO SENDER / PLAYBACK                      #
-########################################################################
-
-def audio_sender(client_socket, mic_stream):
-    global stop_audio_threads
-    while True:
-        if stop_audio_threads:
-            break
-        try:
-            data = mic_stream.read(Chunks, exception_on_overflow=False)
-            if data:
-                client_socket.send(data)
-        except:
-            break
-    print("[audio_sender] ended.")
-
-def play_audio_data_for_user(user_id, audio_data):
-    if stop_audio_threads:
-        return
-    ensure_output_stream(user_id)
-    jitter_buffers[user_id].append(audio_data)
-
-def ensure_output_stream(user_id):
-    if user_id not in output_streams:
-        p = pyaudio.PyAudio()
-        out_stream = p.open(format=Format,
-                            channels=Channels,
-                            rate=Rate,
-                            output=True,
-                            frames_per_buffer=Chunks)
-        output_streams[user_id] = (p, out_stream)
-    if user_id not in jitter_buffers:
-        jitter_buffers[user_id] = deque()
-    if user_id not in playback_threads:
-        t = threading.Thread(target=playback_thread_func, args=(user_id,))
-        t.daemon = True
-        t.start()
-        playback_threads[user_id] = t
-
-def playback_thread_func(user_id):
-    global stop_audio_threads
-    _, out_stream = output_streams[user_id]
-    buf = jitter_buffers[user_id]
-
-    while not stop_audio_threads and len(buf) < BUFFER_FILL_THRESHOLD:
-        time.sleep(0.01)
-
-    while True:
-        if stop_audio_threads:
-            break
-        if len(buf) > 0:
-            chunk = buf.popleft()
-            out_stream.write(chunk)
-        else:
-            out_stream.write(b'\x00' * (Chunks * 2))
-            time.sleep(0.01)
-    print(f"[playback_thread_func] user {user_id} ended.")
-
-def start_mic_and_playback(client_socket, gui):
-    global stop_audio_threads
-    stop_audio_threads = False
-    p = pyaudio.PyAudio()
-    gui.mic_stream = p.open(format=Format,
-                            channels=Channels,
-                            rate=Rate,
-                            input=True,
-                            frames_per_buffer=Chunks)
-
-    gui.mic_thread = threading.Thread(target=audio_sender, args=(client_socket, gui.mic_stream))
-    gui.mic_thread.daemon = True
-    gui.mic_thread.start()
-
-def stop_mic_and_playback():
-    global stop_audio_threads
-    stop_audio_threads = True
-    time.sleep(0.3)
-
-    # close all playback streams
-    for uid, (pa, out_stream) in output_streams.items():
-        try:
-            out_stream.stop_stream()
-            out_stream.close()
-            pa.terminate()
-        except:
-            pass
-    output_streams.clear()
-    jitter_buffers.clear()
-    playback_threads.clear()
-    print("[stop_mic_and_playback] closed playback.")
+from voiceChatClient import ClientSettings
+from voiceChatEngine import level_bar, welcome_rooms
+from voiceChatTk import TkApp, TkEvents
 
 
 ########################################################################
 #                           THE GUI CLASS                              #
 ########################################################################
 
-class VoiceChatGUI:
-    def __init__(self, root):
+class VoiceChatGUI(TkApp):
+    def __init__(self, root, settings):
         self.root = root
         self.root.title("Voice Chat Client")
 
-        self.client_socket = None
-        self.parse_thread = None
-
-        self.mic_stream = None
-        self.mic_thread = None
+        # server, TLS and audio settings: --host etc., see voiceChatClient.ClientSettings
+        self.engine = settings.make_engine(TkEvents(self), settings.make_tls())
+        self.connected = False
+        self.current_room = None
 
         self.build_gui()
+        self.start_ui_queue()
         self.connect_to_server()
 
     def build_gui(self):
@@ -221,9 +38,15 @@ class VoiceChatGUI:
         scrollb.pack(side=tk.RIGHT, fill=tk.Y)
         self.room_listbox.config(yscrollcommand=scrollb.set)
 
+        self.room_listbox.bind("<Double-Button-1>", lambda e: self.on_room_double_click())
+
         btn_refresh = ttk.Button(frame_rooms, text="Refresh", command=self.on_refresh_rooms)
         btn_refresh.pack(side=tk.BOTTOM, fill=tk.X, padx=2, pady=2)
 
+        self.speaking_var = tk.StringVar(value="")
+        speaking_label = ttk.Label(self.root, textvariable=self.speaking_var, font=("Courier", 10))
+        speaking_label.grid(row=3, column=0, padx=5, pady=2, sticky="w")
+
         frame_cmd = ttk.LabelFrame(self.root, text="Command Input")
         frame_cmd.grid(row=1, column=0, padx=5, pady=5, sticky="nsew")
 
@@ -250,43 +73,39 @@ class VoiceChatGUI:
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def connect_to_server(self):
-        global stop_parsing_messages
-        stop_parsing_messages = False
-
-        try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((host, port))
-            welcome_msg = self.client_socket.recv(4096).decode('utf-8')
-            self.append_log(welcome_msg)
-            self.parse_welcome_rooms(welcome_msg)
-        except Exception as e:
-            messagebox.showerror("Connection Error", str(e))
-            self.append_log("Could not connect to server.")
-            return
+        """ Connect off the Tk thread; the welcome (or the error) shows up once it is in. """
+        def done(f):
+            if f.exception() is not None:
+                self.post(self.on_connect_failed, f.exception())
+            else:
+                self.post(self.on_connected, f.result())
+        self.engine.connect_async().add_done_callback(done)
+
+    def on_connect_failed(self, error):
+        messagebox.showerror("Connection Error", str(error))
+        self.append_log("Could not connect to server.")
 
-        self.parse_thread = threading.Thread(target=parse_server_messages, args=(self.client_socket, self))
-        self.parse_thread.daemon = True
-        self.parse_thread.start()
-
-    def parse_welcome_rooms(self, text):
-        if "Available rooms:\n" in text:
-            block = text.split("Available rooms:\n", 1)[1]
-            lines = block.split("\n")
-            rooms_collect = []
-            for line in lines:
-                if line.strip().startswith("Type ") or not line.strip():
-                    break
-                rooms_collect.append(line.strip())
-            if rooms_collect:
-                self.update_room_list("\n".join(rooms_collect))
+    def on_connected(self, welcome_msg):
+        self.connected = True
+        self.append_log(welcome_msg)
+        rooms = welcome_rooms(welcome_msg)
+        if rooms:
+            self.show_rooms(rooms)
 
     ####################################################################
     #                          EVENT HANDLERS                           #
     ####################################################################
 
     def on_refresh_rooms(self):
-        if self.client_socket:
-            send_text_command(self.client_socket, "REQ:ROOM_LIST")
+        if self.connected:
+            self.log_failure(self.engine.request_room_list(), "refresh rooms")
+
+    def log_failure(self, future, what):
+        """ Room commands complete on the engine's reader thread; only failures need a word. """
+        self.when_done(future, lambda _: None, what)
+
+    def show_error(self, text):
+        self.append_log(f"[Room] {text}")
 
     def on_enter_command(self):
         cmd = self.cmd_entry.get().strip()
@@ -296,97 +115,103 @@ class VoiceChatGUI:
         self.append_log(f">>> {cmd}")
 
         if cmd.lower() == "leave":
-            self.leave_and_reconnect()
+            self.leave_room()
+            return
+        if cmd.lower().startswith("switch "):
+            self.switch_room(cmd[len("switch "):].strip())
+            return
+        if cmd.lower().startswith("listen "):
+            self.listen_room(cmd[len("listen "):].strip())
             return
         if cmd.lower() == "q":
             self.on_close()
             return
+        if cmd.lower() == "stats":
+            self.show_stats()
+            return
 
-        if self.client_socket:
-            send_text_command(self.client_socket, cmd)
-
-    def leave_and_reconnect(self):
-        """
-        1) Stop mic & playback
-        2) Stop parse thread
-        3) Close socket
-        4) Clear GUI
-        5) Reconnect
-        """
-        self.stop_mic_stream()
-        self.stop_parse_thread()
-        if self.client_socket:
-            try:
-                self.client.shutdown(socket.SHUT_RDWR)
-                self.client.close()
-
-            except:
-                pass
-        self.client_socket = None
+        if self.connected:
+            self.engine.send_command(cmd)
 
-        # Clear log & rooms
-        self.log_text.config(state='normal')
-        self.log_text.delete("1.0", tk.END)
-        self.log_text.config(state='disabled')
-        self.update_room_list("")
+    def show_stats(self):
+        """ "stats" command: send-side latency and per-speaker receive quality. """
+        for line in self.engine.stats_lines():
+            self.append_log(f"[Stats] {line}")
 
+    def on_room_double_click(self):
+        sel = self.room_listbox.curselection()
+        if sel:
+            self.switch_room(self.room_listbox.get(sel[0]))
 
-        self.connect_to_server()
+    def switch_room(self, room_name):
+        """
+        Hop rooms on the same connection: the server moves us, we keep our id,
+        the mic and all playback devices.
+        """
+        if self.connected and room_name:
+            self.log_failure(self.engine.join(room_name), f"join {room_name!r}")
+
+    def listen_room(self, room_name):
+        """ Listen-only join: no mic for the rest of this connection. """
+        if self.connected and room_name:
+            if self.current_room is not None:
+                self.append_log("[Room] Listen-only is chosen on the first join; reconnect to listen.")
+                return
+            self.log_failure(self.engine.listen(room_name), f"listen to {room_name!r}")
+
+    def leave_room(self):
+        """ Back to the lobby without dropping the connection. """
+        if self.connected and self.current_room is not None:
+            self.log_failure(self.engine.leave(), "leave the room")
+
+    def room_joined(self, room_name):
+        self.current_room = room_name
+        if not self.engine.audio_started:
+            self.start_mic_stream()
+        self.on_refresh_rooms()
+
+    def room_left(self, room_name):
+        self.current_room = None
+        self.on_refresh_rooms()
 
     ####################################################################
     #                      START/STOP MIC STREAM                        #
     ####################################################################
 
     def start_mic_stream(self):
-        self.append_log("[Audio] Starting mic + playback.")
-        start_mic_and_playback(self.client_socket, self)
+        self.append_log("[Audio] Starting playback only (listening)." if self.engine.listening
+                        else "[Audio] Starting mic + playback.")
+        def done(f):
+            if f.exception() is not None:
+                self.append_log(f"[Audio] Could not open the mic: {f.exception()}")
+        self.engine.start_audio_async().add_done_callback(done)
 
     def stop_mic_stream(self):
         self.append_log("[Audio] Stopping mic + playback.")
-        stop_mic_and_playback()
-        if self.mic_stream:
-            try:
-                self.mic_stream.stop_stream()
-                self.mic_stream.close()
-            except:
-                pass
-        self.mic_stream = None
-        self.mic_thread = None
+        self.engine.stop_audio_async()
 
     ####################################################################
-    #                          ROOM LIST, LOG                           #
+    #                       ROOM LIST, SPEAKING                        #
     ####################################################################
 
-    def update_room_list(self, rooms_str):
+    def show_rooms(self, rooms):
         self.room_listbox.delete(0, tk.END)
-        lines = rooms_str.strip().split("\n")
-        for line in lines:
+        for line in rooms:
             line = line.strip()
             if line:
                 self.room_listbox.insert(tk.END, line)
 
-    def append_log(self, text):
-        self.log_text.config(state='normal')
-        self.log_text.insert(tk.END, text + "\n")
-        self.log_text.see(tk.END)
-        self.log_text.config(state='disabled')
-
-    def stop_parse_thread(self):
-        global stop_parsing_messages
-        stop_parsing_messages = True
-        if self.parse_thread and self.parse_thread.is_alive():
-            self.parse_thread.join(timeout=1)
-        self.parse_thread = None
+    def show_speaking(self, levels):
+        text = "   ".join(f"{'me' if uid == self.engine.client_id else uid} {level_bar(level, 6)}"
+                           for uid, level in sorted(levels.items()))
+        text = f"Speaking: {text}" if text else ""
+        if self.speaking_var.get() != text:
+            self.speaking_var.set(text)
 
     def on_close(self):
-        self.stop_mic_stream()
-        self.stop_parse_thread()
-        if self.client_socket:
-            try:
-                self.client_socket.close()
-            except:
-                pass
-        self.client_socket = None
+        # BYE tells the server not to hold our seat for a resume
+        self.engine.close()
+        self.connected = False
         self.root.destroy()
 
 
@@ -395,9 +220,10 @@ class VoiceChatGUI:
 ########################################################################
 
 def main():
+    settings = ClientSettings(sys.argv[1:])
     root = tk.Tk()
     root.title("Voice Chat Client")
-    app = VoiceChatGUI(root)
+    app = VoiceChatGUI(root, settings)
     root.mainloop()
 
 if __name__ == "__main__":
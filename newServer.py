@@ -1,163 +1,1104 @@
+import base64
+import binascii
+import os
+import random
+import select
+import signal
 import socket
+import sys
+import tempfile
 import threading
+import time
 
-port = 5000
-host = "0.0.0.0"
+import voiceChatProfile as profile
+import voiceChatRooms
+from voiceChatProtocol import (COMMAND, FLAG_E2E, FLAG_RED, MAX_LAYERS, MEDIA, MEDIA_HEADER, ClientStreamReader,
+                               encode_line, encode_response, parse_caps, split_request, strip_redundancy)
+from voiceChatLevels import media_pcm
+from voiceChatListeners import ListenerHub
+from voiceChatLoad import DEGRADED, LEVEL_NAMES, LISTEN_ONLY, NORMAL, LoadMonitor
+from voiceChatRecorder import RECORD_RATE, RoomRecorder
+from voiceChatRooms import Member, Outbox, RoomFull, RoomRegistry
+from voiceChatTrace import T_CAPS, T_GONE, T_JOIN, T_LEAVE, T_LISTEN, TraceWriter
+import voiceChatDrain
+import voiceChatTls
+from voiceChatConfig import Config, at_least, between
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind((host, port))
-server.listen(5)
+# Every setting below can be changed per deployment with --<name>, VOICECHAT_<NAME>
+# or the [server] section of a config file (voiceChatConfig).
+config = Config("server", sys.argv[1:] if __name__ == "__main__" else None)
 
-# rooms: { room_name: [(conn, client_id), ...], ... }
-rooms = {}
-client_id_counter = 0
-broadcast_lock = threading.Lock()
+port = config.get("port", 5000, check=between(1, 65535))
+host = config.get("host", "0.0.0.0")
+
+# A meeting start means hundreds of connects within a second; listen(5)
+# makes the kernel drop SYNs and clients sit in 1s+ retransmit backoff.
+LISTEN_BACKLOG = config.get("listen_backlog", 1024, check=at_least(1))
+# Lobby clients must send something within this many seconds or get dropped,
+# so half-open or stalled connections don't pin a thread forever.
+HANDSHAKE_TIMEOUT = config.get("handshake_timeout", 120.0, check=at_least(1.0))
+# A dropped client keeps its id and room seat this long, waiting for RESUME:<token>.
+RESUME_GRACE = config.get("resume_grace", 20.0, check=at_least(0.0))
+# Application keepalive: PING every HEARTBEAT_INTERVAL; a client we have not
+# heard anything from (audio, PONG, command) for IDLE_TIMEOUT is evicted.
+HEARTBEAT_INTERVAL = config.get("heartbeat_interval", 5.0, check=at_least(1.0))
+IDLE_TIMEOUT = config.get("idle_timeout", 15.0, check=at_least(1.0))
+# Every connection has its own thread (a listener's only until it joins); a
+# smaller stack than the platform's (often 8 MB reserved) fits more of them.
+# 0 keeps the default.
+THREAD_STACK_KB = config.get("thread_stack_kb", 0, check=lambda kb: kb == 0 or at_least(64)(kb))
+# Frames queued per listener before the oldest are dropped (Outbox, ListenerHub):
+# deeper rides out longer stalls, shallower keeps a slow listener closer to live.
+OUTBOX_MAX_FRAMES = config.get("outbox_max_frames", voiceChatRooms.OUTBOX_MAX_FRAMES, check=at_least(2))
+# Simulcast: a listener that can decode the lower layers is stepped down one
+# layer when its outbox backs up or its RTT is poor, and back up one layer after
+# a quiet spell, so a weak downlink degrades instead of falling seconds behind.
+LAYER_DOWN_QUEUE = config.get("layer_down_queue", 8, check=at_least(1))     # frames queued in the outbox
+LAYER_DOWN_RTT = config.get("layer_down_rtt", 0.5, check=at_least(0.0))    # seconds
+LAYER_DOWN_HOLD = 1.0       # let the queue drain before stepping down again
+LAYER_UP_QUEUE = config.get("layer_up_queue", 2, check=at_least(0))
+LAYER_UP_HOLD = config.get("layer_up_hold", 5.0, check=at_least(0.0))  # seconds on a layer before trying the one above
+# Rooms to record ("a,b", or "*" for all) and where; empty means no recorder.
+# Clients send their capture rate in CAPS; record_rate is for those that do not.
+RECORD_ROOMS = config.get("record_rooms", [])
+RECORD_DIR = config.get("record_dir", "recordings")
+RECORD_RATE = config.get("record_rate", RECORD_RATE, check=between(8000, 48000))
+# Binary trace of all traffic for traceReplay.py; empty dir means off.
+# Payloads make the trace replay real audio but grow it ~100x.
+TRACE_DIR = config.get("trace_dir", "")
+TRACE_PAYLOAD = config.get("trace_payload", False)
+# Stage timers, lock wait histograms and the signal-driven sampler (voiceChatProfile).
+PROFILE = config.get("profile", False)
+PROFILE_DIR = config.get("profile_dir", "profiles")
+# TLS on every connection when a certificate is given (voiceChatTls); the key
+# defaults to <cert>-key.pem. A cert path that does not exist yet gets a
+# self-signed certificate, for testing.
+TLS_CERT = config.get("tls_cert", "")
+TLS_KEY = config.get("tls_key", "")
+TLS_HANDSHAKE_TIMEOUT = config.get("tls_handshake_timeout", 10.0, check=at_least(0.1))
+# A member without an E2E key that misses a sealed sender's frames for this
+# long (seconds) is told so, and so is the sender (e2e_mismatch).
+E2E_MISMATCH_GRACE = 3.0
+# Kernel keepalive as a second line of defence (seconds idle, interval, probes).
+TCP_KEEPALIVE = (30, 10, 3)
+# Admission limits, 0 = unlimited. Connections count lobby clients too; members
+# are sessions (in a room, in the lobby after LEAVE, or waiting to resume).
+# Over a global limit a newcomer gets SERVER_BUSY, over a room limit ROOM_FULL.
+MAX_CONNECTIONS = config.get("max_connections", 0, check=at_least(0))
+MAX_MEMBERS = config.get("max_members", 0, check=at_least(0))
+ROOM_MAX_MEMBERS = config.get("room_max_members", 0, check=at_least(0))
+# Members whose audio was forwarded within SPEAKER_WINDOW seconds hold the
+# floor; past ROOM_MAX_SPEAKERS of them a new talk spurt is not forwarded.
+ROOM_MAX_SPEAKERS = config.get("room_max_speakers", 0, check=at_least(0))
+SPEAKER_WINDOW = 1.0
+# Overload shedding (voiceChatLoad): past any of these the server forwards
+# cheaper (DEGRADED), at 1.5x it also refuses new speakers and members
+# (LISTEN_ONLY). CPU is process CPU seconds per second, queue the mean outbox
+# depth in frames, forwarding in bytes/s; 0 disables a signal. CPU is off by
+# default: a busy threaded server uses more than one core under normal load,
+# so set shed_cpu from what this machine can take (e.g. 0.9 x cores). A room
+# over ROOM_MAX_FORWARD_BPS is shed on its own, whatever the server-wide level.
+SHED_CPU = config.get("shed_cpu", 0.0, check=at_least(0.0))
+SHED_QUEUE = config.get("shed_queue", 16.0, check=at_least(0.0))
+MAX_FORWARD_BPS = config.get("max_forward_bps", 0.0, check=at_least(0.0))
+ROOM_MAX_FORWARD_BPS = config.get("room_max_forward_bps", 0.0, check=at_least(0.0))
+SHED_LAYER = 1  # lowest simulcast layer index a DEGRADED listener is moved to
+# Drain and restart (voiceChatDrain): SIGTERM drains, SIGHUP restarts on the
+# same listening socket. A drain lasts until the last connection is gone or
+# DRAIN_TIMEOUT; members are told to move within MIGRATE_SPREAD seconds, to
+# REDIRECT ("host:port") if set, else (restart) to our successor. The sessions
+# go to it in HANDOFF_FILE (temp directory; the successor deletes it).
+DRAIN_TIMEOUT = config.get("drain_timeout", 600.0, check=at_least(0.0))
+MIGRATE_SPREAD = config.get("migrate_spread", 10.0, check=at_least(0.0))
+REDIRECT = config.get("redirect", "")
+HANDOFF_FILE = config.get("handoff_file", os.path.join(tempfile.gettempdir(), f"voicechat-handoff-{port}.json"))
+# A listening socket inherited from the process we replace (set by it), or
+# from a socket activator; -1 binds our own.
+LISTEN_FD = config.get("listen_fd", -1, check=at_least(-1))
+ACCEPT_POLL = 0.5  # seconds; how soon the accept loop sees a drain request
+
+config.require(IDLE_TIMEOUT > HEARTBEAT_INTERVAL, "idle_timeout must be longer than heartbeat_interval")
+config.require(not SHED_QUEUE or SHED_QUEUE < OUTBOX_MAX_FRAMES,
+               "shed_queue must be below outbox_max_frames, or queues never reach it")
+config.require(not TLS_KEY or TLS_CERT, "tls_key without tls_cert")
+config.require(not REDIRECT or REDIRECT.rpartition(":")[2].isdigit(), "redirect must be host:port")
+config.done()
+
+if PROFILE:
+    profile.enable(PROFILE_DIR)  # before RoomRegistry() so its lock is timed
+
+# rooms: { room_name: { client_id: Member, ... }, ... }
+rooms = RoomRegistry()
+evicted_total = 0
+expired_total = 0
+# Called as tap(room, client_id, kind, data) for every frame after it has been
+# forwarded. Taps run on the sender's thread, so they must only enqueue.
+media_taps = []
+recorder = None
+tracer = None
+# every listen-only member's socket, reads and writes on one thread (voiceChatListeners)
+hub = None
+tls_context = None
+# Admission and shedding state: the reaper sets the levels, the fan-out reads them.
+connections = 0
+connections_lock = threading.Lock()
+load = LoadMonitor(cpu=SHED_CPU, queue=SHED_QUEUE, forward_bps=MAX_FORWARD_BPS)
+load_level = NORMAL
+room_loads = {}        # room_name -> LoadMonitor, only with ROOM_MAX_FORWARD_BPS
+room_levels = {}       # room_name -> level of rooms shedding on their own
+forwarded_bytes = {}   # room_name -> running total of bytes queued to listeners
+retired_bytes = 0      # totals of rooms that have closed since
+# Drain and restart: set by the signal handlers, acted on by the accept loop.
+drain_mode = None      # None, "drain" or "restart"
+handoff = None         # voiceChatDrain.HandoffReader, when we replaced another process
+handed_over = set()    # tokens resumed here since; never adopted again
+
+def create_listener(bind_host, bind_port, backlog):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((bind_host, bind_port))
+    server.listen(backlog)
+    return server
 
 def start():
-    print("Server started, listening on port", port)
-    while True:
-        conn, addr = server.accept()
+    global recorder, tracer, hub, tls_context, handoff
+    if THREAD_STACK_KB:
+        threading.stack_size(THREAD_STACK_KB * 1024)
+    if LISTEN_FD >= 0:
+        server = socket.socket(fileno=LISTEN_FD)
+        print("Server started on inherited socket", server.getsockname())
+        handoff = voiceChatDrain.HandoffReader(HANDOFF_FILE)
+        adopt_handoff()
+    else:
+        server = create_listener(host, port, LISTEN_BACKLOG)
+        print("Server started, listening on port", port, "backlog", LISTEN_BACKLOG)
+    for line in config.changed():
+        print(f"  {line}")
+    if TLS_CERT:
+        key = TLS_KEY or os.path.splitext(TLS_CERT)[0] + "-key.pem"
+        if not os.path.exists(TLS_CERT):
+            voiceChatTls.make_self_signed(TLS_CERT, key)
+            print(f"Wrote a self-signed certificate to {TLS_CERT}; clients need it as their CA")
+        tls_context = voiceChatTls.server_context(TLS_CERT, key)
+        print(f"TLS on, certificate {TLS_CERT}")
+    if RECORD_ROOMS:
+        recorder = RoomRecorder(RECORD_DIR, RECORD_ROOMS, RECORD_RATE).start()
+        media_taps.append(recorder.offer)
+        print(f"Recording rooms {', '.join(RECORD_ROOMS)} to {RECORD_DIR}")
+    if TRACE_DIR:
+        tracer = TraceWriter(TRACE_DIR, payload=TRACE_PAYLOAD).start()
+        media_taps.append(tracer.offer)
+        print(f"Tracing traffic to {TRACE_DIR}" + (" (with payloads)" if TRACE_PAYLOAD else ""))
+    hub = ListenerHub(handle_listener_line, hang_up, OUTBOX_MAX_FRAMES).start()
+    threading.Thread(target=reaper, daemon=True).start()
+    for name, mode in (("SIGTERM", "drain"), ("SIGHUP", "restart")):
+        if hasattr(signal, name):  # no SIGHUP on Windows
+            signal.signal(getattr(signal, name), lambda signum, frame, mode=mode: request_drain(mode))
+    server.settimeout(ACCEPT_POLL)
+    while drain_mode is None:
+        try:
+            conn, addr = server.accept()
+        except socket.timeout:
+            continue
+        # accept loop only hands off; all socket I/O happens in the worker thread
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        enable_tcp_keepalive(conn)
         print(f"Client connected from {addr}")
-        t = threading.Thread(target=handle_new_connection, args=(conn,))
+        t = threading.Thread(target=serve_connection, args=(conn,), daemon=True)
         t.start()
+    drain(server, drain_mode == "restart")
+
+def request_drain(mode):
+    """ Signal handler side: the accept loop picks it up within ACCEPT_POLL. A second SIGTERM exits now. """
+    global drain_mode
+    if drain_mode is None:
+        drain_mode = mode
+    elif mode == "drain":
+        raise SystemExit("Second SIGTERM while draining, exiting")
+
+def attached():
+    """ Connections still open: lobby and speakers (worker threads) plus listeners. """
+    return connections + len(hub)
+
+def drain(server, restart):
+    """
+    Stop accepting and let the calls we have run out: until every connection
+    is gone or DRAIN_TIMEOUT passes. A restart first starts a successor on
+    our listening socket with our sessions; with a successor or a REDIRECT
+    the members are then told to move, a room at a time (voiceChatDrain).
+    """
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    if restart:
+        write_handoff()
+        successor = voiceChatDrain.spawn_successor(server, HANDOFF_FILE)
+        print(f"Restarting: successor pid {successor.pid} takes over the listening socket")
+    server.close()  # the successor has its own copy
+    move = restart or bool(REDIRECT)
+    print(f"Draining {attached()} connection(s), at most {DRAIN_TIMEOUT:.0f}s"
+          + (f", moving members {'to ' + REDIRECT if REDIRECT else 'over'}" if move else ""))
+    due = {}      # room (None: the lobby) -> when its members are told to move
+    told = set()  # client ids told
+    while attached() and time.monotonic() < deadline:
+        if move:
+            tell_members_to_move(due, told, restart)
+        time.sleep(1.0)
+    if restart:
+        write_handoff(final=True)  # where the stragglers are now, for their resume on the successor
+    left = [member for member in rooms.sessions() if member.conn is not None]
+    print(f"Drained, hanging up {len(left)} member(s) still here" if left else "Drained")
+    for member in left:
+        try:
+            member.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def tell_members_to_move(due, told, restart):
+    """
+    Each room gets a random moment within MIGRATE_SPREAD and all its members
+    the same one, so a room moves together. Members who joined since are told
+    on the next round; a restart rewrites the handoff file first, so their
+    sessions are there when they resume.
+    """
+    now = time.monotonic()
+    batch = []
+    for member in rooms.sessions():
+        if member.conn is None or member.client_id in told:
+            continue
+        when = due.setdefault(member.room, now + random.uniform(0.0, MIGRATE_SPREAD))
+        if when - now < 1.0:
+            batch.append((member, max(0.0, when - now)))
+    if not batch:
+        return
+    if restart:
+        write_handoff()
+    for member, delay in batch:
+        told.add(member.client_id)
+        member.send(encode_line(voiceChatDrain.migrate_line(REDIRECT, delay)))
+
+def write_handoff(final=False):
+    # ids may still be taken here by lobby clients joining: one each at most
+    voiceChatDrain.write_handoff(HANDOFF_FILE, rooms.next_id() + connections, rooms.sessions(), final)
+
+def adopt_handoff():
+    """
+    Take over the sessions of the process we replaced, as detached seats that
+    RESUME picks up. At start, on an unknown token and from the reaper, since
+    the old process rewrites the file as it drains; its final version is the
+    last, and the file is deleted once that is adopted. Returns how many were new.
+    """
+    global handoff
+    reader = handoff  # the reaper may drop it meanwhile
+    if reader is None:
+        return 0
+    found = reader.poll()
+    if found is None:
+        return 0
+    next_id, records = found
+    rooms.reserve_ids(next_id)
+    now = time.monotonic()
+    adopted = 0
+    for record in records:
+        if record["token"] in handed_over:
+            continue  # resumed here already (and maybe gone since)
+        member = Member(None, record["id"], record["room"])
+        member.token = record["token"]
+        member.detached_at = now
+        member.listener = record["listener"]
+        member.fec = record["fec"]
+        member.layers = record["layers"]
+        adopted += rooms.adopt(member)
+    if adopted:
+        print(f"Adopted {adopted} session(s) from {HANDOFF_FILE}")
+    if reader.final:
+        reader.remove()
+        handoff = None
+    return adopted
+
+def enable_tcp_keepalive(conn):
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle, interval, count = TCP_KEEPALIVE
+    # option names differ per platform; set what this one has
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPALIVE", idle),
+                        ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        opt = getattr(socket, name, None)
+        if opt is not None:
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, opt, value)
+            except OSError:
+                pass
+
+def reaper():
+    """
+    Once a second:
+      - every HEARTBEAT_INTERVAL, PING each attached client (the PONG also gives its RTT)
+      - evict clients we have not heard from for IDLE_TIMEOUT (vanished without
+        FIN); shutting the socket down wakes their handle_client, which detaches
+        them like any other drop, so a client that was only stalled can still resume
+      - step simulcast listeners on a lower layer back up once their link is clean
+      - end detached sessions whose resume grace ran out; empty rooms close with them
+      - update the load levels from CPU use, outbox depths and forwarded bytes/s
+      - announce level 0 for senders shown as speaking that stopped sending
+      - adopt a newer handoff file from the process we replaced
+    """
+    global evicted_total, expired_total
+    next_ping = time.monotonic()
+    while True:
+        time.sleep(1.0)
+        now = time.monotonic()
+
+        evicted = 0
+        depths = []
+        ping = now >= next_ping
+        if ping:
+            next_ping = now + HEARTBEAT_INTERVAL
+            ping_line = encode_line(f"PING:{int(time.time() * 1000)}")
+        for member in rooms.sessions():
+            conn = member.conn
+            if conn is None:
+                continue
+            outbox = member.outbox
+            if outbox is not None:
+                depths.append(len(outbox))
+            if now - member.last_seen > IDLE_TIMEOUT:
+                evicted += 1
+                print(f"Client {member.client_id} silent for {now - member.last_seen:.0f}s, evicting")
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            else:
+                if ping:
+                    member.send(ping_line)
+                if member.layer and member.layers > 1:
+                    maybe_raise_layer(member, now)
+                if member.meter.went_quiet(now) and member.room is not None:
+                    announce_level(member, member.room, 0)
+
+        expired = rooms.expire_detached(RESUME_GRACE)
+        for member, room_name in expired:
+            trace_event(T_GONE, room_name, member.client_id)
+            e2e_gone(member, room_name)
+            print(f"Client {member.client_id} did not resume within {RESUME_GRACE:.0f}s, removed")
+
+        if evicted or expired:
+            evicted_total += evicted
+            expired_total += len(expired)
+            print(f"Reaper: evicted {evicted} dead member(s), expired {len(expired)} session(s) "
+                  f"(totals: {evicted_total} evicted, {expired_total} expired, {len(rooms)} room(s) open)")
+        update_load_levels(depths)
+        if handoff is not None:
+            adopt_handoff()
+        if profile.enabled:
+            profile.record("reaper", time.monotonic() - now)
+
+def update_load_levels(depths):
+    """
+    Reaper side of overload shedding: feed the server-wide monitor and, with
+    ROOM_MAX_FORWARD_BPS, one monitor per room, and publish the levels the
+    fan-out reads.
+    """
+    global load_level, retired_bytes
+    for room_name in list(forwarded_bytes):
+        if room_name not in rooms:
+            retired_bytes += forwarded_bytes.pop(room_name, 0)
+            room_loads.pop(room_name, None)
+            room_levels.pop(room_name, None)
+    total = retired_bytes + sum(forwarded_bytes.values())
+    level, changed = load.sample(depths, total)
+    load_level = level
+    if changed:
+        print(f"Shedding: {load.stats_text()}")
+
+    if ROOM_MAX_FORWARD_BPS:
+        for room_name, sent in list(forwarded_bytes.items()):
+            monitor = room_loads.get(room_name)
+            if monitor is None:
+                monitor = room_loads[room_name] = LoadMonitor(forward_bps=ROOM_MAX_FORWARD_BPS)
+            level, changed = monitor.sample((), sent)
+            if level > NORMAL:
+                room_levels[room_name] = level
+            else:
+                room_levels.pop(room_name, None)
+            if changed:
+                print(f"Shedding room {room_name}: {LEVEL_NAMES[level]}, "
+                      f"forwarding {monitor.values['forward_bps'] * 8 / 1e6:.1f} Mbit/s")
+
+def shed_level(room_name):
+    """ Level the fan-out applies in room_name: server-wide or the room's own, whichever is worse. """
+    return max(load_level, room_levels.get(room_name, NORMAL))
+
+def busy_reason():
+    """ Why a newcomer cannot get a seat right now, or None. """
+    if MAX_MEMBERS and rooms.session_count() >= MAX_MEMBERS:
+        return f"server has {MAX_MEMBERS} members"
+    if load_level >= LISTEN_ONLY:
+        return "server overloaded"
+    return None
+
+def admit_speaker(member, room_name, now, voiced=True):
+    """
+    Talk-spurt gate, run per frame: a member that spoke within SPEAKER_WINDOW
+    keeps the floor with one compare. A new spurt is checked against the
+    room's speaker limit and listen-only shedding; a refused member is
+    re-checked once per SPEAKER_WINDOW and told once per spurt.
+    Silent frames (see measure_level) neither take nor extend the floor, so a
+    client without VAD does not hold a speaker slot by sending silence; they
+    are forwarded only while the room is not shedding or speaker-limited.
+    """
+    if now - member.spoke_at < SPEAKER_WINDOW:
+        if voiced:
+            member.spoke_at = now
+            return True
+        return shed_level(room_name) < DEGRADED
+    if not voiced:
+        return not ROOM_MAX_SPEAKERS and shed_level(room_name) < DEGRADED
+    if now - member.refused_at < SPEAKER_WINDOW:
+        return False
+    reason = None
+    if shed_level(room_name) >= LISTEN_ONLY:
+        reason = "server overloaded"
+    elif ROOM_MAX_SPEAKERS:
+        speakers = sum(1 for m in rooms.members(room_name) if now - m.spoke_at < SPEAKER_WINDOW)
+        if speakers >= ROOM_MAX_SPEAKERS:
+            reason = f"room has {speakers} speakers"
+    if reason is None:
+        member.spoke_at = now
+        return True
+    if now - member.refused_at > 2 * SPEAKER_WINDOW:
+        send_control(member, f"LISTEN_ONLY:{reason}")
+    member.refused_at = now
+    return False
+
+def measure_level(member, room_name, kind, data, now):
+    """
+    Feed one incoming frame to the sender's LevelMeter and pass a due level
+    on to the room. Simulcast senders are measured on layer 0 only (each
+    capture arrives once per layer). Returns whether the frame is voiced.
+    """
+    meter = member.meter
+    if kind == MEDIA:
+        if len(data) <= MEDIA_HEADER.size:
+            return True
+        if data[2]:
+            return meter.voiced  # a lower layer of the capture just measured
+        if data[1] & FLAG_E2E:
+            level = meter.report(data[3], now)  # sealed: the sender measured it for us
+        else:
+            level = meter.update(media_pcm(data), now)
+    else:
+        level = meter.update(data, now)
+    if level is not None:
+        announce_level(member, room_name, level)
+    return meter.voiced
+
+def announce_level(member, room_name, level):
+    """ SPEAKING:<id>:<level> to everyone in the room, the speaker included. """
+    line = encode_line(f"SPEAKING:{member.client_id}:{level}")
+    for other in rooms.members(room_name):
+        other.send(line)
+
+def e2e_gone(member, room_name):
+    """ E2E_GONE:<id> to the room's other E2E members; their distributor makes a new key. """
+    if member.e2e_pub is None or room_name is None:
+        return
+    line = encode_line(f"E2E_GONE:{member.client_id}")
+    for other in rooms.members(room_name):
+        if other is not member and other.e2e_pub is not None:
+            other.send(line)
+
+def e2e_mismatch(sender, member):
+    """
+    Fan-out side: a sealed frame from sender skipped member, which has no E2E
+    key. If that has gone on for E2E_MISMATCH_GRACE (longer than an E2E
+    client takes to send E2E_PUB after joining), say so to both, once per pair
+    and room, rather than let member miss sender's audio without a word.
+    """
+    missed = member.e2e_missed
+    now = time.monotonic()
+    since = missed.setdefault(sender.client_id, now)
+    if since is None or now - since < E2E_MISMATCH_GRACE:
+        return
+    missed[sender.client_id] = None
+    send_control(member, f"Client {sender.client_id} uses end-to-end encryption; "
+                         f"turn on E2E to hear it.")
+    send_control(sender, f"Client {member.client_id} has no end-to-end encryption "
+                         f"and does not hear you.")
+
+def valid_e2e_key(text):
+    try:
+        return len(base64.b64decode(text, validate=True)) == 32
+    except (binascii.Error, ValueError):
+        return False
+
+def trace_event(record_type, room, client_id, data=None):
+    """ Membership change or CAPS for the traffic trace, so replays have the same listeners. """
+    if tracer is not None:
+        tracer.event(record_type, room, client_id, data)
+
+def lower_layer_if_congested(member):
+    """ Called from the fan-out per simulcast listener, so only a len() and a compare. """
+    outbox = member.outbox
+    if outbox is None or member.layer >= member.layers - 1:
+        return
+    depth = len(outbox)
+    rtt = member.rtt or 0.0
+    if depth > LAYER_DOWN_QUEUE or rtt > LAYER_DOWN_RTT:
+        now = time.monotonic()
+        if now - member.layer_since < LAYER_DOWN_HOLD:
+            return
+        member.layer += 1
+        member.layer_since = now
+        print(f"Client {member.client_id} -> layer {member.layer} (queue {depth}, rtt {rtt * 1000:.0f} ms)")
+
+def maybe_raise_layer(member, now):
+    """ Reaper side: step a listener back up once its link has been clean for a while. """
+    outbox = member.outbox
+    if outbox is None or now - member.layer_since < LAYER_UP_HOLD:
+        return
+    if len(outbox) <= LAYER_UP_QUEUE and (member.rtt or 0.0) <= LAYER_DOWN_RTT / 2:
+        member.layer -= 1
+        member.layer_since = now
+        print(f"Client {member.client_id} -> layer {member.layer}")
 
 def get_room_list_text():
     """
     Return a newline-separated list of all room names,
     or "No rooms available." if none exist.
     """
-    if not rooms:
+    names = rooms.room_names()
+    if not names:
         return "No rooms available."
-    return "\n".join(rooms.keys())
+    return "\n".join(names)
 
-def send_room_list(conn):
+def get_room_list_payload():
     """
-    Sends "ROOM_LIST:RoomA\nRoomB\n..."
+    Returns b"ROOM_LIST:RoomA\nRoomB\n..."
     """
-    list_str = get_room_list_text()
-    payload = f"ROOM_LIST:{list_str}\n"
-    conn.send(payload.encode('utf-8'))
+    return f"ROOM_LIST:{get_room_list_text()}\n".encode('utf-8')
 
-def handle_new_connection(conn):
-    """
-    1) Send welcome with current rooms
-    2) Repeatedly read a command until the user chooses or creates a room, or disconnects:
-       - "REQ:ROOM_LIST" => send room list
-       - "NEW:<Name>" => create if needed, then pick that room
-       - An existing room name => pick that room
-    3) If user picks a valid room => go to handle_client
-    """
-    global client_id_counter
+def send_room_list(conn):
+    conn.send(get_room_list_payload())
 
-    welcome = (
+def get_welcome_text():
+    return (
         "Available rooms:\n" +
         get_room_list_text() +
         "\n\nType an existing room name to join it, "
         "or type 'NEW:<RoomName>' to create a new room, "
+        "'LISTEN:<RoomName>' to join one listen-only, "
         "or 'REQ:ROOM_LIST' to refresh the room list.\n"
     )
-    conn.send(welcome.encode('utf-8'))
 
+def serve_connection(conn):
+    """
+    Worker thread of one connection: admission against MAX_CONNECTIONS, then
+    the lobby. Listeners are handed to the hub and end the thread, so they
+    count through len(hub) instead.
+    """
+    global connections
+    if tls_context is not None:
+        conn = voiceChatTls.accept(conn, tls_context, TLS_HANDSHAKE_TIMEOUT)
+        if conn is None:
+            return
+    with connections_lock:
+        admitted = not MAX_CONNECTIONS or connections + len(hub) < MAX_CONNECTIONS
+        if admitted:
+            connections += 1
+    if not admitted:
+        refuse_busy(conn, None, f"server has {MAX_CONNECTIONS} connections")
+        return
     try:
+        handle_new_connection(conn)
+    finally:
+        with connections_lock:
+            connections -= 1
+
+def refuse_busy(conn, request_id, reason):
+    """
+    SERVER_BUSY (and the request's ERR) straight on the socket, then hang up.
+    Half-close first and swallow what the client already pipelined, so the
+    close does not turn into a RST that eats our answer.
+    """
+    print(f"Refusing a newcomer: {reason}")
+    try:
+        conn.sendall(f"SERVER_BUSY:{reason}\n".encode('utf-8'))
+        respond(conn.sendall, request_id, False, f"Server busy: {reason}.")
+        conn.shutdown(socket.SHUT_WR)
+        conn.settimeout(1.0)
+        while conn.recv(4096):
+            pass
+    except OSError:
+        pass
+    conn.close()
+
+def handle_new_connection(conn):
+    """
+    1) Send welcome with current rooms, unless the client already pipelined
+       its first command (then the welcome would just be thrown away)
+    2) Repeatedly read a command until the user chooses or creates a room, or disconnects:
+       - "REQ:ROOM_LIST" => send room list
+       - "NEW:<Name>" => create if needed, then pick that room
+       - An existing room name => pick that room
+       - "LISTEN:<Name>" => pick that existing room, listen-only
+       - "RESUME:<token>" => reattach a dropped session (same id and room)
+       any of them possibly tagged "RQ:<id>:..." (answered with RE:<id>:...)
+    3) Admission: a new member over MAX_MEMBERS, or while the server sheds
+       load, gets SERVER_BUSY and is disconnected; a room at ROOM_MAX_MEMBERS
+       gets ROOM_FULL and the client stays in the lobby. Resumes always pass,
+       they still hold their seat.
+    4) If user picks a valid room => go to handle_client, or for a listener
+       hand the socket to the ListenerHub and end this thread
+    """
+    reader = ClientStreamReader(conn, 4096)
+    try:
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        pipelined = voiceChatTls.pending(conn) or select.select([conn], [], [], 0)[0]
+        if not pipelined:
+            conn.sendall(get_welcome_text().encode('utf-8'))
+
         chosen_room = None
+        member = None
 
         while True:
-            data = conn.recv(1024)
-            if not data:
+            line = reader.read_command()  # audio still coming after RESUME_FAILED is skipped
+            if line is None:
                 # user disconnected
                 conn.close()
                 return
-
-            line = data.decode('utf-8').strip()
+            request_id, line = split_request(line)
             if not line:
                 continue
+            if line == "BYE":
+                conn.close()
+                return
 
             # Refresh
             if line == "REQ:ROOM_LIST":
                 send_room_list(conn)
+                respond(conn.send, request_id, True)
                 continue
 
+            # Reconnect after a network blip
+            if line.startswith("RESUME:"):
+                token = line.split(":", 1)[1].strip()
+                member, old_conn = rooms.resume(token, conn)
+                if member is None and adopt_handoff():
+                    member, old_conn = rooms.resume(token, conn)
+                if member is None:
+                    conn.send(b"RESUME_FAILED\n")
+                    respond(conn.send, request_id, False, "Session expired.")
+                    continue
+                if handoff is not None:
+                    handed_over.add(token)
+                if old_conn is not None:
+                    # server had not noticed the drop yet; retire the stale socket
+                    try:
+                        old_conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                conn.settimeout(None)
+                attach_outbox(member, reader)
+                member.send((f"Resumed room: {member.room or ''}\nID:{member.client_id}\n"
+                             f"TOKEN:{member.token}\n").encode('utf-8'))
+                respond(member.send, request_id, True, member.room or "")
+                print(f"Client {member.client_id} resumed in room {member.room}")
+                break
+
             # Create new room
             if line.startswith("NEW:"):
                 new_room = line.split("NEW:", 1)[1].strip()
                 if not new_room:
                     conn.send(b"Invalid room name.\n")
+                    respond(conn.send, request_id, False, "Invalid room name.")
                     continue
-                if new_room not in rooms:
-                    rooms[new_room] = []
                 chosen_room = new_room
-                break
-
-            # Otherwise, try to join an existing room
-            if line in rooms:
-                chosen_room = line
-                break
+                create = True
+                listen = False
             else:
-                # invalid input
-                msg = f"Room '{line}' not found. Type 'NEW:<Name>' or 'REQ:ROOM_LIST'.\n"
-                conn.send(msg.encode('utf-8'))
-
-        # If we have a chosen room
-        client_id_counter += 1
-        this_client_id = client_id_counter
-        rooms[chosen_room].append((conn, this_client_id))
+                # Otherwise, try to join an existing room, maybe listen-only
+                listen = line.startswith("LISTEN:")
+                name = line[7:].strip() if listen else line
+                if name not in rooms:
+                    # invalid input
+                    msg = f"Room '{name}' not found. Type 'NEW:<Name>' or 'REQ:ROOM_LIST'.\n"
+                    conn.send(msg.encode('utf-8'))
+                    respond(conn.send, request_id, False, f"Room '{name}' not found.")
+                    continue
+                chosen_room = name
+                create = False
 
-        conn.send(f"Joined room: {chosen_room}\n".encode('utf-8'))
-        conn.send(f"ID:{this_client_id}\n".encode('utf-8'))
+            reason = busy_reason()
+            if reason is not None:
+                refuse_busy(conn, request_id, reason)
+                return
+            if member is None:
+                member = Member(conn, rooms.allocate_id())
+            member.listener = listen
+            try:
+                joined = rooms.join(member, chosen_room, create=create, max_members=ROOM_MAX_MEMBERS)
+            except RoomFull:
+                conn.send(f"ROOM_FULL:{chosen_room}\n".encode('utf-8'))
+                respond(conn.send, request_id, False, f"Room '{chosen_room}' is full.")
+                chosen_room = None
+                continue
+            if not joined:
+                # room emptied and closed while we were choosing
+                conn.send(f"Room '{chosen_room}' not found.\n".encode('utf-8'))
+                respond(conn.send, request_id, False, f"Room '{chosen_room}' not found.")
+                conn.close()
+                return
+            break
 
-        handle_client(conn, chosen_room, this_client_id)
+        # A resumed session already has its room and token
+        if chosen_room is not None:
+            token = rooms.issue_token(member)
+            conn.settimeout(None)
+            attach_outbox(member, reader)
+            member.send(f"Joined room: {chosen_room}\nID:{member.client_id}\nTOKEN:{token}\n".encode('utf-8'))
+            respond(member.send, request_id, True, chosen_room)
+            trace_event(T_LISTEN if member.listener else T_JOIN, chosen_room, member.client_id)
 
+    except socket.timeout:
+        print("Handshake timed out, closing connection.")
+        conn.close()
+        return
     except Exception as e:
         print("Error in handle_new_connection:", e)
         conn.close()
+        return
+
+    if not member.listener:
+        handle_client(member, reader)
 
-def handle_client(conn, room_name, client_id):
+def attach_outbox(member, reader):
     """
-    User is now in room_name. We:
-      - accept large data as audio and broadcast
-      - if it's short text, check for "REQ:ROOM_LIST"
-      - on disconnection, remove from room
+    Speakers get an Outbox with its writer thread, listeners a seat on the hub.
+    A speaker's TLS socket is then written by the Outbox while this thread
+    reads it, so both go through voiceChatTls.serialized from here on.
     """
+    if member.listener:
+        hub.attach(member, reader.take_buffer())
+    else:
+        conn = voiceChatTls.serialized(member.conn)
+        if conn is not member.conn:
+            member.conn = reader.conn = conn
+            reader.recv = conn.recv
+        member.outbox = Outbox(conn, OUTBOX_MAX_FRAMES).start()
+
+def handle_listener_line(member, line):
+    """ ListenerHub callback: a listener's lines are only ever commands. False after BYE. """
+    if line == "BYE":
+        return False
+    handle_room_command(member, line)
+    return True
+
+def send_control(member, text):
+    """ Reply to an in-room client through its outbox (keeps order with audio). """
+    member.send(encode_line(text))
+
+def respond(send, request_id, ok, detail=""):
+    """
+    Close a tagged request ("RQ:<id>:...") with RE:<id>:OK|ERR:<detail>, after
+    the reply proper and through the same send (conn.send in the lobby, the
+    outbox in a room) so it can never overtake it. No-op for untagged commands.
+    """
+    if request_id is not None:
+        send(encode_response(request_id, ok, detail))
+
+def room_full(member, request_id, room_name):
+    send_control(member, f"ROOM_FULL:{room_name}")
+    respond(member.send, request_id, False, f"Room '{room_name}' is full.")
+
+def handle_room_command(member, cmd):
+    """
+    Commands accepted once a client has an id (in a room or back in the lobby):
+      - "PONG:<ms>"                    => heartbeat answer, gives us the RTT
+      - "CAPS:fec=red,layers=<n>"      => client sends and wants RED redundancy /
+                                          publishes and decodes n simulcast layers;
+                                          ",rate=<Hz>" its capture rate, for the recorder
+      - "REQ:ROOM_LIST"               => send room list
+      - "SWITCH:<Name>" / "NEW:<Name>" => move to that room (created if needed)
+      - "LEAVE"                        => back to the lobby, same connection and id
+      - "E2E_PUB:<key>"                => our E2E public key: answered with the room's
+                                          ("E2E_ROOM:<id>=<key>,..."), passed on to them
+      - "E2E_KEY:<id>:<blob>"          => wrapped room key, relayed to <id> in our room
+      - "<Name>" (lobby only)          => join an existing room
+    Joins and switches into a room at ROOM_MAX_MEMBERS get ROOM_FULL instead.
+    Listeners may also use "LISTEN:<Name>" for a join or switch; their role is
+    fixed for the session, so a speaker's LISTEN is refused.
+    Any of them may come tagged "RQ:<id>:<cmd>" and is then closed with respond().
+    Returns False if cmd is not a command (legacy clients: treat as audio).
+    """
+    request_id, cmd = split_request(cmd)
+    if cmd.startswith("LISTEN:"):
+        if not member.listener:
+            send_control(member, "Listen-only is chosen on the first join; reconnect to listen.")
+            respond(member.send, request_id, False, "Joined as a speaker.")
+            return True
+        cmd = cmd[7:].strip() if member.room is None else "SWITCH:" + cmd[7:]
+
+    if cmd.startswith("PONG:"):
+        try:
+            member.rtt = max(0.0, time.time() - int(cmd[5:]) / 1000.0)
+        except ValueError:
+            pass
+        return True
+
+    if cmd.startswith("CAPS:"):
+        caps = parse_caps(cmd[5:])
+        member.fec = caps.get("fec") == "red"
+        try:
+            member.layers = max(1, min(MAX_LAYERS, int(caps.get("layers", 1))))
+        except ValueError:
+            member.layers = 1
+        member.layer = min(member.layer, member.layers - 1)
+        if recorder is not None and caps.get("rate", "").isdigit():
+            recorder.set_rate(member.client_id, int(caps["rate"]))
+        accepted = []
+        if member.fec:
+            accepted.append("fec=red")
+        if member.layers > 1:
+            accepted.append(f"layers={member.layers}")
+        send_control(member, "CAPS_OK:" + ",".join(accepted))
+        trace_event(T_CAPS, member.room, member.client_id, ",".join(accepted).encode('utf-8'))
+        respond(member.send, request_id, True, ",".join(accepted))
+        return True
+
+    if cmd.startswith("E2E_PUB:"):
+        key = cmd[8:].strip()
+        room_name = member.room
+        if room_name is None or not valid_e2e_key(key):
+            respond(member.send, request_id, False, "Not in a room." if room_name is None else "Bad key.")
+            return True
+        member.e2e_pub = key
+        others = [other for other in rooms.members(room_name) if other is not member and other.e2e_pub is not None]
+        send_control(member, "E2E_ROOM:" + ",".join(f"{other.client_id}={other.e2e_pub}" for other in others))
+        line = encode_line(f"E2E_PUB:{member.client_id}:{key}")
+        for other in others:
+            other.send(line)
+        respond(member.send, request_id, True)
+        return True
+
+    if cmd.startswith("E2E_KEY:"):
+        to_id, _, blob = cmd[8:].partition(":")
+        target = None
+        if member.room is not None and member.e2e_pub is not None:
+            target = next((other for other in rooms.members(member.room)
+                           if str(other.client_id) == to_id and other.e2e_pub is not None), None)
+        if target is None or not blob:
+            respond(member.send, request_id, False, "No such E2E member.")
+            return True
+        target.send(encode_line(f"E2E_KEY:{member.client_id}:{blob}"))
+        respond(member.send, request_id, True)
+        return True
+
+    if cmd == "REQ:ROOM_LIST":
+        member.send(get_room_list_payload())
+        respond(member.send, request_id, True)
+        return True
+
+    if cmd.startswith("SWITCH:") or cmd.startswith("NEW:"):
+        new_room = cmd.split(":", 1)[1].strip()
+        if not new_room:
+            send_control(member, "Invalid room name.")
+            respond(member.send, request_id, False, "Invalid room name.")
+            return True
+        old_room = member.room
+        try:
+            rooms.move(member, new_room, create=True, max_members=ROOM_MAX_MEMBERS)
+        except RoomFull:
+            room_full(member, request_id, new_room)
+            return True
+        trace_event(T_JOIN, new_room, member.client_id)
+        if old_room != new_room:
+            e2e_gone(member, old_room)
+            member.e2e_missed.clear()
+        print(f"Client {member.client_id} moved from room {old_room} to {new_room}")
+        send_control(member, f"Joined room: {new_room}")
+        respond(member.send, request_id, True, new_room)
+        return True
+
+    if cmd == "LEAVE":
+        old_room = member.room
+        if old_room is None and request_id is not None:
+            respond(member.send, request_id, False, "Not in a room.")
+            return True
+        rooms.leave(member)
+        trace_event(T_LEAVE, old_room, member.client_id)
+        e2e_gone(member, old_room)
+        member.e2e_missed.clear()
+        print(f"Client {member.client_id} left room {old_room}")
+        send_control(member, f"Left room: {old_room}")
+        respond(member.send, request_id, True, old_room)
+        return True
+
+    if member.room is None and cmd:
+        try:
+            joined = rooms.move(member, cmd, max_members=ROOM_MAX_MEMBERS)
+        except RoomFull:
+            room_full(member, request_id, cmd)
+            return True
+        if joined:
+            trace_event(T_JOIN, cmd, member.client_id)
+            send_control(member, f"Joined room: {cmd}")
+            respond(member.send, request_id, True, cmd)
+        else:
+            send_control(member, f"Room '{cmd}' not found. Type 'NEW:<Name>' or 'REQ:ROOM_LIST'.")
+            respond(member.send, request_id, False, f"Room '{cmd}' not found.")
+        return True
+
+    if request_id is not None:
+        # a tagged line is always a command, never audio
+        respond(member.send, request_id, False, "Unknown command.")
+        return True
+    return False
+
+def count_forwarded(room_name, nbytes):
+    """ Running total per room for the load monitors; racy += is fine for a rate estimate. """
+    forwarded_bytes[room_name] = forwarded_bytes.get(room_name, 0) + nbytes
+
+def forward_data(member, room_name, data):
+    """ Raw PCM (AUDIO or legacy bare PCM): same bytes to every other member. """
+    frame = f"DATA:{member.client_id}:{len(data)}\n".encode('utf-8') + data
+    listeners = 0
+    for other in rooms.members(room_name):
+        if other is not member:
+            other.send(frame)
+            listeners += 1
+    count_forwarded(room_name, listeners * len(frame))
+
+def forward_media(member, room_name, data):
+    """
+    Stamped MEDIA body, passed on byte for byte, except that each listener
+    gets only its simulcast layer and the RED block is stripped for listeners
+    that did not negotiate FEC. Sealed (FLAG_E2E) frames go only to members
+    with an E2E key (e2e_mismatch tells both sides about the rest); the RED
+    block is stripped all the same. While the room is shedding load (DEGRADED
+    or worse) simulcast listeners get layer SHED_LAYER or cheaper and nobody gets RED.
+    """
+    client_id = member.client_id
+    frame = f"MEDIA:{client_id}:{len(data)}\n".encode('utf-8') + data
+    plain_frame = None  # same frame minus the RED block, built on first need
+    has_red = len(data) > 2 and data[1] & FLAG_RED
+    sealed = len(data) > 2 and data[1] & FLAG_E2E
+    layer = data[2] if len(data) > 2 else 0
+    simulcast = member.layers > 1  # sender publishes more than the full layer
+    degraded = shed_level(room_name) >= DEGRADED
+    floor = min(SHED_LAYER, member.layers - 1) if degraded else 0
+    sent = 0
+    for other in rooms.members(room_name):
+        if other is member:
+            continue
+        if sealed and other.e2e_pub is None:
+            e2e_mismatch(member, other)
+            continue
+        if simulcast and other.layers > 1:
+            lower_layer_if_congested(other)
+            want = max(min(other.layer, member.layers - 1), floor)
+        else:
+            want = 0
+        if layer != want:
+            continue  # each capture arrives once per layer; forward only this listener's
+        if has_red and (degraded or not other.fec):
+            if plain_frame is None:
+                plain = strip_redundancy(data)
+                plain_frame = f"MEDIA:{client_id}:{len(plain)}\n".encode('utf-8') + plain
+            other.send(plain_frame)
+            sent += len(plain_frame)
+        else:
+            other.send(frame)
+            sent += len(frame)
+    count_forwarded(room_name, sent)
+
+def handle_client(member, reader):
+    """
+    User is now in member.room. We:
+      - forward AUDIO/MEDIA frames (or bare PCM from older clients) to the rest
+        of the room (forward_data / forward_media)
+      - then hand each frame to media_taps (e.g. the room recorder)
+      - handle room commands, including switching rooms without reconnecting
+      - measure each sender's level for SPEAKING events (measure_level)
+      - hold back audio past the room's speaker limit or while shedding (admit_speaker)
+      - on "BYE", remove from room
+      - on disconnection, keep the seat for RESUME_GRACE seconds (session_reaper
+        removes it if the client does not come back)
+    With profiling on, each stage is timed: recv (including waiting for the
+    client), parse, command, fanout, taps.
+    """
+    conn = member.conn
+    outbox = member.outbox
+    client_id = member.client_id
+    said_bye = False
+    timing = profile.enabled
+    if timing:
+        recv_timer = reader.recv = profile.TimedCall(reader.recv)
     try:
         while True:
-            data = conn.recv(4096)
-            if not data:
+            if timing:
+                t0 = time.perf_counter()
+                recv_before = recv_timer.elapsed
+            kind, data = reader.read_message()
+            if kind is None:
                 break
+            member.last_seen = time.monotonic()
+            if timing:
+                t1 = time.perf_counter()
+                recv_time = recv_timer.elapsed - recv_before
+                profile.record("recv", recv_time)
+                profile.record("parse", t1 - t0 - recv_time)
 
-            # Distinguish short text from large audio
-            if len(data) < 300:
-                try:
-                    text_cmd = data.decode('utf-8').strip()
-                    if text_cmd == "REQ:ROOM_LIST":
-                        send_room_list(conn)
-                        continue
-                    # else not recognized => treat as audio anyway
-                except UnicodeDecodeError:
-                    pass
+            if kind == COMMAND:
+                if data == "BYE":
+                    said_bye = True
+                    break
+                handled = handle_room_command(member, data)
+                if timing:
+                    profile.record("command", time.perf_counter() - t1)
+                if handled:
+                    continue
+                # not recognized => treat as audio anyway
+                data = data.encode('utf-8')
+
+            room_name = member.room
+            if room_name is None:
+                continue  # in the lobby, nobody to hear it
+            now = member.last_seen
+            voiced = measure_level(member, room_name, kind, data, now)
+            if not admit_speaker(member, room_name, now, voiced):
+                continue  # over the speaker limit, or shedding: listen only / drop silence
 
-            # treat as audio
-            with broadcast_lock:
-                for cl, cl_id in rooms[room_name]:
-                    if cl != conn:
-                        header = f"DATA:{client_id}:{len(data)}\n".encode('utf-8')
-                        cl.send(header + data)
+            if kind == MEDIA:
+                forward_media(member, room_name, data)
+            else:
+                forward_data(member, room_name, data)
+            if timing:
+                t2 = time.perf_counter()
+                profile.record("fanout", t2 - t1)
+            for tap in media_taps:
+                tap(room_name, client_id, kind, data)
+            if timing:
+                profile.record("taps", time.perf_counter() - t2)
 
     except Exception as e:
         print("Error or disconnection:", e)
     finally:
-        remove_from_room(conn, room_name, client_id)
+        outbox.close()
         conn.close()
-        print(f"Client {client_id} disconnected from room {room_name}")
+        hang_up(member, conn, said_bye)
 
-def remove_from_room(conn, room_name, client_id):
+def hang_up(member, conn, said_bye):
     """
-    Remove (conn, client_id) from that room. If empty => del rooms[room_name].
+    conn is closed: after BYE the session ends, otherwise the seat is held for
+    RESUME_GRACE seconds. Also the ListenerHub's on_gone.
     """
-    if room_name in rooms:
-        pair = (conn, client_id)
-        if pair in rooms[room_name]:
-            rooms[room_name].remove(pair)
-            if not rooms[room_name]:
-                del rooms[room_name]  # auto-close empty room
+    room_name = member.room
+    if said_bye:
+        rooms.end_session(member)
+        trace_event(T_GONE, room_name, member.client_id)
+        e2e_gone(member, room_name)
+        print(f"Client {member.client_id} disconnected from room {room_name}")
+    elif rooms.detach(member, conn):
+        print(f"Client {member.client_id} dropped from room {room_name}, holding seat for resume")
 
-start()
\ No newline at end of file
+if __name__ == "__main__":
+    start()
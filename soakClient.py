@@ -0,0 +1,380 @@
+"""
+Soak test: hundreds of virtual participants in one process, each with its own
+connection doing the full client handshake (NEW:<room>, ID/TOKEN, CAPS, PING/PONG),
+the speakers among them sending stamped MEDIA frames in real time.
+
+    python soakClient.py                                   # spawns a local newServer.py
+    python soakClient.py --clients 200 --rooms 1 --speakers 3 --seconds 300
+    python soakClient.py --host 1.2.3.4 --wav speech.wav --measure
+    python soakClient.py --clients 2000 --speakers 2 --listen   # big audience, listen-only
+    python soakClient.py --tls                             # local server with a fresh certificate
+    python soakClient.py --host 1.2.3.4 --tls cert.pem     # a TLS server's self-signed certificate
+
+Everything runs on one asyncio loop; a participant costs a socket and two
+tasks, not the eight threads of a real client (voiceChatEngine), so a laptop
+can put a few hundred of them in a room. Audio is a synthetic tone or a
+16-bit WAV file, cut into chunks once and shared by all speakers.
+
+Listeners discard what they receive, or with --measure parse every MEDIA
+header for loss (seq) and delivery time (arrival minus the sender's stamp;
+all participants share this machine's clock). "lag" is how late the
+speakers' send schedule ran: if it grows, this process is the bottleneck,
+not the server.
+"""
+import argparse
+import array
+import asyncio
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+from joinStormBench import raise_fd_limit
+from voiceChatMedia import (LAYER_DECIMATION, RED_DECIMATION, MediaFrame, average_down, decimate,
+                            pack_media)
+from voiceChatProfile import Histogram
+from voiceChatProtocol import MAX_LAYERS, MEDIA_HEADER, encode_line, encode_media
+from voiceChatTls import TLS_SERVER_NAME, client_context, make_self_signed
+
+TONE_AMPLITUDE = 3000
+SEND_BUFFER_MAX = 256 * 1024   # bytes queued on a connection before its frames are dropped
+
+
+class AudioSource:
+    """
+    Chunks of PCM with everything a speaker sends alongside each one (the
+    RED copy of the previous chunk, the lower simulcast layers), built once.
+    """
+
+    def __init__(self, pcm, rate, chunk, layers):
+        self.rate = rate
+        self.chunk = chunk
+        step = 2 * chunk
+        if len(pcm) % step:
+            pcm += bytes(step - len(pcm) % step)
+        self.payloads = [pcm[i:i + step] for i in range(0, len(pcm), step)]
+        self.redundant = [decimate(p, RED_DECIMATION) for p in self.payloads]
+        self.layers = [tuple(average_down(p, factor) for factor in LAYER_DECIMATION[1:layers])
+                       for p in self.payloads]
+
+    @classmethod
+    def tone(cls, rate, chunk, layers, freq=440.0, seconds=1.0):
+        n = int(rate * seconds)
+        samples = array.array('h', (int(TONE_AMPLITUDE * math.sin(2 * math.pi * freq * i / rate))
+                                    for i in range(n)))
+        if sys.byteorder != "little":
+            samples.byteswap()
+        return cls(samples.tobytes(), rate, chunk, layers)
+
+    @classmethod
+    def from_wav(cls, path, chunk, layers):
+        with wave.open(path, "rb") as w:
+            if w.getsampwidth() != 2:
+                raise ValueError(f"{path}: need 16-bit PCM")
+            channels = w.getnchannels()
+            rate = w.getframerate()
+            pcm = w.readframes(w.getnframes())
+        if channels > 1:
+            samples = array.array('h', pcm)
+            pcm = samples[::channels].tobytes()  # first channel
+        return cls(pcm, rate, chunk, layers)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def bodies(self, idx, seq, sample_ts, now, fec):
+        """ MEDIA bodies for one capture: full layer first, then the lower layers. """
+        prev = (idx - 1) % len(self.payloads)
+        frame = MediaFrame(seq, sample_ts, now, self.payloads[idx], send_time=now,
+                           redundant=self.redundant[prev] if fec and seq else None)
+        out = [pack_media(frame)]
+        for layer, payload in enumerate(self.layers[idx], 1):
+            out.append(pack_media(MediaFrame(seq, sample_ts, now, payload, layer=layer, send_time=now)))
+        return out
+
+
+class SoakStats:
+    def __init__(self):
+        self.speakers = 0
+        self.connected = 0
+        self.joined = 0
+        self.failed = 0
+        self.dropped = 0          # connections lost mid-test
+        self.frames_out = 0
+        self.frames_skipped = 0   # not sent: the connection's send buffer was full
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.lost = 0
+        self.join_time = Histogram("join")
+        self.delivery = Histogram("delivery")
+        self.lag = Histogram("send lag")
+        self.errors = []
+
+    def line(self, elapsed):
+        return (f"{elapsed:6.1f}s joined {self.joined}/{self.connected} failed {self.failed} "
+                f"dropped {self.dropped} | out {self.frames_out} fr {self.bytes_out / 1e6:.1f} MB "
+                f"skipped {self.frames_skipped} | in {self.frames_in} fr {self.bytes_in / 1e6:.1f} MB "
+                f"lost {self.lost} | delivery p50<={self.delivery.percentile(50) * 1000:.0f} ms "
+                f"p99<={self.delivery.percentile(99) * 1000:.0f} ms | lag max {self.lag.max * 1000:.0f} ms")
+
+
+class VirtualParticipant:
+    """ One connection: joins, speaks (if a speaker) and listens until the deadline. """
+
+    def __init__(self, args, stats, source, index, room, speaker):
+        self.args = args
+        self.stats = stats
+        self.source = source
+        self.index = index
+        self.room = room
+        self.speaker = speaker
+        self.reader = None
+        self.writer = None
+        self.client_id = None
+        self.expected = {}   # sender id -> next seq (--measure)
+
+    async def run(self, deadline):
+        args = self.args
+        t0 = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(args.host, args.port, ssl=args.ssl,
+                                        server_hostname=args.server_name), args.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.stats.failed += 1
+            self.stats.errors.append(e)
+            return
+        self.stats.connected += 1
+        try:
+            self.writer.write(encode_line(self.join_line()))
+            await asyncio.wait_for(self.await_join(), args.timeout)
+            self.stats.join_time.add(time.perf_counter() - t0)
+            self.stats.joined += 1
+            caps = [f"rate={self.source.rate}"]
+            if args.fec:
+                caps.append("fec=red")
+            if args.layers > 1:
+                caps.append(f"layers={args.layers}")
+            self.writer.write(encode_line("CAPS:" + ",".join(caps)))
+            receiving = asyncio.ensure_future(self.receive())
+            if self.speaker:
+                await self.speak(deadline)
+            else:
+                await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+            if receiving.done():
+                self.stats.dropped += 1
+            receiving.cancel()
+            self.writer.write(encode_line("BYE"))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+            self.stats.failed += 1
+            self.stats.errors.append(e)
+        finally:
+            self.writer.close()
+
+    def join_line(self):
+        if self.args.listen and not self.speaker:
+            return f"LISTEN:{self.room}"
+        return f"NEW:{self.room}"
+
+    async def await_join(self):
+        """
+        Skip the welcome text; ID and TOKEN follow "Joined room:" and are read by
+        receive(). Admission refusals count as failed joins.
+        """
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("closed before join")
+            if line.startswith(b"Joined room:"):
+                return
+            if line.startswith((b"SERVER_BUSY", b"ROOM_FULL:")):
+                raise ConnectionRefusedError(line.decode('utf-8').strip())
+            if line.startswith(b"Room '"):
+                # LISTEN before the room's first speaker created it: try again
+                await asyncio.sleep(0.1)
+                self.writer.write(encode_line(self.join_line()))
+
+    async def receive(self):
+        reader = self.reader
+        stats = self.stats
+        measure = self.args.measure
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if line.startswith((b"MEDIA:", b"DATA:")):
+                    _, sid, length = line.split(b":")
+                    body = await reader.readexactly(int(length))
+                    stats.frames_in += 1
+                    stats.bytes_in += len(body)
+                    if measure and line.startswith(b"MEDIA:"):
+                        self.measure(int(sid), body)
+                elif line.startswith(b"PING:"):
+                    self.writer.write(b"PONG:" + line[5:])
+                elif line.startswith(b"ID:"):
+                    self.client_id = int(line[3:])
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            return
+
+    def measure(self, sid, body):
+        _, _, _, _, seq, _, _, send_time = MEDIA_HEADER.unpack_from(body)
+        self.stats.delivery.add(max(0.0, time.time() - send_time))
+        expected = self.expected.get(sid)
+        if expected is not None and seq > expected:
+            self.stats.lost += seq - expected
+        if expected is None or seq >= expected:
+            self.expected[sid] = seq + 1
+
+    async def speak(self, deadline):
+        """ One capture every chunk period, on a fixed schedule (no drift, no catch-up bursts). """
+        source = self.source
+        stats = self.stats
+        period = source.chunk / source.rate
+        idx = (self.index * 7) % len(source)   # speakers do not all say the same thing at once
+        seq = 0
+        start = time.monotonic() + period
+        transport = self.writer.transport
+        while True:
+            due = start + seq * period
+            if due >= deadline:
+                return
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats.lag.add(max(0.0, time.monotonic() - due))
+            if transport.is_closing():
+                raise ConnectionError("connection lost")
+            if transport.get_write_buffer_size() > SEND_BUFFER_MAX:
+                stats.frames_skipped += 1
+            else:
+                for body in source.bodies(idx, seq, seq * source.chunk, time.time(), self.args.fec):
+                    self.writer.write(encode_media(body))
+                    stats.frames_out += 1
+                    stats.bytes_out += len(body)
+            seq += 1
+            idx = (idx + 1) % len(source)
+
+
+async def soak(args, source):
+    stats = SoakStats()
+    loop_start = time.monotonic()
+    ramp_end = loop_start + args.ramp
+    deadline = ramp_end + args.seconds
+    participants = []
+    for i in range(args.clients):
+        room = f"soak-{i % args.rooms}"
+        speaker = i // args.rooms < args.speakers   # the first joiners of each room speak
+        participants.append(VirtualParticipant(args, stats, source, i, room, speaker))
+        stats.speakers += speaker
+
+    async def start(p, i):
+        if args.ramp:
+            await asyncio.sleep(args.ramp * i / args.clients)
+        await p.run(deadline)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report)
+            print(stats.line(time.monotonic() - loop_start), flush=True)
+
+    reporter = asyncio.ensure_future(report())
+    await asyncio.gather(*(start(p, i) for i, p in enumerate(participants)))
+    reporter.cancel()
+    return stats, time.monotonic() - loop_start
+
+
+def spawn_server(clients, port, env=None):
+    """ newServer.py from this directory on port, with a listen backlog big enough for the ramp. """
+    env = dict(os.environ, VOICECHAT_PORT=str(port), VOICECHAT_LISTEN_BACKLOG=str(max(clients, 128)), **(env or {}))
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "newServer.py")
+    server_proc = subprocess.Popen([sys.executable, server_script], env=env, stdout=subprocess.DEVNULL)
+    time.sleep(1.0)
+    return server_proc
+
+
+def setup_tls(args, tmp):
+    """
+    --tls: args.ssl and args.server_name for open_connection. A local server
+    gets a certificate made in tmp; returns the server's env for it.
+    """
+    args.ssl = args.server_name = None
+    if args.tls is None:
+        return {}
+    env = {}
+    if args.host is None and not args.tls:
+        args.tls = os.path.join(tmp, "cert.pem")
+        make_self_signed(args.tls, os.path.join(tmp, "key.pem"))
+        env = {"VOICECHAT_TLS_CERT": args.tls, "VOICECHAT_TLS_KEY": os.path.join(tmp, "key.pem")}
+    args.ssl = client_context(args.tls or None)
+    args.server_name = TLS_SERVER_NAME if args.tls else args.host
+    return env
+
+
+def parser():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default=None, help="server to drive (default: spawn newServer.py locally)")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--clients", type=int, default=200)
+    ap.add_argument("--rooms", type=int, default=1)
+    ap.add_argument("--speakers", type=int, default=3, help="speakers per room (the rest only listen)")
+    ap.add_argument("--seconds", type=float, default=60.0, help="how long everyone stays after the ramp")
+    ap.add_argument("--ramp", type=float, default=5.0, help="spread the joins over this many seconds")
+    ap.add_argument("--wav", default=None, help="16-bit WAV to send (default: a 440 Hz tone)")
+    ap.add_argument("--rate", type=int, default=44100, help="sample rate of the tone")
+    ap.add_argument("--chunk", type=int, default=4096, help="frames per chunk (the clients' Chunks)")
+    ap.add_argument("--fec", action="store_true", help="negotiate RED and send redundant copies")
+    ap.add_argument("--layers", type=int, default=1, help="simulcast layers to negotiate and publish")
+    ap.add_argument("--listen", action="store_true",
+                    help="non-speakers join with LISTEN:<room> (server's listen-only path)")
+    ap.add_argument("--measure", action="store_true", help="parse received frames for loss and delivery time")
+    ap.add_argument("--report", type=float, default=5.0, help="seconds between progress lines")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--tls", nargs="?", const="", default=None, metavar="CAFILE",
+                    help="connect over TLS, trusting CAFILE (a local server gets a fresh certificate)")
+    return ap
+
+
+def main():
+    args = parser().parse_args()
+    args.layers = max(1, min(MAX_LAYERS, args.layers))
+
+    if args.wav:
+        source = AudioSource.from_wav(args.wav, args.chunk, args.layers)
+    else:
+        source = AudioSource.tone(args.rate, args.chunk, args.layers)
+    raise_fd_limit(args.clients + 64)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server_env = setup_tls(args, tmp)
+        server_proc = None
+        if args.host is None:
+            args.host = "127.0.0.1"
+            server_proc = spawn_server(args.clients, args.port, server_env)
+
+        try:
+            stats, total = asyncio.run(soak(args, source))
+        finally:
+            if server_proc is not None:
+                server_proc.terminate()
+                server_proc.wait()
+
+    print(f"clients:   {args.clients} in {args.rooms} room(s), {stats.speakers} speaking, "
+          f"{source.chunk / source.rate * 1000:.0f} ms chunks")
+    print(stats.line(total))
+    print(f"join:      p50<={stats.join_time.percentile(50) * 1000:.0f} ms "
+          f"p99<={stats.join_time.percentile(99) * 1000:.0f} ms max {stats.join_time.max * 1000:.0f} ms")
+    if stats.delivery.count:
+        print(f"delivery:  avg {stats.delivery.total / stats.delivery.count * 1000:.1f} ms "
+              f"p99<={stats.delivery.percentile(99) * 1000:.0f} ms max {stats.delivery.max * 1000:.0f} ms")
+    print(f"send lag:  p99<={stats.lag.percentile(99) * 1000:.0f} ms max {stats.lag.max * 1000:.0f} ms")
+    if stats.errors:
+        print(f"errors:    {len(stats.errors)}, first: {stats.errors[0]!r}")
+
+
+if __name__ == "__main__":
+    main()
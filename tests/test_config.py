@@ -0,0 +1,78 @@
+import pytest
+
+from voiceChatConfig import CONFIG_ENV, Config, ConfigError, at_least, between, multiple_of, one_of
+
+
+@pytest.fixture
+def ini(tmp_path):
+    path = tmp_path / "voicechat.ini"
+    path.write_text("[server]\nport = 7000\nhost = file.example\nrecord_rooms = a, b\n\n[client]\nport = 9\n")
+    return str(path)
+
+
+def test_flag_beats_environment_beats_file_beats_default(ini):
+    environ = {CONFIG_ENV: ini, "VOICECHAT_PORT": "6000", "VOICECHAT_HOST": "env.example"}
+    config = Config("server", ["--port", "5001"], environ=environ)
+    assert config.get("port", 5000) == 5001
+    assert config.get("host", "0.0.0.0") == "env.example"
+    assert config.get("record_rooms", []) == ["a", "b"]
+    assert config.get("backlog", 1024) == 1024
+    config.done()
+    assert config.changed() == ["port=5001 (--port)", "host=env.example (VOICECHAT_HOST)",
+                                f"record_rooms=['a', 'b'] ({ini} [server] record_rooms)"]
+
+
+def test_config_file_from_flag_and_its_own_section(ini):
+    config = Config("client", [f"--config={ini}"], env_prefix="VOICECHAT_CLIENT_",
+                    environ={"VOICECHAT_PORT": "6000"})
+    assert config.get("port", 5000) == 9
+
+
+def test_values_parse_as_the_default_type():
+    config = Config("client", ["--tls", "--rate=16000", "--gain", "1.5", "--fec", "no"], environ={})
+    assert config.get("tls", False) is True
+    assert config.get("rate", 44100) == 16000
+    assert config.get("gain", 1.0) == 1.5
+    assert config.get("fec", True) is False
+
+
+def test_checks():
+    at_least(1)(1)
+    between(1, 10)(10)
+    multiple_of(4)(8)
+    one_of("a", "b")("b")
+    for check, value in ((at_least(1), 0), (between(1, 10), 11), (multiple_of(4), 6), (multiple_of(4), 0),
+                         (one_of("a", "b"), "c")):
+        with pytest.raises(ValueError):
+            check(value)
+
+
+def test_bad_value_names_its_source():
+    config = Config("server", environ={"VOICECHAT_PORT": "0"})
+    with pytest.raises(ConfigError, match="VOICECHAT_PORT"):
+        config.get("port", 5000, check=between(1, 65535))
+    with pytest.raises(ConfigError, match="whole number"):
+        Config("server", environ={"VOICECHAT_PORT": "x"}).get("port", 5000)
+
+
+def test_unknown_keys_are_refused(ini):
+    config = Config("server", environ={CONFIG_ENV: ini})
+    config.get("port", 5000)
+    with pytest.raises(ConfigError, match="host"):
+        config.done()
+
+
+def test_command_line_errors_exit_with_status_2(capsys):
+    config = Config("server", ["--prot", "6000"], environ={})
+    config.get("port", 5000)
+    with pytest.raises(SystemExit) as e:
+        config.done()
+    assert e.value.code == 2
+    assert "--prot" in capsys.readouterr().err
+
+
+def test_require():
+    config = Config("server", environ={})
+    config.require(True, "fine")
+    with pytest.raises(ConfigError, match="longer"):
+        config.require(False, "idle_timeout must be longer than heartbeat_interval")
@@ -0,0 +1,84 @@
+import base64
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+from voiceChatE2E import RoomKeys  # noqa: E402
+from voiceChatMedia import MediaFrame, pack_media, unpack_media  # noqa: E402
+from voiceChatProtocol import FLAG_E2E  # noqa: E402
+
+
+def keys(client_id):
+    room_keys = RoomKeys()
+    room_keys.my_id = client_id
+    return room_keys
+
+
+def pub(room_keys):
+    return base64.b64encode(room_keys.public).decode('ascii')
+
+
+def relay(line, from_id):
+    """ What the server does with our "E2E_KEY:<to>:<blob>": (to, blob) with from_id put in. """
+    _, to_id, blob = line.split(":", 2)
+    return int(to_id), (from_id, blob)
+
+
+def room_of_two():
+    a, b = keys(1), keys(2)
+    assert a.on_room("") == []  # first in the room: makes a key, nobody to send it to
+    assert b.on_room(f"1={pub(a)}") == []
+    (line,) = a.on_peer(2, pub(b))
+    to_id, (from_id, blob) = relay(line, 1)
+    assert to_id == 2 and b.on_key(from_id, blob)
+    return a, b
+
+
+def sealed_frame(room_keys, sender_id, seq=1):
+    frame = MediaFrame(seq, 160 * seq, 1700000000.0, b"\x01\x02" * 80, redundant=b"\x03\x04" * 20)
+    body = pack_media(frame, seal=lambda f, block, data: room_keys.seal(sender_id, f, block, data))
+    return frame, body
+
+
+def test_seal_and_open():
+    a, b = room_of_two()
+    frame, body = sealed_frame(a, 1)
+    got = unpack_media(body)
+    assert got.flags & FLAG_E2E and got.payload != frame.payload
+    assert b.open_frame(1, got)
+    assert got.payload == frame.payload and got.redundant == frame.redundant
+
+
+def test_open_fails_for_another_sender_or_a_tampered_frame():
+    a, b = room_of_two()
+    _, body = sealed_frame(a, 1)
+    assert not b.open_frame(3, unpack_media(body))
+    tampered = bytearray(body)
+    tampered[-1] ^= 1
+    assert not b.open_frame(1, unpack_media(bytes(tampered)))
+    assert b.undecryptable == 2
+
+
+def test_nothing_goes_out_without_a_key():
+    lone = keys(5)
+    assert sealed_frame(lone, 5)[1] is None
+
+
+def test_leaver_triggers_a_new_key_and_recent_frames_still_open():
+    a, b = room_of_two()
+    c = keys(3)
+    c.on_room(f"1={pub(a)},2={pub(b)}")
+    b.on_peer(3, pub(c))
+    for line in a.on_peer(3, pub(c)):
+        to_id, key = relay(line, 1)
+        assert to_id == 3 and c.on_key(*key)
+    _, before = sealed_frame(a, 1, seq=1)
+
+    lines = a.on_gone(3)
+    assert [relay(line, 1)[0] for line in lines] == [2]
+    b.on_key(*relay(lines[0], 1)[1])
+    _, after = sealed_frame(a, 1, seq=2)
+    assert b.open_frame(1, unpack_media(before)) and b.open_frame(1, unpack_media(after))
+    assert c.open_frame(1, unpack_media(before))
+    assert not c.open_frame(1, unpack_media(after))
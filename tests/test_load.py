@@ -0,0 +1,65 @@
+import pytest
+
+import voiceChatLoad
+from voiceChatLoad import DEGRADED, LISTEN_ONLY, NORMAL, RECOVER_HOLD, LoadMonitor
+
+
+class Clock:
+    """ Stands in for the time module: the test moves the wall clock, CPU stays idle. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def process_time(self):
+        return 0.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(voiceChatLoad, "time", fake)
+    return fake
+
+
+def sample(monitor, clock, depth, seconds=1.0):
+    clock.now += seconds
+    return monitor.sample([depth, depth], 0)
+
+
+def test_levels_go_up_at_once(clock):
+    monitor = LoadMonitor(queue=10)
+    assert sample(monitor, clock, 5) == (NORMAL, False)
+    assert sample(monitor, clock, 10) == (DEGRADED, True)
+    assert sample(monitor, clock, 10) == (DEGRADED, False)
+    assert sample(monitor, clock, 15) == (LISTEN_ONLY, True)
+
+
+def test_overload_skips_straight_to_listen_only(clock):
+    monitor = LoadMonitor(queue=10)
+    assert sample(monitor, clock, 20) == (LISTEN_ONLY, True)
+
+
+def test_levels_come_down_one_step_after_the_hold(clock):
+    monitor = LoadMonitor(queue=10)
+    sample(monitor, clock, 20)
+    assert sample(monitor, clock, 1) == (LISTEN_ONLY, False)  # calm from here
+    assert sample(monitor, clock, 1, RECOVER_HOLD - 1) == (LISTEN_ONLY, False)
+    assert sample(monitor, clock, 1) == (DEGRADED, True)
+    assert sample(monitor, clock, 1, RECOVER_HOLD) == (NORMAL, True)
+
+
+def test_load_between_recover_and_threshold_holds_the_level(clock):
+    monitor = LoadMonitor(queue=10)
+    sample(monitor, clock, 10)
+    sample(monitor, clock, 1)
+    assert sample(monitor, clock, 8, RECOVER_HOLD - 1) == (DEGRADED, False)  # resets the calm
+    assert sample(monitor, clock, 1, RECOVER_HOLD - 1) == (DEGRADED, False)
+    assert sample(monitor, clock, 1) == (DEGRADED, False)
+
+
+def test_disabled_signals_never_shed(clock):
+    monitor = LoadMonitor()
+    assert sample(monitor, clock, 10 ** 6) == (NORMAL, False)
@@ -0,0 +1,90 @@
+import pytest
+
+from voiceChatMedia import (RED_DECIMATION, MediaFrame, SequenceTracker, pack_media, recover_lost_frame,
+                            unpack_media)
+from voiceChatProtocol import FLAG_RED, MEDIA_HEADER, strip_redundancy
+
+
+def frame(seq, sample_ts=0, payload=b"\x01\x00" * 8, **kwargs):
+    return MediaFrame(seq, sample_ts, 1700000000.25, payload, **kwargs)
+
+
+def test_pack_unpack_round_trip():
+    sent = frame(7, 4096, layer=1, send_time=1700000000.5, level=42)
+    got = unpack_media(pack_media(sent))
+    assert (got.seq, got.sample_ts, got.capture_time, got.send_time, got.layer, got.level) == (
+        7, 4096, 1700000000.25, 1700000000.5, 1, 42)
+    assert got.payload == sent.payload and got.redundant is None
+
+
+def test_pack_wraps_seq_to_32_bits():
+    assert unpack_media(pack_media(frame(2 ** 32 + 5))).seq == 5
+
+
+def test_unpack_refuses_an_unknown_version():
+    body = bytearray(pack_media(frame(1)))
+    body[0] = 99
+    with pytest.raises(ValueError):
+        unpack_media(bytes(body))
+    assert len(body) == MEDIA_HEADER.size + 16
+
+
+def track(*seqs):
+    tracker = SequenceTracker(8000)
+    gaps = [tracker.update(frame(seq, seq * 160), arrival=seq * 0.02) for seq in seqs]
+    return tracker, gaps
+
+
+def test_sequence_in_order():
+    tracker, gaps = track(0, 1, 2, 3)
+    assert gaps == [0, 0, 0, 0]
+    assert (tracker.received, tracker.lost, tracker.reordered, tracker.duplicates) == (4, 0, 0, 0)
+
+
+def test_sequence_counts_a_gap_as_lost():
+    tracker, gaps = track(0, 1, 4, 5)
+    assert gaps == [0, 0, 2, 0] and tracker.lost == 2
+
+
+def test_sequence_late_frame_is_reordered_not_lost():
+    tracker, gaps = track(0, 2, 1, 3)
+    assert gaps == [0, 1, -1, 0]
+    assert (tracker.lost, tracker.reordered, tracker.duplicates) == (0, 1, 0)
+
+
+def test_sequence_repeat_is_a_duplicate():
+    tracker, gaps = track(0, 1, 1, 2)
+    assert gaps == [0, 0, -1, 0]
+    assert (tracker.lost, tracker.reordered, tracker.duplicates) == (0, 0, 1)
+
+
+def test_sequence_survives_wraparound():
+    tracker, gaps = track(2 ** 32 - 2, 2 ** 32 - 1, 0, 1)
+    assert gaps == [0, 0, 0, 0] and tracker.lost == 0
+
+
+def test_red_block_round_trip():
+    sent = frame(3, redundant=b"\x05\x00" * 2)
+    body = pack_media(sent)
+    assert body[1] & FLAG_RED
+    got = unpack_media(body)
+    assert got.payload == sent.payload and got.redundant == sent.redundant
+
+
+def test_strip_redundancy_leaves_the_primary_frame():
+    with_red = pack_media(frame(3, redundant=b"\x05\x00" * 2))
+    stripped = strip_redundancy(with_red)
+    assert stripped == pack_media(frame(3))
+    assert strip_redundancy(stripped) == stripped
+    got = unpack_media(stripped)
+    assert got.seq == 3 and got.redundant is None
+
+
+def test_recover_exactly_one_lost_frame_from_red():
+    nframes = 8
+    redundant = b"\x05\x00" * (nframes // RED_DECIMATION)
+    late = unpack_media(pack_media(frame(5, redundant=redundant)))
+    rebuilt = recover_lost_frame(late, 1, nframes)
+    assert len(rebuilt) == nframes * 2
+    assert recover_lost_frame(late, 2, nframes) is None
+    assert recover_lost_frame(unpack_media(pack_media(frame(5))), 1, nframes) is None
@@ -0,0 +1,84 @@
+from voiceChatProtocol import (AUDIO, COMMAND, MEDIA, ClientStreamReader, LineReader, encode_audio, encode_line,
+                               encode_media)
+
+
+class Segments:
+    """ A socket whose recv() returns the given TCP segments one by one, then EOF. """
+
+    def __init__(self, *segments):
+        self.segments = list(segments)
+
+    def recv(self, bufsize):
+        return self.segments.pop(0) if self.segments else b""
+
+
+def messages(*segments):
+    reader = ClientStreamReader(Segments(*segments))
+    out = []
+    while True:
+        kind, data = reader.read_message()
+        if kind is None:
+            return out
+        out.append((kind, data))
+
+
+def test_line_reader_splits_coalesced_lines():
+    reader = LineReader(Segments(b"NEW:a\nREQ:ROOM_LIST\nBY", b"E\n"))
+    assert reader.read_line() == "NEW:a"
+    assert reader.read_line() == "REQ:ROOM_LIST"
+    assert reader.read_line() == "BYE"
+    assert reader.read_line() is None
+
+
+def test_line_reader_waits_for_the_rest_of_a_split_line_once_framed():
+    reader = LineReader(Segments(b"REQ:ROOM_LIST\n", b"SWITCH:ro", b"om\n"))
+    assert reader.read_line() == "REQ:ROOM_LIST"
+    assert reader.read_line() == "SWITCH:room"
+
+
+def test_line_reader_tagged_request_is_framed_from_the_start():
+    reader = LineReader(Segments(b"RQ:1:NEW:ro", b"om\n"))
+    assert reader.read_line() == "RQ:1:NEW:room"
+
+
+def test_line_reader_legacy_packet_is_one_command():
+    reader = LineReader(Segments(b"NEW:room", b"REQ:ROOM_LIST"))
+    assert reader.read_line() == "NEW:room"
+    assert reader.read_line() == "REQ:ROOM_LIST"
+
+
+def test_stream_reader_split_command_after_framing():
+    assert messages(encode_line("PONG:1"), b"SWITCH:ro", b"om\n", b"PONG:17", b"29\n") == [
+        (COMMAND, "PONG:1"), (COMMAND, "SWITCH:room"), (COMMAND, "PONG:1729")]
+
+
+def test_stream_reader_split_command_after_media():
+    body = bytes(range(40))
+    assert messages(encode_media(body), b"SWITCH:ro", b"om\n") == [(MEDIA, body), (COMMAND, "SWITCH:room")]
+
+
+def test_stream_reader_frames_split_anywhere():
+    body = bytes(range(256)) * 4
+    stream = encode_audio(body) + encode_media(body[:100]) + encode_line("LEAVE")
+    for cut in (1, 3, 7, 100, 1030, len(stream) - 2):
+        assert messages(stream[:cut], stream[cut:]) == [(AUDIO, body), (MEDIA, body[:100]), (COMMAND, "LEAVE")]
+
+
+def test_stream_reader_coalesced_frames_and_commands():
+    stream = encode_line("CAPS:fec=red") + encode_media(b"\x01\x02") + encode_line("RQ:4:LEAVE") + encode_audio(b"xy")
+    assert messages(stream) == [(COMMAND, "CAPS:fec=red"), (MEDIA, b"\x01\x02"), (COMMAND, "RQ:4:LEAVE"),
+                                (AUDIO, b"xy")]
+
+
+def test_stream_reader_legacy_bare_pcm_and_commands():
+    pcm = bytes([0xff, 0xfe]) * 600
+    assert messages(b"LEAVE", pcm) == [(COMMAND, "LEAVE"), (AUDIO, pcm)]
+
+
+def test_lobby_skips_audio_after_a_failed_resume():
+    body = b"\nNEW:x\n" + bytes(range(50))
+    reader = ClientStreamReader(Segments(encode_line("RESUME:tok"), encode_media(body)[:9],
+                                         encode_media(body)[9:] + encode_audio(b"ab"), encode_line("RQ:2:NEW:room")))
+    assert reader.read_command() == "RESUME:tok"
+    assert reader.read_command() == "RQ:2:NEW:room"
+    assert reader.read_command() is None
@@ -0,0 +1,17 @@
+from voiceChatRecorder import safe_name
+
+
+def test_safe_name_keeps_plain_names():
+    assert safe_name("room-1") == "room-1"
+    assert safe_name("a_b") == "a_b"
+
+
+def test_safe_name_changed_names_do_not_collide():
+    names = {safe_name(name) for name in ("a b", "a/b", "a_b", "a\\b")}
+    assert len(names) == 4
+
+
+def test_safe_name_stays_in_the_directory():
+    for name in ("..", "../x", "/etc/passwd", ""):
+        safe = safe_name(name)
+        assert "/" not in safe and not safe.startswith(".")
@@ -0,0 +1,146 @@
+import pytest
+
+from voiceChatRooms import Member, RoomFull, RoomRegistry
+
+
+def member(rooms):
+    return Member(object(), rooms.allocate_id())
+
+
+def test_join_existing_room_only_unless_create():
+    rooms = RoomRegistry()
+    a = member(rooms)
+    assert not rooms.join(a, "r")
+    assert "r" not in rooms
+    assert rooms.join(a, "r", create=True)
+    assert a.room == "r" and rooms.members("r") == (a,)
+
+
+def test_join_refuses_a_full_room():
+    rooms = RoomRegistry()
+    a, b, c = member(rooms), member(rooms), member(rooms)
+    rooms.join(a, "r", create=True, max_members=2)
+    rooms.join(b, "r", max_members=2)
+    with pytest.raises(RoomFull):
+        rooms.join(c, "r", max_members=2)
+    assert c.room is None and len(rooms.members("r")) == 2
+
+
+def test_last_leave_closes_the_room():
+    rooms = RoomRegistry()
+    a, b = member(rooms), member(rooms)
+    rooms.join(a, "r", create=True)
+    rooms.join(b, "r")
+    rooms.leave(a)
+    assert a.room is None and rooms.members("r") == (b,)
+    rooms.leave(a)  # a second leave is harmless
+    rooms.leave(b)
+    assert "r" not in rooms and len(rooms) == 0
+    assert rooms.members("r") == ()
+
+
+def test_members_snapshot_is_rebuilt_after_a_change():
+    rooms = RoomRegistry()
+    a, b = member(rooms), member(rooms)
+    rooms.join(a, "r", create=True)
+    snapshot = rooms.members("r")
+    assert rooms.members("r") is snapshot
+    rooms.join(b, "r")
+    assert snapshot == (a,)
+    assert set(rooms.members("r")) == {a, b}
+
+
+def test_ids_are_never_reused():
+    rooms = RoomRegistry()
+    a = member(rooms)
+    rooms.join(a, "r", create=True)
+    rooms.leave(a)
+    assert member(rooms).client_id == a.client_id + 1
+
+
+def test_move_hops_rooms_and_closes_the_empty_one():
+    rooms = RoomRegistry()
+    a, b = member(rooms), member(rooms)
+    rooms.join(a, "r1", create=True)
+    rooms.join(b, "r2", create=True)
+    assert rooms.move(a, "r2")
+    assert a.room == "r2" and set(rooms.members("r2")) == {a, b}
+    assert "r1" not in rooms
+    assert rooms.move(a, "r2")  # already there
+
+
+def test_move_to_a_missing_or_full_room_keeps_the_member_in_place():
+    rooms = RoomRegistry()
+    a, b = member(rooms), member(rooms)
+    rooms.join(a, "r1", create=True)
+    rooms.join(b, "r2", create=True)
+    assert not rooms.move(a, "nowhere")
+    with pytest.raises(RoomFull):
+        rooms.move(a, "r2", max_members=1)
+    assert a.room == "r1" and rooms.members("r1") == (a,)
+    assert rooms.move(a, "new", create=True) and a.room == "new"
+
+
+def test_detached_member_keeps_its_seat_and_resumes():
+    rooms = RoomRegistry()
+    a = member(rooms)
+    rooms.join(a, "r", create=True)
+    token = rooms.issue_token(a)
+    old_conn, new_conn = a.conn, object()
+    assert rooms.detach(a, old_conn)
+    assert a.conn is None and rooms.members("r") == (a,)
+    assert not rooms.detach(a, old_conn)
+    assert rooms.resume(token, new_conn) == (a, None)
+    assert a.conn is new_conn and a.detached_at is None
+    assert rooms.resume("bogus", object()) == (None, None)
+
+
+def test_resume_takes_over_a_connection_not_yet_seen_dead():
+    rooms = RoomRegistry()
+    a = member(rooms)
+    rooms.join(a, "r", create=True)
+    token = rooms.issue_token(a)
+    stale, fresh = a.conn, object()
+    assert rooms.resume(token, fresh) == (a, stale)
+    assert not rooms.detach(a, stale)  # the old reader's hang-up comes too late
+
+
+def test_expire_detached_ends_only_sessions_past_the_grace():
+    rooms = RoomRegistry()
+    gone, waiting, attached = member(rooms), member(rooms), member(rooms)
+    for m in (gone, waiting, attached):
+        rooms.join(m, "r", create=True)
+        rooms.issue_token(m)
+    rooms.detach(gone, gone.conn)
+    rooms.detach(waiting, waiting.conn)
+    gone.detached_at -= 100
+    assert rooms.expire_detached(30) == [(gone, "r")]
+    assert set(rooms.members("r")) == {waiting, attached}
+    assert rooms.resume(gone.token, object()) == (None, None)
+
+
+def test_end_session_invalidates_the_token():
+    rooms = RoomRegistry()
+    a = member(rooms)
+    rooms.join(a, "r", create=True)
+    token = rooms.issue_token(a)
+    rooms.end_session(a)
+    assert "r" not in rooms and rooms.resume(token, object()) == (None, None)
+
+
+def test_adopt_takes_over_a_handed_off_session():
+    rooms = RoomRegistry()
+    old = Member(None, 41, room="r")
+    old.token, old.detached_at = "tok", 0.0
+    assert rooms.adopt(old)
+    assert rooms.members("r") == (old,)
+    assert not rooms.adopt(old)  # same token twice
+    assert rooms.allocate_id() == 42
+    assert rooms.resume("tok", object())[0] is old
+
+
+def test_reserve_ids_skips_the_old_process_ids():
+    rooms = RoomRegistry()
+    rooms.reserve_ids(100)
+    rooms.reserve_ids(50)
+    assert rooms.next_id() == 100 and rooms.allocate_id() == 100
@@ -0,0 +1,131 @@
+"""
+TLS overhead benchmark: the server's CPU per forwarded frame with and
+without TLS (voiceChatTls), and per handshake, full and resumed.
+
+    python tlsOverheadBench.py
+    python tlsOverheadBench.py --clients 300 --speakers 3 --seconds 30 --budget 0.3
+
+Runs the same soak (soakClient) twice against a local newServer.py, plain
+and then with a fresh self-signed certificate, and charges each run the
+server process's own CPU time (its rusage once it has exited), so the
+soak clients' encryption does not count. Capacity loss is 1 - plain/TLS
+frames delivered per server CPU second; it must stay within --budget or
+the exit status is 1.
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import soakClient
+from voiceChatTls import TlsClient, make_self_signed, server_context
+
+# What we accept for encryption: AES-GCM alone is ~3.5 us per 8 KB frame on a
+# core with AES-NI, against ~12 us of forwarding work per frame in plaintext.
+CAPACITY_BUDGET = 0.35
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def soak_cost(args, tls):
+    """ (server CPU seconds per frame delivered, frames delivered) for one soak run. """
+    source = soakClient.AudioSource.tone(args.rate, args.chunk, args.layers)
+    with tempfile.TemporaryDirectory() as tmp:
+        args.tls = "" if tls else None
+        args.host = None
+        server_env = soakClient.setup_tls(args, tmp)
+        args.host = "127.0.0.1"
+        before = children_cpu()
+        server_proc = soakClient.spawn_server(args.clients, args.port, server_env)
+        try:
+            stats, _ = asyncio.run(soakClient.soak(args, source))
+        finally:
+            server_proc.terminate()
+            server_proc.wait()
+        cpu = children_cpu() - before
+    if stats.failed or not stats.frames_in:
+        raise RuntimeError(f"soak failed: {stats.failed} failed, first error {stats.errors[:1]!r}")
+    return cpu / stats.frames_in, stats.frames_in
+
+
+def handshake_cost(context, client, count):
+    """ Server CPU seconds per handshake; client.session decides full or resumed. """
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(count)
+    address = listener.getsockname()
+    cpu = 0.0
+    resumed = 0
+    for _ in range(count):
+        box = {}
+
+        def dial():
+            sock = client.wrap(socket.create_connection(address))
+            sock.recv(16)  # the ticket arrives ahead of this
+            client.remember(sock)
+            box["reused"] = sock.session_reused
+            sock.close()
+
+        dialer = threading.Thread(target=dial)
+        dialer.start()
+        conn, _ = listener.accept()
+        start = time.thread_time()
+        conn = context.wrap_socket(conn, server_side=True)
+        conn.sendall(b"x")
+        cpu += time.thread_time() - start
+        dialer.join()
+        conn.close()
+        resumed += box["reused"]
+    listener.close()
+    return cpu / count, resumed
+
+
+def main():
+    ap = soakClient.parser()
+    ap.description = __doc__
+    ap.set_defaults(clients=100, seconds=15.0, ramp=2.0, report=3600.0)
+    ap.add_argument("--handshakes", type=int, default=50)
+    ap.add_argument("--budget", type=float, default=CAPACITY_BUDGET, help="largest acceptable capacity loss")
+    args = ap.parse_args()
+    if resource is None:
+        sys.exit("needs the resource module (Unix) to read the server's CPU time")
+    soakClient.raise_fd_limit(args.clients + 64)
+
+    plain, plain_frames = soak_cost(args, tls=False)
+    tls, tls_frames = soak_cost(args, tls=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        certfile, keyfile = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        make_self_signed(certfile, keyfile)
+        context = server_context(certfile, keyfile)
+        full, _ = handshake_cost(context, TlsClient("127.0.0.1", certfile), args.handshakes)
+        client = TlsClient("127.0.0.1", certfile)
+        handshake_cost(context, client, 1)  # gets the session to resume
+        resumed_cost, resumed = handshake_cost(context, client, args.handshakes)
+
+    loss = 1.0 - plain / tls
+    print(f"soak:       {args.clients} clients, {args.speakers} speaking per room, {args.seconds:.0f} s")
+    print(f"plain:      {plain * 1e6:.1f} us server CPU per frame delivered ({plain_frames} frames)")
+    print(f"TLS:        {tls * 1e6:.1f} us server CPU per frame delivered ({tls_frames} frames), "
+          f"+{(tls / plain - 1) * 100:.0f}%")
+    print(f"capacity:   -{loss * 100:.0f}% (budget -{args.budget * 100:.0f}%)")
+    print(f"handshake:  full {full * 1e3:.2f} ms, resumed {resumed_cost * 1e3:.2f} ms server CPU "
+          f"({resumed}/{args.handshakes} resumed)")
+    if loss > args.budget:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
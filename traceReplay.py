@@ -0,0 +1,182 @@
+"""
+Replay a traffic trace (newServer.py run with VOICECHAT_TRACE_DIR) against a
+server with the recorded timing: every traced client becomes a connection
+that joins, switches, leaves and sends its frames when it did in production.
+
+    python traceReplay.py traces/trace-*.vct                 # spawns a local newServer.py, 1x
+    python traceReplay.py --speed 4 traces/trace-*.vct       # four times faster
+    python traceReplay.py --host 1.2.3.4 traces/trace-*.vct  # against a running server
+
+Frames traced without payload are replayed as silence of the same size.
+Listen-only clients rejoin with LISTEN: and every client repeats the CAPS
+the server accepted from it, so RED and simulcast are forwarded as traced.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from joinStormBench import percentile, raise_fd_limit
+from voiceChatProtocol import encode_audio, encode_line, encode_media
+from voiceChatTrace import T_AUDIO, T_CAPS, T_GONE, T_JOIN, T_LEAVE, T_LISTEN, T_MEDIA, read_trace
+
+
+class VirtualClient:
+    """ One traced client id: a connection, its room, and a task draining what the server sends. """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.room = None
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.drain_task = asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    return
+                if line.startswith((b"DATA:", b"MEDIA:")):
+                    length = int(line.rsplit(b":", 1)[1])
+                    await self.reader.readexactly(length)
+                    self.frames_in += 1
+                    self.bytes_in += length
+                elif line.startswith(b"PING:"):
+                    # answer, or the server evicts replayed listeners that never speak
+                    self.writer.write(b"PONG:" + line[5:])
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            return
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        records.extend(read_trace(path))
+    records.sort(key=lambda r: r[1])
+    return records
+
+
+async def replay(host, port, records, speed, timeout):
+    clients = {}
+    gone = []
+    lags = []
+    errors = 0
+    sent = 0
+    loop = asyncio.get_running_loop()
+    t_first = records[0][1]
+    start = loop.time()
+
+    async def client_for(client_id, room, listen=False):
+        client = clients.get(client_id)
+        if client is None:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            client = clients[client_id] = VirtualClient(reader, writer)
+            # a listener joins a room some speaker has created before it, as traced
+            client.send(encode_line(f"LISTEN:{room}" if listen else f"NEW:{room}"))
+            client.room = room
+        elif room is not None and client.room != room:
+            client.send(encode_line(f"SWITCH:{room}"))
+            client.room = room
+        return client
+
+    for record_type, t, room, client_id, size, payload in records:
+        due = start + (t - t_first) / speed
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lags.append(max(0.0, loop.time() - due))
+        try:
+            if record_type == T_GONE:
+                client = clients.pop(client_id, None)
+                if client is not None:
+                    client.send(encode_line("BYE"))
+                    client.close()
+                    gone.append(client)
+            elif record_type == T_LEAVE:
+                client = clients.get(client_id)
+                if client is not None:
+                    client.send(encode_line("LEAVE"))
+                    client.room = None
+            elif record_type in (T_JOIN, T_LISTEN):
+                await client_for(client_id, room, listen=record_type == T_LISTEN)
+            elif record_type == T_CAPS:
+                client = clients.get(client_id) if room is None else await client_for(client_id, room)
+                if client is not None:
+                    client.send(encode_line("CAPS:" + (payload or b"").decode('utf-8', errors='replace')))
+            elif record_type in (T_AUDIO, T_MEDIA) and room is not None:
+                client = await client_for(client_id, room)
+                body = (payload or b"").ljust(size, b"\x00")
+                client.send(encode_media(body) if record_type == T_MEDIA else encode_audio(body))
+                sent += 1
+        except (OSError, asyncio.TimeoutError):
+            errors += 1
+
+    total = loop.time() - start
+    await asyncio.sleep(0.5)  # let the last frames come back
+    everyone = list(clients.values()) + gone
+    frames_in = sum(c.frames_in for c in everyone)
+    bytes_in = sum(c.bytes_in for c in everyone)
+    for client in clients.values():
+        client.send(encode_line("BYE"))
+        client.close()
+    for client in everyone:
+        client.drain_task.cancel()
+    return total, sorted(lags), sent, frames_in, bytes_in, len(everyone), errors
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("traces", nargs="+", help="trace files (trace-*.vct)")
+    ap.add_argument("--host", default=None, help="server to drive (default: spawn newServer.py locally)")
+    ap.add_argument("--port", type=int, default=5000)
+    ap.add_argument("--speed", type=float, default=1.0, help="replay speed factor (2 = twice as fast)")
+    ap.add_argument("--timeout", type=float, default=10.0)
+    args = ap.parse_args()
+
+    records = load_records(args.traces)
+    if not records:
+        print("no records in trace")
+        return
+    client_ids = {r[3] for r in records}
+    raise_fd_limit(len(client_ids) + 64)
+
+    server_proc = None
+    host = args.host
+    if host is None:
+        host = "127.0.0.1"
+        env = dict(os.environ, VOICECHAT_PORT=str(args.port),
+                   VOICECHAT_LISTEN_BACKLOG=str(max(len(client_ids), 128)))
+        env.pop("VOICECHAT_TRACE_DIR", None)  # do not trace the replay itself
+        server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "newServer.py")
+        server_proc = subprocess.Popen([sys.executable, server_script], env=env, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+
+    try:
+        total, lags, sent, frames_in, bytes_in, clients, errors = asyncio.run(
+            replay(host, args.port, records, args.speed, args.timeout))
+    finally:
+        if server_proc is not None:
+            server_proc.terminate()
+            server_proc.wait()
+
+    traced = records[-1][1] - records[0][1]
+    print(f"records:   {len(records)}  clients: {clients}  errors: {errors}")
+    print(f"traced:    {traced:.1f} s  replayed: {total:.1f} s at {args.speed:g}x")
+    print(f"sent:      {sent} frames  received: {frames_in} frames, {bytes_in / 1e6:.1f} MB")
+    print(f"lag p50:   {percentile(lags, 50) * 1000:.1f} ms")
+    print(f"lag p99:   {percentile(lags, 99) * 1000:.1f} ms")
+    print(f"lag max:   {percentile(lags, 100) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
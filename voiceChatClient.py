@@ -1,230 +1,126 @@
-import socket
-import threading
-import pyaudio
 import sys
-from collections import deque
-import time
-
-host = "16.170.201.66"
-port = 5000
-
-Format = pyaudio.paInt16
-Chunks = 4096
-Channels = 1
-Rate = 44100
-
-output_streams = {}   # user_id -> (pyaudio_instance, output_stream)
-my_client_id = None
-stop_audio_threads = False
-
-# Jitter buffers: user_id -> deque of audio chunks
-jitter_buffers = {}
-# Playback threads: user_id -> thread
-playback_threads = {}
-
-# Jitter Buffer Configuration
-BUFFER_FILL_THRESHOLD = 2  # Start with fewer chunks to reduce initial delay
-# We will no longer strictly sleep TIME_PER_CHUNK each iteration, we'll just try to play continuously.
-
-import socket
-
-def connect_to_server():
-    try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((host, port))  # Replace with actual IP and Port
-        welcome_message = client.recv(4096).decode('utf-8')
-        return client, welcome_message
-    except Exception as e:
-        print(f"Failed to connect to server: {e}")
-        return None, None
+import threading
 
+import voiceChatEngine as engine_defaults
+from voiceChatConfig import CLIENT_ENV_PREFIX, Config, at_least, between, multiple_of
+from voiceChatEngine import EngineEvents, VoiceChatEngine
+from voiceChatMedia import LAYER_DECIMATION, RED_DECIMATION
+from voiceChatProtocol import MAX_LAYERS
+from voiceChatTls import TlsClient
 
-def choose_room(client):
-    while True:
-        choice = input("Type an existing room name to join, 'NEW:<RoomName>' to create a new room, or 'q' to quit: ").strip()
-        if choice.lower() == 'q':
-            client.close()
-            sys.exit(0)
-        client.send(choice.encode('utf-8'))
-        response = client.recv(4096).decode('utf-8')
-        print(response)
-        if "Joined room:" in response:
-            return True
-        elif "Disconnecting" in response:
-            client.close()
-            return False
 
-def ensure_output_stream(user_id):
-    """Create output stream and jitter buffer for a user if not already existing."""
-    if user_id not in output_streams:
-        p = pyaudio.PyAudio()
-        out_stream = p.open(format=Format,
-                            channels=Channels,
-                            rate=Rate,
-                            output=True,
-                            frames_per_buffer=Chunks)
-        output_streams[user_id] = (p, out_stream)
-    if user_id not in jitter_buffers:
-        jitter_buffers[user_id] = deque()
-    if user_id not in playback_threads:
-        # Start a playback thread for this user
-        t = threading.Thread(target=playback_thread_func, args=(user_id,))
-        t.daemon = True
-        t.start()
-        playback_threads[user_id] = t
-
-def playback_thread_func(user_id):
+class ClientSettings:
     """
-    Playback thread:
-    Wait until jitter buffer has at least a few chunks, then play chunks as they come.
-    If buffer empties, play silence briefly until new data arrives, but do not force long waits.
+    Where to connect and how to run the engine, shared by the CLI and the GUIs:
+    --<name> flags (given argv), VOICECHAT_CLIENT_<NAME> variables or the
+    [client] section of a config file (voiceChatConfig), over these defaults.
     """
-    _, out_stream = output_streams[user_id]
-    buffer = jitter_buffers[user_id]
-
-    # Wait for buffer to fill a bit to avoid immediate stutter
-    while not stop_audio_threads and len(buffer) < BUFFER_FILL_THRESHOLD:
-        time.sleep(0.01)
-
-    # Now play continuously
-    while not stop_audio_threads:
-        if len(buffer) > 0:
-            chunk = buffer.popleft()
-            out_stream.write(chunk)
-        else:
-            # Buffer empty, play a short silence or just wait a bit
-            # Play a very small silence just to avoid a big crackle:
-            silence = b'\x00' * (Chunks * 2)
-            out_stream.write(silence)
-            # Sleep a bit to wait for next data
-            time.sleep(0.01)
-
-def play_audio_data_for_user(user_id, audio_data):
+
+    def __init__(self, argv=None):
+        config = Config("client", argv, env_prefix=CLIENT_ENV_PREFIX)
+        self.host = config.get("host", "16.170.201.66")
+        self.port = config.get("port", 5000, check=between(1, 65535))
+        # TLS to a server started with VOICECHAT_TLS_CERT; tls_ca is that certificate
+        # if it is self-signed, empty to trust the system's CAs.
+        self.use_tls = config.get("tls", False)
+        self.tls_ca = config.get("tls_ca", "") or None
+        # Audio and buffering: a smaller chunk (frames per capture) cuts delay and
+        # costs more packets; prefill is chunks queued before a speaker plays.
+        self.engine_options = dict(
+            rate=config.get("rate", engine_defaults.Rate, check=between(8000, 48000)),
+            chunk=config.get("chunk", engine_defaults.Chunks,
+                             check=multiple_of(RED_DECIMATION * max(LAYER_DECIMATION))),
+            prefill=config.get("prefill", engine_defaults.BUFFER_FILL_THRESHOLD, check=at_least(1)),
+            inbox=config.get("inbox", engine_defaults.AUDIO_INBOX_MAX, check=at_least(8)),
+            fec=config.get("fec", engine_defaults.FEC_ENABLED),
+            layers=config.get("layers", engine_defaults.SIMULCAST_LAYERS, check=between(1, MAX_LAYERS)),
+            dsp=config.get("dsp", engine_defaults.DSP_ENABLED),
+            e2e=config.get("e2e", engine_defaults.E2E_ENABLED))
+        config.require(self.tls_ca is None or self.use_tls, "tls_ca without tls")
+        config.done()
+
+    def make_tls(self):
+        """ One per run, shared by its engines, so a new connection resumes TLS. """
+        return TlsClient(self.host, self.tls_ca) if self.use_tls else None
+
+    def make_engine(self, events, tls=None):
+        return VoiceChatEngine(self.host, self.port, events=events, tls=tls, **self.engine_options)
+
+
+class ConsoleEvents(EngineEvents):
+    """ Prints what the server says; the mic starts once we are in a room. """
+
+    def __init__(self):
+        self.engine = None
+        self.gone = threading.Event()
+
+    def message(self, text):
+        print(f"Control Message: {text}")
+
+    def room_list(self, rooms_text):
+        print("Available rooms:\n" + rooms_text)
+
+    def joined(self, room):
+        # on the audio worker: opening the mic here would stall the socket reader
+        def done(f):
+            if f.exception() is not None:
+                print(f"Could not open the mic: {f.exception()}")
+        if not self.engine.audio_started:
+            self.engine.start_audio_async().add_done_callback(done)  # listeners: playback only
+
+    def disconnected(self):
+        print("Stopping message parsing thread.")
+        self.gone.set()
+
+
+def run_session(engine, events):
     """
-    Push audio_data into the user's jitter buffer.
-    The playback thread plays as soon as data arrives, trying to be continuous.
+    One connection: lobby commands until we join a room ("LISTEN:<room>" to
+    join listen-only, without opening the mic), then "stats", "SWITCH:<room>"
+    etc. until "leave" (hang up) or "q" (quit).
+    Returns False when the user wants to quit.
     """
-    ensure_output_stream(user_id)
-    jitter_buffers[user_id].append(audio_data)
-
-def parse_server_messages(client):
-    global stop_audio_threads, my_client_id
-
-    if client is None:
-        print("Error: Client socket is None. Cannot start message parsing.")
-        return
-
-    try:
-        f = client.makefile('rb')  # Ensure this doesn't fail silently
-    except AttributeError:
-        print("Error: Client socket is invalid. Cannot create file object.")
-        return
-    except Exception as e:
-        print(f"Unexpected error creating file object: {e}")
-        return
-
-    while not stop_audio_threads:
+    print("Type an existing room name to join, 'NEW:<RoomName>' to create a new room, "
+          "'LISTEN:<RoomName>' to only listen, or 'q' to quit.")
+    while not events.gone.is_set():
+        command = sys.stdin.readline()
+        if not command:
+            return False
+        command = command.strip()
+        if command.lower() == 'q':
+            return False
+        if command.lower() == "leave":
+            return True
+        if command.lower() == "stats":
+            for line in engine.stats_lines():
+                print(line)
+            continue
+        if command.startswith("LISTEN:"):
+            engine.listen(command[len("LISTEN:"):].strip())
+            continue
         try:
-            header_line = f.readline()
-            if not header_line:
-                print("Connection closed by server.")
-                break
-
-            header_line = header_line.strip()
-            if header_line.startswith(b"DATA:"):
-                # Format: DATA:<sender_id>:<length>
-                parts = header_line.decode('utf-8').split(':')
-                if len(parts) == 3:
-                    _, sender_id_str, length_str = parts
-                    sender_id = int(sender_id_str)
-                    length = int(length_str)
-                    audio_data = f.read(length)
-                    if not audio_data or len(audio_data) < length:
-                        print("Incomplete audio data received.")
-                        break
-                    play_audio_data_for_user(sender_id, audio_data)
-
-            elif header_line.startswith(b"ID:"):
-                line_str = header_line.decode('utf-8')
-                my_client_id = int(line_str.split("ID:")[-1])
-                print(f"Assigned Client ID: {my_client_id}")
-
-            else:
-                # Control message
-                line_str = header_line.decode('utf-8')
-                if line_str:
-                    print(f"Control Message: {line_str}")
-
-        except Exception as e:
-            print("Error receiving server messages:", e)
-            break
+            engine.send_command(command)
+        except OSError as e:
+            print(f"Send failed: {e}")
+    return True
 
-    print("Stopping message parsing thread.")
 
-def audio_sender(client, input_stream):
-    global stop_audio_threads
-    while not stop_audio_threads:
+def main():
+    settings = ClientSettings(sys.argv[1:])
+    tls = settings.make_tls()
+    while True:
+        events = ConsoleEvents()
+        engine = events.engine = settings.make_engine(events, tls)
         try:
-            data = input_stream.read(Chunks, exception_on_overflow=False)
-            if data:
-                client.send(data)
-        except:
-            break
-
-def user_input_thread(client):
-    global stop_audio_threads
-    while not stop_audio_threads:
-        command = sys.stdin.readline().strip().lower()
-        if command == "leave":
+            print(engine.connect())
+        except OSError as e:
+            print(f"Failed to connect to server: {e}")
+            return
+        keep_going = run_session(engine, events)
+        engine.close()
+        if not keep_going:
             break
-    stop_audio_threads = True
-    try:
-        client.shutdown(socket.SHUT_RDWR)
-    except:
-        pass
-    client.close()
-
-def audio_streaming(client):
-    global stop_audio_threads, output_streams, jitter_buffers
-    stop_audio_threads = False
-    p = pyaudio.PyAudio()
-    input_stream = p.open(format=Format,
-                          channels=Channels,
-                          rate=Rate,
-                          input=True,
-                          frames_per_buffer=Chunks)
-
-    t_send = threading.Thread(target=audio_sender, args=(client, input_stream))
-    t_recv = threading.Thread(target=parse_server_messages, args=(client,))
-    t_input = threading.Thread(target=user_input_thread, args=(client,))
-
-    t_send.start()
-    t_recv.start()
-    t_input.start()
-
-    t_send.join()
-    t_recv.join()
-
-    # Close output streams
-    for uid, (pa, out_stream) in output_streams.items():
-        out_stream.stop_stream()
-        out_stream.close()
-        pa.terminate()
-    output_streams.clear()
-    jitter_buffers.clear()
-
-    input_stream.stop_stream()
-    input_stream.close()
-    p.terminate()
 
-def main():
-    while True:
-        client, welcome_message = connect_to_server()
-        print(welcome_message)
-        joined = choose_room(client)
-        if not joined:
-            continue
-        audio_streaming(client)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
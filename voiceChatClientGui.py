@@ -1,24 +1,27 @@
+import sys
 import tkinter as tk
-from logging import exception
 from tkinter import messagebox, ttk
-import threading
-from voiceChatClient import connect_to_server, audio_streaming, parse_server_messages
+from voiceChatClient import ClientSettings
+from voiceChatEngine import welcome_rooms
+from voiceChatTk import TkApp, TkEvents, fill_speaking_list
 
 
-class VoiceChatApp:
-    def __init__(self, root):
+class VoiceChatApp(TkApp):
+    def __init__(self, root, settings):
         self.root = root
         self.root.title("Voice Chat App")
         self.root.geometry("600x500")
-        self.voiceChatClient = None
+        self.engine = settings.make_engine(TkEvents(self), settings.make_tls())
+        self.connected = False
         self.username = None
         self.current_room = None
-        self.is_room_owner = False
 
         self.frames = {}  # Initialize the dictionary for frames
 
         self.setup_pages()
         self.show_page("FirstPage")
+        self.start_ui_queue()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def setup_pages(self):
         """Sayfaları tek seferde oluştur ve sakla."""
@@ -33,6 +36,28 @@ class VoiceChatApp:
         frame = self.frames[page_name]
         frame.tkraise()
 
+    def show_rooms(self, rooms):
+        self.frames["SecondPage"].show_rooms(rooms)
+
+    def show_speaking(self, levels):
+        fill_speaking_list(self.frames["ThirdPage"].users_listbox, self.engine, levels)
+
+    def on_joined_room(self, room_name):
+        self.current_room = room_name
+        self.when_done(self.engine.start_audio_async(), lambda _: None, "open the microphone")
+        self.frames["ThirdPage"].enter_room()
+        self.show_page("ThirdPage")
+
+    def on_left_room(self, _room=None):
+        self.current_room = None
+        self.engine.stop_audio_async()
+        self.show_page("SecondPage")
+        self.frames["SecondPage"].refresh_rooms()
+
+    def on_close(self):
+        self.engine.close()
+        self.root.destroy()
+
 class FirstPage(tk.Frame):
     def __init__(self, parent):
         super().__init__(parent.root)
@@ -57,23 +82,18 @@ class FirstPage(tk.Frame):
             return
 
         self.parent.username = username
-        try:
-            self.parent.voiceChatClient, welcome_message = connect_to_server()
-            if self.parent.voiceChatClient is None:
-                raise ConnectionError("Unable to establish a connection to the server.")
-
-            print(welcome_message)
-
-            # Start the parsing thread only if client is valid
-            threading.Thread(
-                target=parse_server_messages,
-                args=(self.parent.voiceChatClient,),
-                daemon=True
-            ).start()
-
+        self.parent.frames["SecondPage"].greeting.config(text=f"Hello, {username}")
+        if self.parent.connected:
             self.parent.show_page("SecondPage")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to connect to server: {e}")
+            return
+        # connect off the Tk thread; the page changes once the welcome is in
+        self.parent.when_done(self.parent.engine.connect_async(), self.on_connected, "connect to server")
+
+    def on_connected(self, welcome_message):
+        self.parent.connected = True
+        print(welcome_message)
+        self.parent.frames["SecondPage"].show_rooms(welcome_rooms(welcome_message))
+        self.parent.show_page("SecondPage")
 
 
 class SecondPage(tk.Frame):
@@ -92,7 +112,8 @@ class SecondPage(tk.Frame):
         self.rooms_listbox.pack(pady=5)
         tk.Button(left_frame, text="Refresh Rooms", command=self.refresh_rooms, font=("Arial", 12)).pack(pady=5)
 
-        tk.Label(right_frame, text=f"Hello, {self.parent.username}", font=("Arial", 14)).pack(pady=5)
+        self.greeting = tk.Label(right_frame, text=f"Hello, {self.parent.username}", font=("Arial", 14))
+        self.greeting.pack(pady=5)
         tk.Label(right_frame, text="Room Actions", font=("Arial", 12, "bold")).pack(pady=5)
 
         self.room_name_entry = tk.Entry(right_frame, font=("Arial", 12), width=30)
@@ -102,6 +123,8 @@ class SecondPage(tk.Frame):
                   fg="white").pack(pady=5)
         tk.Button(right_frame, text="Attend Room", command=self.attend_room, font=("Arial", 12), bg="#FF9800",
                   fg="white").pack(pady=5)
+        tk.Button(right_frame, text="Listen Only", command=self.listen_room, font=("Arial", 12), bg="#607D8B",
+                  fg="white").pack(pady=5)
         tk.Button(right_frame, text="Back", command=lambda: self.parent.show_page("FirstPage"), font=("Arial", 12),
                   bg="#F44336", fg="white").pack(pady=20)
 
@@ -110,66 +133,49 @@ class SecondPage(tk.Frame):
         if not room_name:
             messagebox.showerror("Error", "Room name cannot be empty!")
             return
-
-        try:
-            if self.parent.voiceChatClient is None:
-                raise ConnectionError("Not connected to the server. Please reconnect.")
-
-            self.parent.voiceChatClient.send(f"NEW:{room_name}".encode('utf-8'))
-            response = self.parent.voiceChatClient.recv(4096).decode('utf-8')
-            if "Joined room:" in response:
-                self.parent.current_room = room_name
-                self.parent.is_room_owner = True
-                self.parent.show_page("ThirdPage")
-            else:
-                messagebox.showerror("Error", response)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to create room: {e}")
+        self.join(room_name, create=True)
 
     def attend_room(self):
         room_name = self.room_name_entry.get()
         if not room_name:
             messagebox.showerror("Error", "Please enter a room name to attend!")
             return
+        self.join(room_name, create=False)
 
-        try:
-            if self.parent.voiceChatClient is None:
-                raise ConnectionError("Not connected to the server. Please reconnect.")
-
-            self.parent.voiceChatClient.send(room_name.encode('utf-8'))
-            response = self.parent.voiceChatClient.recv(4096).decode('utf-8')
-            if "Joined room:" in response:
-                self.parent.current_room = room_name
-                self.parent.is_room_owner = False
-                self.parent.show_page("ThirdPage")
-            else:
-                messagebox.showerror("Error", response)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to attend room: {e}")
-
-    def refresh_rooms(self):
-        try:
-            if self.parent.voiceChatClient is None:
-                print(1)
-                raise ConnectionError("Not connected to the server. Please reconnect.")
-            print(2)
-
-            self.parent.voiceChatClient.send(b"LIST")
-            print(3)
+    def listen_room(self):
+        """ Join without a mic; the choice holds for the rest of this connection. """
+        room_name = self.room_name_entry.get()
+        if not room_name:
+            messagebox.showerror("Error", "Please enter a room name to listen to!")
+            return
+        self.join(room_name, create=False, listen=True)
 
-            response = self.parent.voiceChatClient.recv(4096).decode('utf-8')
-            print(4)
+    def join(self, room_name, create, listen=False):
+        """ Returns at once; the page changes when the server confirms the join. """
+        if not self.parent.connected:
+            messagebox.showerror("Error", "Not connected to the server. Please reconnect.")
+            return
+        engine = self.parent.engine
+        if listen:
+            future, what = engine.listen(room_name), "listen to room"
+        elif create:
+            future, what = engine.join(room_name), "create room"
+        else:
+            future, what = engine.attend(room_name), "attend room"
+        self.parent.when_done(future, self.parent.on_joined_room, what)
 
-            self.rooms_listbox.delete(0, tk.END)
-            print(5)
+    def refresh_rooms(self):
+        """ The list arrives as a room_list event; only failures are handled here. """
+        if not self.parent.connected:
+            messagebox.showerror("Error", "Not connected to the server. Please reconnect.")
+            return
+        self.parent.when_done(self.parent.engine.request_room_list(), lambda _: None, "refresh rooms")
 
-            for room in response.split("\n"):
-                if room.strip():
-                    print(response[room])
-                    self.rooms_listbox.insert(tk.END, room)
-        except Exception as e:
-            print("e")
-            messagebox.showerror("Error", f"Failed to refresh rooms: {e}")
+    def show_rooms(self, rooms):
+        self.rooms_listbox.delete(0, tk.END)
+        for room in rooms:
+            if room.strip():
+                self.rooms_listbox.insert(tk.END, room)
 
 
 class ThirdPage(tk.Frame):
@@ -177,7 +183,8 @@ class ThirdPage(tk.Frame):
         super().__init__(parent.root)
         self.parent = parent
 
-        tk.Label(self, text=f"Room: {self.parent.current_room}", font=("Arial", 18, "bold")).pack(pady=10)
+        self.room_label = tk.Label(self, text=f"Room: {self.parent.current_room}", font=("Arial", 18, "bold"))
+        self.room_label.pack(pady=10)
 
         users_frame = tk.Frame(self)
         users_frame.pack(expand=True, fill="both", padx=20, pady=10)
@@ -190,51 +197,21 @@ class ThirdPage(tk.Frame):
         bottom_frame = tk.Frame(self, pady=10)
         bottom_frame.pack(fill="x")
 
+        # no Close Room: the server closes a room once its last member leaves
         tk.Button(bottom_frame, text="Leave Room", command=self.leave_room, font=("Arial", 12), bg="#FF5722",
                   fg="white").pack(side="left", padx=10)
 
-        if self.parent.is_room_owner:
-            tk.Button(bottom_frame, text="Close Room", command=self.close_room, font=("Arial", 12), bg="#D32F2F",
-                      fg="white").pack(side="right", padx=10)
-
-        threading.Thread(target=audio_streaming, args=(self.parent.voiceChatClient,), daemon=True).start()
+    def enter_room(self):
+        """ Called on every join: this page is built once and reused. """
+        self.room_label.config(text=f"Room: {self.parent.current_room}")
 
     def leave_room(self):
-        self.parent.voiceChatClient.send(b"LEAVE")
-        self.parent.show_page("SecondPage")
-
-    def close_room(self):
-        """
-        Closes the current room if the user is the room owner.
-        """
-        try:
-            print("close room pressed")
-
-            if self.is_room_owner:
-                self.voiceChatClient.send(b"CLOSE_ROOM")
-                response = self.voiceChatClient.recv(4096).decode('utf-8')
-                print(response)
-                if "Room closed" in response:
-                    messagebox.showinfo("Room Closed", "The room was successfully closed.")
-                    self.setup_second_page()
-                else:
-                    messagebox.showerror("Error", response)
-
-                print("room closed")
-
-            else:
-                messagebox.showerror("Error", "Only the room owner can close the room.")
-        except Exception as e:
-            print("exception")
-            messagebox.showerror("Error", f"Failed to close room: {e}")
-
-    def clear_frame(self):
-        for widget in self.root.winfo_children():
-            widget.destroy()
+        self.parent.when_done(self.parent.engine.leave(), self.parent.on_left_room, "leave room")
 
 
 # Start GUI
 if __name__ == "__main__":
+    settings = ClientSettings(sys.argv[1:])
     root = tk.Tk()
-    app = VoiceChatApp(root)
+    app = VoiceChatApp(root, settings)
     root.mainloop()
@@ -0,0 +1,212 @@
+"""
+Settings for the server and the clients. Each value comes from the first of:
+a command line flag, an environment variable, the config file, the default
+in the code.
+
+    python newServer.py --port 6000 --max-connections 2000
+    VOICECHAT_PORT=6000 python newServer.py
+    python newServer.py --config voicechat.ini
+    python voiceChatClient.py --host voice.example.org --tls yes
+
+A module reads its settings where its constants are, one get() per constant,
+and calls done() after the last one:
+
+    config = Config("server", sys.argv[1:] if __name__ == "__main__" else None)
+    LISTEN_BACKLOG = config.get("listen_backlog", 1024, check=at_least(1))
+    ...
+    config.done()
+
+Imported (argv None) only the environment and the file apply, so tools that
+import a module with their own flags are not affected by it.
+
+Setting listen_backlog is the flag --listen-backlog, the variable
+VOICECHAT_LISTEN_BACKLOG (client settings: VOICECHAT_CLIENT_...) and the key
+listen_backlog in the file's section for the program. The file (--config, or
+VOICECHAT_CONFIG) is INI:
+
+    [server]
+    port = 6000
+    record_rooms = standup, all-hands
+
+    [client]
+    host = voice.example.org
+    tls = yes
+
+Values are parsed as the type of the default (bool: yes/no, 1/0, true/false,
+on/off, and a bare flag means yes; list: comma separated) and checked. A bad
+value, or a flag or file key that no setting asked for (a typo would
+otherwise fall back to the default without a word), is a ConfigError naming
+where it came from; with a command line it is an error message and exit
+status 2 instead, as argparse does. done() also answers --help.
+"""
+import configparser
+import os
+import sys
+
+ENV_PREFIX = "VOICECHAT_"
+CLIENT_ENV_PREFIX = "VOICECHAT_CLIENT_"
+CONFIG_ENV = "VOICECHAT_CONFIG"
+
+_TRUE = ("1", "yes", "true", "on")
+_FALSE = ("0", "no", "false", "off")
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def at_least(low):
+    def check(value):
+        if value < low:
+            raise ValueError(f"must be at least {low}")
+    return check
+
+
+def between(low, high):
+    def check(value):
+        if not low <= value <= high:
+            raise ValueError(f"must be between {low} and {high}")
+    return check
+
+
+def multiple_of(step):
+    def check(value):
+        if value <= 0 or value % step:
+            raise ValueError(f"must be a positive multiple of {step}")
+    return check
+
+
+def one_of(*choices):
+    def check(value):
+        if value not in choices:
+            raise ValueError(f"must be one of {', '.join(map(str, choices))}")
+    return check
+
+
+def parse_value(text, default):
+    """ text as the type of default; raises ValueError. """
+    if isinstance(default, bool):
+        if text is None or text.lower() in _TRUE:
+            return True
+        if text.lower() in _FALSE:
+            return False
+        raise ValueError("expected yes or no")
+    if text is None:
+        raise ValueError("needs a value")
+    try:
+        if isinstance(default, int):
+            return int(text)
+        if isinstance(default, float):
+            return float(text)
+    except ValueError:
+        raise ValueError("expected a whole number" if isinstance(default, int) else "expected a number") from None
+    if isinstance(default, (list, tuple)):
+        return [item.strip() for item in text.split(",") if item.strip()]
+    return text
+
+
+def split_flags(argv):
+    """ ["--a", "1", "--b=2", "--c"] -> {"a": "1", "b": "2", "c": None} """
+    flags = {}
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg in ("-h", "--help"):
+            flags["help"] = None
+            continue
+        if not arg.startswith("--") or len(arg) < 3:
+            raise ConfigError(f"unexpected argument {arg!r}")
+        name, eq, value = arg[2:].partition("=")
+        if not eq:
+            value = args.pop(0) if args and not args[0].startswith("--") else None
+        flags[name] = value
+    return flags
+
+
+class Config:
+    """
+    section: the program's section in the config file ("server", "client").
+    argv: its command line arguments, or None when imported.
+    """
+
+    def __init__(self, section, argv=None, env_prefix=ENV_PREFIX, environ=None):
+        self.section = section
+        self.env_prefix = env_prefix
+        self.environ = os.environ if environ is None else environ
+        self.command_line = argv is not None
+        self.settings = []   # (name, value, source, default), in get() order
+        self.flags = {}
+        self.file_values = {}
+        try:
+            self.flags = split_flags(argv or ())
+            self.path = self.flags.pop("config", None) or self.environ.get(CONFIG_ENV, "")
+            if self.path:
+                self.file_values = self._read_file(self.path)
+        except ConfigError as e:
+            self._fail(str(e))
+
+    def _read_file(self, path):
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            with open(path, encoding="utf-8") as f:
+                parser.read_file(f)
+        except (OSError, configparser.Error) as e:
+            raise ConfigError(f"config file {path}: {e}") from None
+        return dict(parser[self.section]) if parser.has_section(self.section) else {}
+
+    def _fail(self, message):
+        if self.command_line:
+            print(f"{os.path.basename(sys.argv[0])}: error: {message}", file=sys.stderr)
+            sys.exit(2)
+        raise ConfigError(message)
+
+    def get(self, name, default, check=None):
+        """ The value of one setting, parsed as the type of default and passed to check(). """
+        flag = name.replace("_", "-")
+        env = self.env_prefix + name.upper()
+        if flag in self.flags:
+            text, source = self.flags[flag], f"--{flag}"
+        elif env in self.environ:
+            text, source = self.environ[env], env
+        elif name in self.file_values:
+            text, source = self.file_values[name], f"{self.path} [{self.section}] {name}"
+        else:
+            self.settings.append((name, default, "default", default))
+            return default
+        try:
+            value = parse_value(text, default)
+            if check is not None:
+                check(value)
+        except ValueError as e:
+            self._fail(f"{source}: {text!r}: {e}")
+        self.settings.append((name, value, source, default))
+        return value
+
+    def require(self, condition, message):
+        """ A check across settings, e.g. one timeout longer than another. """
+        if not condition:
+            self._fail(message)
+
+    def done(self):
+        """ After the last get(): refuses unknown flags and file keys, answers --help. """
+        known = {name for name, _, _, _ in self.settings}
+        if "help" in self.flags:
+            print(self.help_text())
+            sys.exit(0)
+        unknown = [f"--{flag}" for flag in self.flags if flag.replace("-", "_") not in known]
+        unknown += [f"{self.path} [{self.section}] {key}" for key in self.file_values if key not in known]
+        if unknown:
+            self._fail(f"unknown setting(s): {', '.join(unknown)}")
+        return self
+
+    def changed(self):
+        """ "name=value (source)" for every setting not at its default, for the startup log. """
+        return [f"{name}={value} ({source})" for name, value, source, _ in self.settings if source != "default"]
+
+    def help_text(self):
+        lines = [f"usage: {os.path.basename(sys.argv[0])} [--config FILE] [--<setting> VALUE ...]", "",
+                 f"settings (flag, {self.env_prefix}<NAME>, or [{self.section}] in the config file):"]
+        for name, value, _, default in self.settings:
+            shown = ",".join(default) if isinstance(default, (list, tuple)) else default
+            lines.append(f"  --{name.replace('_', '-'):<26} default {shown!s:<14} now {value}")
+        return "\n".join(lines)
@@ -0,0 +1,119 @@
+"""
+Graceful drain and zero-downtime restart for newServer.py.
+
+    kill -TERM <pid>   drain: stop accepting, let the calls finish, exit
+    kill -HUP <pid>    restart: start a successor on the same listening
+                       socket, move the clients over to it, then drain
+
+On a restart the old process stops calling accept() and starts a copy of
+itself (same command line) that inherits the listening socket
+(VOICECHAT_LISTEN_FD), so connects that arrive meanwhile wait in the
+kernel's accept queue instead of being refused. The sessions go along in
+the handoff file: every token with its client id, room and negotiated
+caps. The successor adopts them as detached sessions, so "RESUME:<token>"
+works there exactly as after a network drop: same id, same room.
+
+The old process then tells its members to move, a room at a time at a
+random point within the migrate spread, so a room moves together and the
+reconnects (and TLS handshakes) do not all land in the same second:
+
+    RECONNECT:<ms>                  same address, after <ms>
+    REDIRECT:<host>:<port>:<ms>     another server (the redirect setting)
+
+A client connects and resumes at the new address first and only then drops
+the old connection. Clients that ignore the hint are served as before until
+they leave or the drain deadline passes; then the old process rewrites the
+handoff file a last time (marked final) and hangs up, and their usual
+reconnect resumes on the successor, which re-reads the file when it sees a
+token it does not know, and once a second. It deletes the file once it has
+adopted the final one. The file lives in the temp directory by default.
+
+A plain drain (no successor, no redirect) only closes the listening socket,
+so new connects are refused at once, and waits for the calls to end. A
+second SIGTERM ends any drain at once.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+HANDOFF_VERSION = 1
+
+
+def migrate_line(redirect, delay):
+    """ The hint for one member: RECONNECT, or REDIRECT to redirect ("host:port"). """
+    ms = int(delay * 1000)
+    return f"REDIRECT:{redirect}:{ms}" if redirect else f"RECONNECT:{ms}"
+
+
+def parse_migrate(text):
+    """ "RECONNECT:<ms>" -> (None, None, seconds); "REDIRECT:<host>:<port>:<ms>" -> (host, port, seconds). """
+    if text.startswith("RECONNECT:"):
+        return None, None, int(text[10:]) / 1000.0
+    host, port, ms = text[9:].rsplit(":", 2)
+    return host, int(port), int(ms) / 1000.0
+
+
+def session_record(member):
+    return {"token": member.token, "id": member.client_id, "room": member.room,
+            "listener": member.listener, "fec": member.fec, "layers": member.layers}
+
+
+def write_handoff(path, next_id, members, final=False):
+    """
+    Write the sessions for a successor, atomically (it may be reading).
+    next_id: the first id the successor may hand out.
+    final: our last write; the successor deletes the file once it has read it.
+    """
+    data = {"version": HANDOFF_VERSION, "written": time.time(), "next_id": next_id, "final": final,
+            "sessions": [session_record(member) for member in members if member.token is not None]}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class HandoffReader:
+    """
+    Successor side: poll() returns (next_id, session records) whenever the
+    file changed, else None; final is set once the old process wrote its last.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seen = None
+        self.final = False
+
+    def poll(self):
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+        if stamp == self.seen:
+            return None
+        self.seen = stamp
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Handoff file {self.path} unreadable: {e}")
+            return None
+        if data.get("version") != HANDOFF_VERSION:
+            print(f"Handoff file {self.path} has version {data.get('version')}, ignored")
+            return None
+        self.final = bool(data.get("final"))
+        return data["next_id"], data["sessions"]
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def spawn_successor(listener, handoff_path):
+    """ This server again (same command line), on our listening socket. """
+    fd = listener.fileno()
+    env = dict(os.environ, VOICECHAT_LISTEN_FD=str(fd), VOICECHAT_HANDOFF_FILE=handoff_path)
+    return subprocess.Popen([sys.executable] + sys.argv, pass_fds=(fd,), env=env)
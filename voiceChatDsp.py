@@ -0,0 +1,343 @@
+"""
+Capture-side DSP for the clients: echo cancellation, noise suppression and
+automatic gain, run on the CapturePipeline's process thread before gain/VAD.
+
+    mic -> [AEC: subtract what our speakers played] -> [NS] -> [AGC] -> VAD / send
+
+Without AEC every client re-sends what it plays, and that echo then goes out
+to the whole room and keeps VAD from ever detecting silence.
+
+The echo reference is whatever the playback threads write to the output
+streams, mixed into EchoReference on a shared monotonic timeline. The bulk
+delay between that and the mic (device buffering on both sides) is found by
+cross-correlation; a partitioned-block frequency-domain NLMS filter then
+models the remaining echo path.
+
+NumPy is optional: without it DSP_AVAILABLE is False and the clients send the
+raw mic signal as before.
+"""
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DSP_AVAILABLE = np is not None
+
+REFERENCE_SECONDS = 2.0        # playback history kept for the AEC
+MAX_ECHO_DELAY = 0.5           # seconds of bulk delay the delay search covers
+DELAY_ESTIMATE_EVERY = 4       # frames between delay searches
+AEC_BLOCK = 512                # samples per adaptive-filter block
+AEC_PARTITIONS = 8             # filter length = AEC_BLOCK * AEC_PARTITIONS after alignment
+AEC_STEP = 0.1                 # NLMS step; much above 2 / AEC_PARTITIONS diverges
+# Geigel double-talk detector: a mic peak above this multiple of the recent
+# reference peak cannot be echo alone, so adaptation is frozen for the block.
+AEC_DOUBLE_TALK = 2.0
+NS_FFT = 512
+NS_HOP = 256
+NS_GAIN_FLOOR = 0.1            # at most -20 dB of suppression
+AGC_TARGET_RMS = 3277.0        # -20 dBFS
+AGC_MAX_GAIN = 10.0
+AGC_GATE_RMS = 100.0           # below this the frame is noise: hold the gain
+# Share of the frame duration the chain may spend; if its running average goes
+# over, the most expensive stage is switched off rather than falling behind the mic.
+DSP_BUDGET_FRACTION = 0.5
+
+
+def _to_float(pcm):
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+
+
+def _to_pcm(samples):
+    return np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+
+
+class EchoReference:
+    """
+    Ring buffer of what we played, indexed by sample position on the monotonic
+    clock. Each playback thread adds its chunks, so overlapping speakers mix.
+    """
+
+    def __init__(self, rate, seconds=REFERENCE_SECONDS):
+        self.rate = rate
+        self.size = int(rate * seconds)
+        self.ring = np.zeros(self.size, dtype=np.float32)
+        self.lock = threading.Lock()
+        self.t0 = time.monotonic()
+        self.written_until = 0  # absolute sample index; everything past it is silence
+
+    def position(self, when):
+        return int(round((when - self.t0) * self.rate))
+
+    def add(self, pcm, when=None):
+        """ Record pcm as starting to play at monotonic time when (default: now). """
+        start = self.position(time.monotonic() if when is None else when)
+        samples = _to_float(pcm)
+        end = start + len(samples)
+        with self.lock:
+            if end <= self.written_until - self.size:
+                return  # older than anything we keep
+            if end > self.written_until:
+                # the span between the last write and this chunk was silence
+                stale = np.arange(max(self.written_until, end - self.size), end) % self.size
+                self.ring[stale] = 0.0
+                self.written_until = end
+            keep = max(0, self.written_until - self.size - start)
+            self.ring[np.arange(start + keep, end) % self.size] += samples[keep:]
+
+    def read(self, start, n):
+        """ n samples from absolute position start; silence where we have nothing. """
+        idx = np.arange(start, start + n)
+        with self.lock:
+            out = self.ring[idx % self.size]
+            valid = (idx < self.written_until) & (idx >= self.written_until - self.size)
+        return np.where(valid, out, 0.0).astype(np.float32)
+
+
+def estimate_delay(mic, ref, max_lag):
+    """
+    Lag (samples, 0..max_lag) at which mic best matches ref, by GCC-PHAT.
+    ref holds max_lag samples of history followed by the span of mic.
+    Returns None if there is no clear peak (no echo, or double talk).
+    """
+    n = 1 << int(len(ref) + len(mic) - 1).bit_length()
+    spec = np.fft.rfft(mic, n) * np.conj(np.fft.rfft(ref, n))
+    spec /= np.abs(spec) + 1e-9
+    corr = np.fft.irfft(spec, n)
+    # mic[t] ~ ref[max_lag + t - lag]  =>  peak at index lag - max_lag (mod n)
+    lags = corr[(np.arange(max_lag + 1) - max_lag) % n]
+    best = int(np.argmax(lags))
+    if lags[best] < 4.0 * (np.mean(np.abs(lags)) + 1e-9):
+        return None
+    return best
+
+
+class EchoCanceller:
+    """ Partitioned-block frequency-domain NLMS (overlap-save, constrained gradient). """
+
+    def __init__(self, block=AEC_BLOCK, partitions=AEC_PARTITIONS, step=AEC_STEP):
+        self.block = block
+        self.step = step
+        bins = block + 1
+        self.W = np.zeros((partitions, bins), dtype=np.complex64)
+        self.X = np.zeros((partitions, bins), dtype=np.complex64)
+        self.power = np.full(bins, 1e3, dtype=np.float32)
+        self.prev_ref = np.zeros(block, dtype=np.float32)
+        self.ref_peak = np.zeros(partitions, dtype=np.float32)
+
+    def reset(self):
+        self.W[:] = 0
+        self.X[:] = 0
+
+    def process(self, mic, ref):
+        """ Both arrays a multiple of block long and aligned; returns mic minus echo. """
+        B = self.block
+        out = np.empty_like(mic)
+        for i in range(0, len(mic), B):
+            d = mic[i:i + B]
+            x = ref[i:i + B]
+            self.X = np.roll(self.X, 1, axis=0)
+            self.X[0] = np.fft.rfft(np.concatenate((self.prev_ref, x)))
+            self.prev_ref = x
+            self.ref_peak = np.roll(self.ref_peak, 1)
+            self.ref_peak[0] = np.max(np.abs(x))
+
+            y = np.fft.irfft(np.sum(self.W * self.X, axis=0))[B:]
+            e = d - y
+            d_pow = float(np.dot(d, d))
+            if float(np.dot(e, e)) > 2.0 * d_pow + 1e-3:
+                # diverged (echo path changed, bad alignment): start over
+                self.reset()
+                e = d
+            out[i:i + B] = e
+
+            ref_max = float(np.max(self.ref_peak))
+            if ref_max < 1.0 or np.max(np.abs(d)) > AEC_DOUBLE_TALK * ref_max:
+                continue  # nothing played, or near-end talking: freeze
+            X0 = self.X[0]
+            self.power = 0.9 * self.power + 0.1 * (X0.real ** 2 + X0.imag ** 2)
+            E = np.fft.rfft(np.concatenate((np.zeros(B, dtype=np.float32), e)))
+            G = np.conj(self.X) * (E * (self.step / (self.power + 1e-2)))
+            g = np.fft.irfft(G, axis=1)
+            g[:, B:] = 0.0
+            self.W += np.fft.rfft(g, axis=1).astype(np.complex64)
+        return out
+
+
+class NoiseSuppressor:
+    """
+    Wiener-style spectral gain over a sqrt-Hann STFT (50% overlap), with a
+    per-bin noise floor tracked from the quietest quarter of each chunk's
+    STFT frames (speech pauses within a chunk are enough to follow it).
+    Adds NS_FFT - NS_HOP samples of delay.
+    """
+
+    def __init__(self, nfft=NS_FFT, hop=NS_HOP):
+        self.nfft = nfft
+        self.hop = hop
+        self.window = np.sqrt(np.hanning(nfft + 1)[:nfft]).astype(np.float32)
+        self.in_tail = np.zeros(nfft - hop, dtype=np.float32)
+        self.out_tail = np.zeros(nfft - hop, dtype=np.float32)
+        self.noise = None
+        self.gain = np.ones(nfft // 2 + 1, dtype=np.float32)
+
+    def process(self, samples):
+        x = np.concatenate((self.in_tail, samples))
+        nframes = (len(x) - self.nfft) // self.hop + 1
+        frames = np.lib.stride_tricks.sliding_window_view(x, self.nfft)[::self.hop][:nframes]
+        spec = np.fft.rfft(frames * self.window, axis=1)
+        power = spec.real ** 2 + spec.imag ** 2
+
+        quiet = np.argsort(power.sum(axis=1))[:max(1, nframes // 4)]
+        floor = power[quiet].mean(axis=0)
+        if self.noise is None:
+            self.noise = floor
+        else:
+            # fall fast to a new minimum, creep up slowly so speech is not learnt as noise
+            self.noise = np.where(floor < self.noise, 0.7 * self.noise + 0.3 * floor, self.noise * 1.05)
+        gains = np.maximum(1.0 - 1.5 * self.noise / (power + 1e-9), NS_GAIN_FLOOR)
+        gains[0] = 0.5 * self.gain + 0.5 * gains[0]
+        gains[1:] = 0.5 * gains[:-1] + 0.5 * gains[1:]
+        self.gain = gains[-1]
+
+        y = np.fft.irfft(spec * gains, self.nfft, axis=1) * self.window
+        used = nframes * self.hop
+        out = np.zeros(used + self.nfft - self.hop, dtype=np.float32)
+        out[:len(self.out_tail)] += self.out_tail
+        for k in range(nframes):
+            out[k * self.hop:k * self.hop + self.nfft] += y[k]
+        self.in_tail = x[used:]
+        self.out_tail = out[used:]
+        result = out[:used]
+        if used < len(samples):
+            result = np.concatenate((np.zeros(len(samples) - used, dtype=np.float32), result))
+        return result[-len(samples):]
+
+
+class AutomaticGain:
+    """ Steer speech towards AGC_TARGET_RMS: quick to turn down, slow to turn up. """
+
+    def __init__(self, target=AGC_TARGET_RMS, max_gain=AGC_MAX_GAIN):
+        self.target = target
+        self.max_gain = max_gain
+        self.gain = 1.0
+
+    def process(self, samples):
+        rms = float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0.0
+        new_gain = self.gain
+        if rms > AGC_GATE_RMS:
+            desired = min(self.max_gain, max(1.0 / self.max_gain, self.target / rms))
+            rate = 0.5 if desired < self.gain else 0.05
+            new_gain = self.gain * (desired / self.gain) ** rate
+        ramp = np.linspace(self.gain, new_gain, len(samples), dtype=np.float32)
+        self.gain = new_gain
+        return samples * ramp
+
+
+class DspChain:
+    """
+    AEC -> NS -> AGC for one capture stream. process(pcm, start) is called by
+    CapturePipeline's process thread with the monotonic time of the chunk's
+    first sample and returns processed PCM of the same length.
+
+    Every call is timed; if the running average goes over the budget
+    (DSP_BUDGET_FRACTION of a frame) the costliest stage still on is dropped.
+    """
+
+    def __init__(self, rate, frames_per_chunk, reference=None, aec=True, ns=True, agc=True,
+                 budget_fraction=DSP_BUDGET_FRACTION, log=print):
+        if np is None:
+            raise RuntimeError("DSP needs numpy")
+        self.rate = rate
+        self.log = log
+        self.reference = reference
+        self.max_lag = int(MAX_ECHO_DELAY * rate)
+        self.delay = None
+        self.delay_votes = []
+        self.frames = 0
+        self.processed = 0
+        self.aec = EchoCanceller() if aec and reference is not None else None
+        self.ns = NoiseSuppressor() if ns else None
+        self.agc = AutomaticGain() if agc else None
+        self.budget = budget_fraction * frames_per_chunk / rate
+        self.avg_time = 0.0
+        self.worst_time = 0.0
+        self.overruns = 0
+        self.stage_time = {"aec": 0.0, "ns": 0.0, "agc": 0.0}
+        self.shed = []
+
+    def process(self, pcm, start):
+        t0 = time.perf_counter()
+        samples = _to_float(pcm)
+        if self.aec is not None:
+            samples = self._cancel_echo(samples, start)
+        t1 = time.perf_counter()
+        if self.ns is not None:
+            samples = self.ns.process(samples)
+        t2 = time.perf_counter()
+        if self.agc is not None:
+            samples = self.agc.process(samples)
+        t3 = time.perf_counter()
+        self._account(t3 - t0, {"aec": t1 - t0, "ns": t2 - t1, "agc": t3 - t2})
+        return _to_pcm(samples)
+
+    def _cancel_echo(self, mic, start):
+        n = len(mic)
+        pos = self.reference.position(start)
+        if self.frames % DELAY_ESTIMATE_EVERY == 0:
+            history = self.reference.read(pos - self.max_lag, self.max_lag + n)
+            if np.any(history):
+                lag = estimate_delay(mic, history, self.max_lag)
+                if lag is not None:
+                    self._vote_delay(lag)
+        self.frames += 1
+        if self.delay is None:
+            return mic
+        # advance the reference a little so the echo lands a few taps into the
+        # filter and a slightly long delay estimate stays causal
+        lead = AEC_BLOCK // 4
+        ref = self.reference.read(pos - self.delay + lead, n)
+        usable = n - n % AEC_BLOCK
+        out = mic.copy()
+        out[:usable] = self.aec.process(mic[:usable], ref[:usable])
+        return out
+
+    def _vote_delay(self, lag):
+        """ Take a new bulk delay only once three estimates in a row agree. """
+        self.delay_votes = (self.delay_votes + [lag])[-3:]
+        if len(self.delay_votes) == 3 and max(self.delay_votes) - min(self.delay_votes) <= AEC_BLOCK // 8:
+            new_delay = sorted(self.delay_votes)[1]
+            if self.delay is None or abs(new_delay - self.delay) > AEC_BLOCK // 8:
+                self.delay = new_delay
+                self.aec.reset()
+
+    def _account(self, elapsed, stages):
+        self.processed += 1
+        self.avg_time = elapsed if self.processed == 1 else 0.9 * self.avg_time + 0.1 * elapsed
+        self.worst_time = max(self.worst_time, elapsed)
+        for name, t in stages.items():
+            self.stage_time[name] = 0.9 * self.stage_time[name] + 0.1 * t
+        if elapsed > self.budget:
+            self.overruns += 1
+        if self.avg_time > self.budget:
+            self._shed_stage()
+
+    def _shed_stage(self):
+        candidates = [name for name in ("aec", "ns") if getattr(self, name) is not None]
+        if not candidates:
+            return
+        name = max(candidates, key=lambda s: self.stage_time[s])
+        setattr(self, name, None)
+        self.shed.append(name)
+        self.avg_time = 0.0
+        self.log(f"[DSP] over budget ({self.budget * 1000:.0f} ms/frame), disabled {name.upper()}")
+
+    def stats_text(self):
+        on = [name.upper() for name in ("aec", "ns", "agc") if getattr(self, name) is not None]
+        delay = "n/a" if self.delay is None else f"{self.delay / self.rate * 1000:.0f} ms"
+        return (f"DSP {'+'.join(on) or 'off'}: avg {self.avg_time * 1000:.1f} ms, "
+                f"max {self.worst_time * 1000:.1f} ms, budget {self.budget * 1000:.0f} ms, "
+                f"overruns {self.overruns}, echo delay {delay}"
+                + (f", shed {','.join(self.shed)}" if self.shed else ""))
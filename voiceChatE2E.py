@@ -0,0 +1,208 @@
+"""
+End-to-end media encryption: the server forwards MEDIA frames it cannot read.
+
+Each client makes an X25519 key pair per connection. After joining a room it
+sends "E2E_PUB:<key>"; the server answers "E2E_ROOM:<id>=<key>,..." with the
+other E2E members of the room and passes "E2E_PUB:<id>:<key>" on to them.
+The room's media key (AES-128-GCM) comes from one member, the distributor:
+the E2E member with the lowest client id. It wraps the key for each member
+under their X25519 shared secret and sends "E2E_KEY:<to id>:<blob>", which
+the server relays as "E2E_KEY:<from id>:<blob>".
+  - a newcomer gets the current key from the distributor
+  - when a member goes ("E2E_GONE:<id>") the distributor makes a new key for
+    everyone left, so the leaver cannot follow the room any more
+  - a distributor without a key (first in the room, or the previous one
+    left) makes one
+
+Frames keep MEDIA_HEADER in the clear, with FLAG_E2E set and the sender's
+level in the level byte, so the server still picks layers, strips RED and
+sends SPEAKING without looking at the payload. The primary payload and the
+RED copy are sealed separately as <key id:u32><nonce><ciphertext+tag>, with
+the sender id, layer, block and stamps as associated data. The last
+KEYS_KEPT keys are kept, so frames sealed just before a rekey still open.
+
+The server never sees a media key, but it could hand out public keys of its
+own (a man in the middle); fingerprint() gives a short code per key that
+members can compare out of band ("stats" shows them).
+
+Needs the cryptography package; without it E2E_AVAILABLE is False and the
+clients send plain MEDIA.
+"""
+import base64
+import hashlib
+import os
+import struct
+import threading
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:
+    AESGCM = None
+
+E2E_AVAILABLE = AESGCM is not None
+
+KEY_BITS = 128
+NONCE_BYTES = 12
+KEYS_KEPT = 4
+KEY_ID = struct.Struct("!I")
+# sender id, layer, block (0 payload, 1 RED copy), seq, sample_ts, capture_time, send_time
+FRAME_AAD = struct.Struct("!IBBIQdd")
+WRAP_INFO = b"voicechat e2e key wrap"
+
+
+def fingerprint(public):
+    """ Short code for a public key, for members to compare out of band. """
+    digest = hashlib.sha256(public).hexdigest()[:16]
+    return " ".join(digest[i:i + 4] for i in range(0, 16, 4))
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+class RoomKeys:
+    """
+    One client's E2E state for the room it is in. The reader thread feeds it
+    the server's E2E lines (the on_* methods return the lines to send back),
+    the capture thread seals with it and the reader opens with it.
+    """
+
+    def __init__(self):
+        self.private = X25519PrivateKey.generate()
+        self.public = self.private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        self.lock = threading.Lock()
+        self.my_id = None
+        self.wrappers = {}   # client id -> (their public key, AESGCM of our pairwise key)
+        self.undecryptable = 0
+        self.reset()
+
+    def reset(self):
+        """ Left the room (or joined another): forget its members and keys. """
+        with self.lock:
+            self.peers = {}      # client id -> public key, E2E members of the room but us
+            self.keys = {}       # key id -> AESGCM, oldest first
+            self.current = None  # (key id, AESGCM, raw key) we seal with
+            self.in_room = False
+
+    def hello(self):
+        """ The line announcing our key; sent after every join and resume. """
+        return f"E2E_PUB:{_b64(self.public)}"
+
+    def on_room(self, text):
+        """ E2E_ROOM:<id>=<key>,... : the room's other E2E members. """
+        with self.lock:
+            self.in_room = True
+            self.peers = {}
+            for item in text.split(","):
+                client_id, _, key = item.partition("=")
+                if key:
+                    self.peers[int(client_id)] = base64.b64decode(key)
+            if self._distributor() and self.current is None:
+                return self._rekey()
+            return []
+
+    def on_peer(self, client_id, key):
+        """ E2E_PUB:<id>:<key> : someone joined (or resumed); the distributor keys them. """
+        with self.lock:
+            self.peers[client_id] = base64.b64decode(key)
+            if not self.in_room or not self._distributor():
+                return []
+            if self.current is None:
+                return self._rekey()
+            key_id, _, raw = self.current
+            return [self._wrap_line(client_id, key_id, raw)]
+
+    def on_gone(self, client_id):
+        """ E2E_GONE:<id> : the distributor makes a new key for everyone left. """
+        with self.lock:
+            if self.peers.pop(client_id, None) is None or not self._distributor():
+                return []
+            return self._rekey()
+
+    def on_key(self, from_id, blob):
+        """ E2E_KEY:<id>:<blob> : a room key wrapped for us; it becomes the one we seal with. """
+        with self.lock:
+            if from_id not in self.peers:
+                return False
+            data = base64.b64decode(blob)
+            try:
+                plain = self._wrapper(from_id).decrypt(data[:NONCE_BYTES], data[NONCE_BYTES:],
+                                                       f"{from_id}>{self.my_id}".encode('ascii'))
+            except (InvalidTag, ValueError):
+                return False
+            (key_id,) = KEY_ID.unpack_from(plain)
+            self._install(key_id, plain[KEY_ID.size:])
+            return True
+
+    def _distributor(self):
+        return self.my_id is not None and all(self.my_id < client_id for client_id in self.peers)
+
+    def _rekey(self):
+        key_id = KEY_ID.unpack(os.urandom(KEY_ID.size))[0]
+        key = AESGCM.generate_key(bit_length=KEY_BITS)
+        self._install(key_id, key)
+        return [self._wrap_line(client_id, key_id, key) for client_id in self.peers]
+
+    def _install(self, key_id, key):
+        cipher = AESGCM(key)
+        self.keys.pop(key_id, None)
+        self.keys[key_id] = cipher
+        while len(self.keys) > KEYS_KEPT:
+            del self.keys[next(iter(self.keys))]
+        self.current = (key_id, cipher, key)
+
+    def _wrapper(self, client_id):
+        public = self.peers[client_id]
+        cached = self.wrappers.get(client_id)
+        if cached is None or cached[0] != public:
+            shared = self.private.exchange(X25519PublicKey.from_public_bytes(public))
+            key = HKDF(algorithm=hashes.SHA256(), length=KEY_BITS // 8, salt=None, info=WRAP_INFO).derive(shared)
+            cached = self.wrappers[client_id] = (public, AESGCM(key))
+        return cached[1]
+
+    def _wrap_line(self, client_id, key_id, key):
+        nonce = os.urandom(NONCE_BYTES)
+        sealed = self._wrapper(client_id).encrypt(nonce, KEY_ID.pack(key_id) + key,
+                                                  f"{self.my_id}>{client_id}".encode('ascii'))
+        return f"E2E_KEY:{client_id}:{_b64(nonce + sealed)}"
+
+    def seal(self, sender_id, frame, block, data):
+        """ Sealed block of frame, or None while we have no key (the frame must not go out). """
+        current = self.current
+        if current is None or sender_id is None:
+            return None
+        key_id, cipher, _ = current
+        nonce = os.urandom(NONCE_BYTES)
+        aad = FRAME_AAD.pack(sender_id, frame.layer, block, frame.seq & 0xFFFFFFFF, frame.sample_ts,
+                             frame.capture_time, frame.send_time)
+        return KEY_ID.pack(key_id) + nonce + cipher.encrypt(nonce, bytes(data), aad)
+
+    def open_frame(self, sender_id, frame):
+        """ Decrypt frame's payload and RED copy in place; False if we cannot. """
+        try:
+            frame.payload = self._open(sender_id, frame, 0, frame.payload)
+            if frame.redundant is not None:
+                frame.redundant = self._open(sender_id, frame, 1, frame.redundant)
+            return True
+        except (KeyError, InvalidTag, ValueError, struct.error):
+            self.undecryptable += 1
+            return False
+
+    def _open(self, sender_id, frame, block, sealed):
+        (key_id,) = KEY_ID.unpack_from(sealed)
+        start = KEY_ID.size + NONCE_BYTES
+        aad = FRAME_AAD.pack(sender_id, frame.layer, block, frame.seq, frame.sample_ts,
+                             frame.capture_time, frame.send_time)
+        return self.keys[key_id].decrypt(bytes(sealed[KEY_ID.size:start]), bytes(sealed[start:]), aad)
+
+    def stats_text(self):
+        with self.lock:
+            peers = ", ".join(f"{client_id}: {fingerprint(key)}" for client_id, key in sorted(self.peers.items()))
+        return (f"E2E {'on' if self.current else 'waiting for a key'}, me: {fingerprint(self.public)}"
+                + (f"; {peers}" if peers else "")
+                + (f"; {self.undecryptable} frame(s) undecryptable" if self.undecryptable else ""))
@@ -0,0 +1,945 @@
+"""
+Client engine shared by the CLI (voiceChatClient.py) and the GUIs (newClient.py,
+voiceChatClientGui.py, voiceChatGUI.py).
+
+One VoiceChatEngine is one participant. Its socket, session token, receive
+pipeline and capture pipeline all live on the instance, so several engines can
+run side by side in one process, e.g. on NullDevices for a load test:
+
+    socket reader -> audio_inbox -> demux (seq / FEC / latency) -> jitter buffer
+                  -> playback thread per speaker -> output device (+ echo reference)
+    mic -> CapturePipeline (DSP, RED, simulcast) -> send_media_body -> socket
+
+Front ends subclass EngineEvents. Its methods are called on the engine's
+threads, so a GUI must hand them over to its own thread. Opening and closing
+the audio devices takes a while (stop_audio() waits for the playback threads),
+so a GUI uses start_audio_async() / stop_audio_async(), which run them in
+order on the engine's audio worker and return a Future.
+
+Control commands (join, attend, leave, room list) go out as requests
+("RQ:<id>:<command>") and return a concurrent.futures.Future that the reader
+thread resolves when the matching "RE:<id>:..." arrives, so nothing but the
+reader ever reads the socket and no caller blocks on the network.
+
+With E2E turned on (off by default; needs the cryptography package) the
+engine announces a key on every join and seals its media with the room key
+(voiceChatE2E); the demux thread opens sealed frames and drops those it cannot.
+"""
+import itertools
+import queue
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import pyaudio
+except ImportError:  # headless use (NullDevices) needs no sound library
+    pyaudio = None
+
+from voiceChatDrain import parse_migrate
+from voiceChatDsp import DSP_AVAILABLE, DspChain, EchoReference
+from voiceChatE2E import E2E_AVAILABLE, RoomKeys
+from voiceChatMedia import (CapturePipeline, LatencyBreakdown, MediaFrame, SequenceTracker, ServerClock,
+                            full_rate_payload, recover_lost_frame, unpack_media)
+from voiceChatProtocol import (FLAG_E2E, SERVER_IDLE_TIMEOUT, encode_line, encode_media, encode_request, parse_caps,
+                               parse_response, reconnect_with_backoff)
+
+Chunks = 4096
+Channels = 1
+Rate = 44100
+
+BUFFER_FILL_THRESHOLD = 2    # chunks queued before a speaker starts playing
+
+# Ask the server for RED forward error correction: we attach a low-rate copy
+# of the previous frame and receive others' copies, so one lost frame is
+# rebuilt instead of becoming a 93 ms hole. It adds to every frame both ways,
+# so it is off by default; turn it on for lossy links with the client's fec
+# setting (--fec).
+FEC_ENABLED = False
+# Simulcast: publish our voice at full rate and, with 2 or 3, at 1/2 and 1/4
+# rate as well; the server forwards each listener the best layer its downlink
+# keeps up with. 3 layers cost ~1.75x the upload, so 1 (off) is the default;
+# set the client's layers setting (--layers 3) to publish them.
+SIMULCAST_LAYERS = 1
+# Echo cancellation / noise suppression / AGC on the mic (needs numpy).
+# Everything the playback threads write is fed to the echo reference for the AEC.
+DSP_ENABLED = True
+# End-to-end encrypt our media, so the server forwards what it cannot read
+# (needs the cryptography package). Off by default: members without it do not
+# hear us, and a server recorder cannot record us. The server tells both sides
+# when a room mixes the two. Turn on with the client's e2e setting (--e2e).
+E2E_ENABLED = False
+
+# Receive is split in two stages: the socket reader only parses frames and
+# hands audio to the inbox; the demux thread feeds the per-speaker jitter
+# buffers. Opening an output device (tens of ms) happens on the stream opener
+# thread, from a pool of pre-opened spares, so a new speaker never stalls the reader.
+AUDIO_INBOX_MAX = 256        # frames; oldest dropped if demux falls behind
+PREWARM_OUTPUT_STREAMS = 2   # spare output streams kept open and idle
+
+REQUEST_TIMEOUT = 10.0       # seconds before an unanswered request's future fails
+
+# The server repeats a talking member's SPEAKING level at least once a second
+# (voiceChatLevels.SPEAKING_REFRESH); one we have not heard about for longer
+# has stopped, even if its final level 0 got lost with a dropped connection.
+SPEAKING_STALE = 2.0
+
+
+class RequestError(Exception):
+    """ The server answered a request with ERR; the message is its reason. """
+
+
+def busy_text(line):
+    """ "SERVER_BUSY:<reason>" -> something to show the user. """
+    reason = line.strip().split("\n", 1)[0].partition(":")[2]
+    return f"Server busy ({reason}), try again later." if reason else "Server busy, try again later."
+
+
+def level_bar(level, width=10):
+    """ 0..100 -> a text meter for the GUIs' member lists. """
+    filled = (max(0, min(100, level)) * width + 50) // 100
+    return "\u2588" * filled + "\u2591" * (width - filled)
+
+
+def welcome_rooms(text):
+    """ Room names listed in the server's welcome text. """
+    if "Available rooms:\n" not in text:
+        return []
+    rooms = []
+    for line in text.split("Available rooms:\n", 1)[1].split("\n"):
+        line = line.strip()
+        if line.startswith("Type ") or not line:
+            break
+        rooms.append(line)
+    return rooms
+
+
+class EngineEvents:
+    """
+    What the engine reports. The defaults print; front ends override what
+    they show. Called on the engine's threads.
+    """
+
+    def log(self, text):
+        """ The engine's own notes (reconnects, audio setup, ...). """
+        print(text)
+
+    def message(self, text):
+        """ Any text line from the server, joins and errors included. """
+        self.log(text)
+
+    def room_list(self, rooms_text):
+        pass
+
+    def joined(self, room):
+        pass
+
+    def resumed(self, room):
+        pass
+
+    def left(self, room):
+        pass
+
+    def speaking(self, client_id, level):
+        """ SPEAKING:<id>:<level> from the server; level 0 means it stopped. """
+        pass
+
+    def disconnected(self):
+        """ The connection is gone for good (closed, or reconnecting gave up). """
+        pass
+
+
+class PyAudioDevices:
+    """ Mic and speakers through one PyAudio instance, opened on first use. """
+
+    def __init__(self, rate=Rate, chunk=Chunks):
+        self.rate = rate
+        self.chunk = chunk
+        self.pa = None
+
+    def _open(self, **kwargs):
+        if pyaudio is None:
+            raise RuntimeError("pyaudio is not installed")
+        if self.pa is None:
+            self.pa = pyaudio.PyAudio()
+        return self.pa.open(format=pyaudio.paInt16, channels=Channels, rate=self.rate,
+                            frames_per_buffer=self.chunk, **kwargs)
+
+    def open_input(self):
+        return self._open(input=True)
+
+    def open_output(self):
+        """ Opened but not started: spares sit idle until a speaker shows up. """
+        return self._open(output=True, start=False)
+
+    def close(self):
+        if self.pa is not None:
+            self.pa.terminate()
+            self.pa = None
+
+
+class NullStream:
+    """ Stand-in for a PyAudio stream: reads silence, swallows writes, both in real time. """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.due = None
+
+    def _pace(self, nframes):
+        now = time.monotonic()
+        if self.due is None or self.due < now - 0.2:
+            self.due = now  # first use, or we fell behind: no catching up in a burst
+        self.due += nframes / self.rate
+        if self.due > now:
+            time.sleep(self.due - now)
+
+    def read(self, nframes, exception_on_overflow=False):
+        self._pace(nframes)
+        return bytes(2 * nframes)
+
+    def write(self, data):
+        self._pace(len(data) // 2)
+
+    def start_stream(self):
+        pass
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_output_latency(self):
+        return 0.0
+
+
+class NullDevices:
+    """ Headless devices: a silent mic and speakers that discard, for tests and load. """
+
+    def __init__(self, rate=Rate, chunk=Chunks):
+        self.rate = rate
+        self.chunk = chunk
+
+    def open_input(self):
+        return NullStream(self.rate)
+
+    def open_output(self):
+        return NullStream(self.rate)
+
+    def close(self):
+        pass
+
+
+class VoiceChatEngine:
+    """
+    connect() -> join()/attend()/switch, start_audio() once in a room,
+    leave(), close(). Everything else runs on the engine's own threads and is
+    reported through events.
+    """
+
+    def __init__(self, host, port, events=None, devices=None, rate=Rate, chunk=Chunks,
+                 fec=FEC_ENABLED, layers=SIMULCAST_LAYERS, dsp=DSP_ENABLED,
+                 prefill=BUFFER_FILL_THRESHOLD, tls=None, e2e=E2E_ENABLED, inbox=AUDIO_INBOX_MAX):
+        self.host = host
+        self.port = port
+        self.tls = tls        # voiceChatTls.TlsClient, or None for plaintext
+        self.events = events or EngineEvents()
+        self.devices = devices or PyAudioDevices(rate, chunk)
+        self.rate = rate
+        self.chunk = chunk
+        self.fec = fec
+        self.layers = layers
+        self.dsp_enabled = dsp
+        self.prefill = prefill
+        self.e2e = RoomKeys() if e2e and E2E_AVAILABLE else None
+        if e2e and not E2E_AVAILABLE:
+            self.events.log("[E2E] cryptography not installed, media is not end-to-end encrypted.")
+
+        self.sock = None
+        # the capture pipeline and the front end both write to the socket; keep frames whole
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+        self.closing = False
+        self.refused = False  # got SERVER_BUSY: do not reconnect as a newcomer
+        self.client_id = None
+        self.token = None     # from "TOKEN:<token>", lets us RESUME after a drop
+        self.room = None
+        self.listening = False  # joined with LISTEN: no mic for this session
+        self.levels = {}        # client id -> (level, when heard), from SPEAKING
+        self.request_ids = itertools.count(1)
+        self.pending = {}     # request id -> (Future, timeout Timer)
+        self.pending_lock = threading.Lock()
+
+        self.caps_sent = False     # the server keeps our CAPS for the session, across rooms
+        self.fec_active = False    # server acknowledged CAPS:fec=red
+        self.layers_active = 1     # from CAPS_OK:layers=<n>
+        self.frames_recovered = 0
+        self.inbox_dropped = 0
+        # Stamps and arrival times are taken on the server's clock (from its PINGs),
+        # so the network share of the delay is meaningful between different machines.
+        self.server_clock = ServerClock()
+
+        self.stop_audio_threads = False
+        self.audio_started = False  # start_audio() ran, listeners included; until stop_audio()
+        self.audio_inbox = queue.Queue(maxsize=inbox)
+        self.stream_requests = queue.Queue()  # user_id to open a stream for, or None to refill spares
+        self.spare_streams = deque()          # opened, not started
+        self.pending_streams = set()          # user_ids with an open in flight
+        self.output_streams = {}   # user_id -> output stream
+        self.jitter_buffers = {}   # user_id -> deque() of (pcm, received_at or None)
+        self.playback_threads = {}
+        self.receive_stats = {}    # user_id -> SequenceTracker (stamped MEDIA senders only)
+        self.latency_stats = {}    # user_id -> LatencyBreakdown (stamped MEDIA senders only)
+        self.workers_started = False
+
+        self.mic_stream = None
+        self.capture = None
+        self.dsp = None
+        self.echo_reference = None
+        # start/stop_audio_async run here one at a time, so a stop still waiting
+        # for its playback threads cannot close the streams of the next start
+        self.audio_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine-audio")
+
+    ####################################################################
+    #                           CONNECTION                             #
+    ####################################################################
+
+    def connect(self):
+        """ Connect and start reading; returns the server's welcome text. Blocks. """
+        self.closing = False
+        self.refused = False
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls is not None:
+            sock = self.tls.wrap(sock)
+        welcome = sock.recv(4096).decode('utf-8')
+        if welcome.startswith("SERVER_BUSY"):
+            sock.close()
+            raise ConnectionRefusedError(busy_text(welcome))
+        self.sock = sock
+        self.start_receive_workers()
+        self.reader_thread = threading.Thread(target=self.parse_server_messages, daemon=True)
+        self.reader_thread.start()
+        return welcome
+
+    def connect_async(self):
+        """ connect() on a worker thread; returns a Future of the welcome text. """
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.connect())
+            except Exception as e:
+                future.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def request(self, command, timeout=REQUEST_TIMEOUT):
+        """
+        Send command tagged with a fresh request id. The returned Future gets the
+        server's detail text (e.g. the room joined) when it answers OK, or fails
+        with RequestError (ERR), TimeoutError or ConnectionError. It is resolved
+        on the reader thread, after the events the reply itself raised (joined,
+        left, ...), so callbacks see the engine's state already updated.
+        """
+        future = Future()
+        request_id = next(self.request_ids)
+        timer = threading.Timer(timeout, self.finish_request, (request_id,),
+                                {"error": TimeoutError(f"no answer to {command!r} in {timeout:g}s")})
+        timer.daemon = True
+        with self.pending_lock:
+            self.pending[request_id] = (future, timer)
+        try:
+            sock = self.sock
+            if sock is None:
+                raise ConnectionError("not connected")
+            with self.send_lock:
+                sock.sendall(encode_request(request_id, command))
+        except OSError as e:  # ConnectionError included
+            self.finish_request(request_id, error=e)
+            return future
+        timer.start()
+        return future
+
+    def finish_request(self, request_id, result=None, error=None):
+        with self.pending_lock:
+            entry = self.pending.pop(request_id, None)
+        if entry is None:
+            return  # already answered, timed out or failed
+        future, timer = entry
+        timer.cancel()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def fail_pending_requests(self, reason):
+        with self.pending_lock:
+            request_ids = list(self.pending)
+        for request_id in request_ids:
+            self.finish_request(request_id, error=ConnectionError(reason))
+
+    def send_command(self, cmd_str):
+        """ Sends a command line to the server if not empty. """
+        if cmd_str and self.sock is not None:
+            with self.send_lock:
+                self.sock.sendall(encode_line(cmd_str))
+
+    def join(self, room):
+        """ Create-or-join from the lobby, or hop rooms on the same connection. Future of the room. """
+        return self.request(f"NEW:{room}" if self.room is None else f"SWITCH:{room}")
+
+    def attend(self, room):
+        """ Join an existing room only (from the lobby). Future of the room. """
+        return self.request(room)
+
+    def listen(self, room):
+        """
+        Join an existing room listen-only, as the first join of a connection:
+        no mic, and the server serves us from its cheap write-only path for
+        the rest of the session. Future of the room.
+        """
+        self.listening = True
+        future = self.request(f"LISTEN:{room}")
+
+        def done(f):
+            if f.exception() is not None and self.room is None:
+                self.listening = False
+        future.add_done_callback(done)
+        return future
+
+    def leave(self):
+        """ Back to the lobby without dropping the connection. Future of the room left. """
+        return self.request("LEAVE")
+
+    def request_room_list(self):
+        """ The list itself arrives as a room_list event, before the Future resolves. """
+        return self.request("REQ:ROOM_LIST")
+
+    def close(self):
+        """ Stop audio, say BYE (the server need not hold our seat) and disconnect. Blocks. """
+        self.stop_audio_async().result()
+        self.closing = True
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                with self.send_lock:
+                    sock.sendall(encode_line("BYE"))
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self.fail_pending_requests("connection closed")
+        if self.reader_thread is not None and self.reader_thread is not threading.current_thread():
+            self.reader_thread.join(timeout=1)
+        self.reader_thread = None
+        self.client_id = None
+        self.token = None
+        self.room = None
+        self.listening = False
+        self.caps_sent = False
+
+    def parse_server_messages(self):
+        """
+        Runs read_server_messages; if the connection drops without us asking,
+        reconnects with backoff and resumes the session (same id, same room),
+        so other clients keep their stream for us and we keep ours for them.
+        """
+        sock = self.sock
+        while True:
+            self.read_server_messages(sock)
+            # answers to anything in flight went down with the connection
+            self.fail_pending_requests("connection lost")
+            if self.closing:
+                break
+            if self.sock is not sock and self.sock is not None:
+                sock = self.sock  # migrate() has already resumed us on the new connection
+                continue
+            if self.refused and self.token is None:
+                break  # nothing to resume, and retrying would only add to the load
+            self.events.log("[Network] Connection lost, reconnecting...")
+            sock = reconnect_with_backoff(self.host, self.port, self.token,
+                                          should_stop=lambda: self.closing,
+                                          log=self.events.log,
+                                          wrap=self.tls.wrap if self.tls is not None else None)
+            if sock is None:
+                self.events.log("[Network] Could not reconnect.")
+                break
+            self.sock = sock
+        self.events.disconnected()
+
+    def read_server_messages(self, sock):
+        """
+        Reads lines from the server until the connection ends:
+          - ID:<id>, TOKEN:<token>
+          - PING:<ms> (answered with PONG:<ms>)
+          - CAPS_OK:...
+          - ROOM_LIST:...
+          - DATA:<client_id>:<length> / MEDIA:<client_id>:<length>
+          - "Joined room:" / "Resumed room:" / "Left room:" / "RESUME_FAILED"
+          - SERVER_BUSY:<reason>, ROOM_FULL:<room>, LISTEN_ONLY:<reason>
+          - SPEAKING:<client_id>:<level>
+          - E2E_ROOM: / E2E_PUB: / E2E_KEY: / E2E_GONE: (handle_e2e_line)
+          - RECONNECT:<ms> / REDIRECT:<host>:<port>:<ms> (migrate)
+          - RE:<id>:OK|ERR:<detail> (resolves the request's Future)
+          - any other text
+        """
+        try:
+            # the server pings regularly, so a long silence means a dead link
+            sock.settimeout(SERVER_IDLE_TIMEOUT)
+            f = sock.makefile('rb')
+        except OSError:
+            return
+
+        remember_tls = self.tls is not None
+        while not self.closing:
+            try:
+                line = f.readline()
+                if not line:
+                    break
+                if remember_tls:
+                    # the session ticket came in before this line; keep it for the next reconnect
+                    self.tls.remember(sock)
+                    remember_tls = False
+                line = line.strip()
+
+                if line.startswith(b"DATA:") or line.startswith(b"MEDIA:"):
+                    parts = line.decode('utf-8').split(':')
+                    if len(parts) == 3:
+                        sid = int(parts[1])
+                        length = int(parts[2])
+                        audio_data = f.read(length)
+                        if not audio_data or len(audio_data) < length:
+                            break
+                        if line.startswith(b"MEDIA:"):
+                            audio_data = unpack_media(audio_data)
+                            audio_data.received_at = time.monotonic()
+                        self.hand_off_audio(sid, audio_data)
+
+                elif line.startswith(b"ID:"):
+                    self.client_id = int(line[3:])
+                    if self.e2e is not None:
+                        self.e2e.my_id = self.client_id
+                    self.events.log(f"Assigned Client ID: {self.client_id}")
+
+                elif line.startswith(b"PING:"):
+                    stamp = line[5:].decode('utf-8')
+                    self.send_command("PONG:" + stamp)
+                    self.server_clock.update(int(stamp))
+
+                elif line.startswith(b"TOKEN:"):
+                    self.token = line[6:].decode('utf-8')
+
+                elif line.startswith(b"CAPS_OK:"):
+                    caps = parse_caps(line[8:].decode('utf-8'))
+                    self.fec_active = caps.get("fec") == "red"
+                    self.layers_active = int(caps.get("layers", 1))
+                    capture = self.capture
+                    if capture is not None:
+                        capture.redundancy = self.fec_active
+                        capture.layers = self.layers_active
+
+                elif line == b"RESUME_FAILED":
+                    # grace window ran out; come back as a new participant
+                    self.events.log("[Network] Session expired, rejoining.")
+                    self.caps_sent = False
+                    if self.room is not None:
+                        self.send_command(f"NEW:{self.room}")
+
+                elif line.startswith(b"RE:"):
+                    response = parse_response(line.decode('utf-8'))
+                    if response is not None:
+                        request_id, ok, detail = response
+                        self.finish_request(request_id, result=detail if ok else None,
+                                            error=None if ok else RequestError(detail))
+
+                elif line.startswith(b"SPEAKING:"):
+                    _, sid, level = line.decode('utf-8').split(':')
+                    sid, level = int(sid), int(level)
+                    if level:
+                        self.levels[sid] = (level, time.monotonic())
+                    else:
+                        self.levels.pop(sid, None)
+                    self.events.speaking(sid, level)
+
+                elif line.startswith(b"E2E_"):
+                    self.handle_e2e_line(line.decode('utf-8'))
+
+                elif line.startswith(b"RECONNECT:") or line.startswith(b"REDIRECT:"):
+                    host, port, delay = parse_migrate(line.decode('utf-8'))
+                    host, port = host or self.host, port or self.port
+                    self.events.log(f"[Network] Server is draining, moving to {host}:{port} in {delay:.1f}s.")
+                    timer = threading.Timer(delay, self.migrate, (sock, host, port))
+                    timer.daemon = True
+                    timer.start()
+
+                elif line.startswith(b"SERVER_BUSY"):
+                    self.refused = True
+                    self.events.message(busy_text(line.decode('utf-8')))
+
+                elif line.startswith(b"ROOM_FULL:"):
+                    self.events.message(f"Room '{line[10:].decode('utf-8')}' is full.")
+
+                elif line.startswith(b"LISTEN_ONLY:"):
+                    self.events.message(f"Not forwarding our audio: {line[12:].decode('utf-8')}.")
+
+                elif line.startswith(b"ROOM_LIST:"):
+                    self.events.room_list(line.decode('utf-8').split("ROOM_LIST:", 1)[1].strip())
+
+                else:
+                    text = line.decode('utf-8')
+                    if not text:
+                        continue
+                    self.events.message(text)
+                    if text.startswith("Joined room:"):
+                        room = text.split(":", 1)[1].strip()
+                        if self.room is not None:
+                            self.reset_jitter_buffers()
+                        self.room = room
+                        if self.e2e is not None:
+                            self.e2e.reset()
+                            self.send_command(self.e2e.hello())
+                        if self.audio_started:
+                            self.send_caps()  # no-op unless this is a new session
+                        self.events.joined(room)
+                    elif text.startswith("Resumed room:"):
+                        self.room = text.split(":", 1)[1].strip() or None
+                        if self.e2e is not None and self.room is not None:
+                            self.send_command(self.e2e.hello())  # same members; keep our keys
+                        self.events.resumed(self.room)
+                    elif text.startswith("Left room:"):
+                        room, self.room = self.room, None
+                        self.reset_jitter_buffers()
+                        if self.e2e is not None:
+                            self.e2e.reset()
+                        self.events.left(room)
+
+            except (OSError, ValueError) as e:
+                if not self.closing:
+                    self.events.log(f"[Network] Error reading from server: {e}")
+                break
+
+    def migrate(self, old, host, port):
+        """
+        The server is draining: resume at host:port on a new connection first,
+        then drop old; the reader carries on with the new one. If the new one
+        cannot be had we stay, and the usual reconnect runs when old closes.
+        """
+        if self.closing or self.sock is not old:
+            return
+        if self.tls is not None and host != self.host:
+            self.tls.retarget(host)
+        sock = reconnect_with_backoff(host, port, self.token,
+                                      should_stop=lambda: self.closing or self.sock is not old,
+                                      log=self.events.log,
+                                      wrap=self.tls.wrap if self.tls is not None else None)
+        if sock is None:
+            return
+        self.host, self.port = host, port
+        with self.send_lock:
+            self.sock = sock
+        try:
+            old.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle_e2e_line(self, text):
+        """ The room's E2E key exchange, relayed by the server; sends whatever RoomKeys answers. """
+        e2e = self.e2e
+        if e2e is None:
+            return
+        tag, _, rest = text.partition(":")
+        try:
+            if tag == "E2E_ROOM":
+                lines = e2e.on_room(rest)
+            elif tag == "E2E_PUB":
+                sid, _, key = rest.partition(":")
+                lines = e2e.on_peer(int(sid), key)
+            elif tag == "E2E_GONE":
+                lines = e2e.on_gone(int(rest))
+            elif tag == "E2E_KEY":
+                sid, _, blob = rest.partition(":")
+                if not e2e.on_key(int(sid), blob):
+                    self.events.log(f"[E2E] Could not open the room key from {sid}.")
+                lines = []
+            else:
+                return
+        except ValueError as e:
+            self.events.log(f"[E2E] Bad {tag} line: {e}")
+            return
+        for line in lines:
+            self.send_command(line)
+
+    ####################################################################
+    #                         RECEIVE / PLAYBACK                       #
+    ####################################################################
+
+    def start_receive_workers(self):
+        """ Start the demux and stream-opener stages once per engine. """
+        if self.workers_started:
+            return
+        self.workers_started = True
+        for target in (self.audio_demux_thread, self.stream_opener_thread):
+            threading.Thread(target=target, daemon=True).start()
+
+    def hand_off_audio(self, user_id, audio_data):
+        """
+        audio_data is raw PCM (DATA) or a MediaFrame (MEDIA).
+        Called on the socket reader thread: never blocks. If the demux stage is
+        behind, the oldest queued frame is dropped (it would play late anyway).
+        """
+        while True:
+            try:
+                self.audio_inbox.put_nowait((user_id, audio_data))
+                return
+            except queue.Full:
+                try:
+                    self.audio_inbox.get_nowait()
+                    self.inbox_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def audio_demux_thread(self):
+        chunk = self.chunk
+        while True:
+            user_id, audio_data = self.audio_inbox.get()
+            received_at = None
+            if isinstance(audio_data, MediaFrame):
+                if audio_data.flags & FLAG_E2E and (self.e2e is None or not self.e2e.open_frame(user_id, audio_data)):
+                    continue  # sealed with a key we do not have (yet)
+                tracker = self.receive_stats.get(user_id)
+                if tracker is None:
+                    tracker = self.receive_stats[user_id] = SequenceTracker(self.rate)
+                    self.latency_stats[user_id] = LatencyBreakdown(self.rate)
+                gap = tracker.update(audio_data)
+                if gap < 0:
+                    continue  # late or duplicate: its slot has already been played
+                received_at = audio_data.received_at
+                arrival = self.server_clock.now() - (time.monotonic() - received_at)
+                self.latency_stats[user_id].on_arrival(audio_data, arrival, chunk)
+                if gap:
+                    recovered = recover_lost_frame(audio_data, gap, chunk)
+                    if recovered is not None:
+                        self.frames_recovered += 1
+                        self.play_audio_data_for_user(user_id, recovered)
+                audio_data = full_rate_payload(audio_data, chunk)
+            self.play_audio_data_for_user(user_id, audio_data, received_at)
+
+    def play_audio_data_for_user(self, user_id, audio_data, received_at=None):
+        if self.stop_audio_threads:
+            return
+        buf = self.jitter_buffers.get(user_id)
+        if buf is None:
+            buf = self.jitter_buffers[user_id] = deque()
+        buf.append((audio_data, received_at))
+        self.ensure_output_stream(user_id)
+
+    def ensure_output_stream(self, user_id):
+        """
+        Non-blocking: if user_id has no output stream yet, ask the opener thread
+        for one. Audio keeps collecting in the jitter buffer meanwhile.
+        """
+        if user_id in self.output_streams or user_id in self.pending_streams:
+            return
+        self.pending_streams.add(user_id)
+        self.stream_requests.put(user_id)
+
+    def stream_opener_thread(self):
+        """
+        Hands out output streams: a pre-opened spare if there is one, a fresh one
+        otherwise; then tops the spare pool back up while nobody is waiting.
+        """
+        while True:
+            user_id = self.stream_requests.get()
+            try:
+                if user_id is not None and not self.stop_audio_threads:
+                    out_stream = (self.spare_streams.popleft() if self.spare_streams
+                                  else self.devices.open_output())
+                    out_stream.start_stream()
+                    self.output_streams[user_id] = out_stream
+                    t = threading.Thread(target=self.playback_thread_func, args=(user_id,), daemon=True)
+                    t.start()
+                    self.playback_threads[user_id] = t
+                while (self.stream_requests.empty() and not self.stop_audio_threads
+                       and len(self.spare_streams) < PREWARM_OUTPUT_STREAMS):
+                    self.spare_streams.append(self.devices.open_output())
+            except Exception as e:
+                self.events.log(f"[Audio] Error opening output stream: {e}")
+            finally:
+                self.pending_streams.discard(user_id)
+
+    def playback_thread_func(self, user_id):
+        out_stream = self.output_streams[user_id]
+        buf = self.jitter_buffers[user_id]
+        silence = b'\x00' * (self.chunk * 2)
+        try:
+            device_latency = out_stream.get_output_latency()
+        except Exception:
+            device_latency = 0.0
+
+        while not self.stop_audio_threads and len(buf) < self.prefill:
+            time.sleep(0.01)
+
+        while not self.stop_audio_threads:
+            if buf:
+                chunk, received_at = buf.popleft()
+                breakdown = self.latency_stats.get(user_id)
+                if received_at is not None and breakdown is not None:
+                    breakdown.on_playout(time.monotonic() - received_at, device_latency)
+                reference = self.echo_reference
+                if reference is not None:
+                    reference.add(chunk)
+                out_stream.write(chunk)
+            else:
+                out_stream.write(silence)
+                time.sleep(0.01)
+
+    def reset_jitter_buffers(self):
+        """
+        Drop queued audio from the room we just left. Output streams and their
+        playback threads stay open; they play silence until audio shows up again.
+        """
+        for buf in list(self.jitter_buffers.values()):
+            buf.clear()
+        self.levels.clear()
+
+    def speaking_now(self):
+        """ {client id: level} of the members currently talking, stale ones dropped. """
+        now = time.monotonic()
+        return {sid: level for sid, (level, heard) in list(self.levels.items())
+                if now - heard < SPEAKING_STALE}
+
+    ####################################################################
+    #                              CAPTURE                             #
+    ####################################################################
+
+    def send_media_body(self, body):
+        """
+        Writes to whatever self.sock currently is: after a reconnect the reader
+        swaps it in and we carry on. Raises OSError while the link is down; the
+        pipeline drops that frame rather than queueing stale audio.
+        """
+        sock = self.sock
+        if sock is None:
+            raise OSError("not connected")
+        with self.send_lock:
+            sock.sendall(encode_media(body))
+
+    def seal_media(self, frame, block, data):
+        """ CapturePipeline.seal: our frames under the room key. """
+        return self.e2e.seal(self.client_id, frame, block, data)
+
+    def start_audio(self):
+        """
+        Open the mic, start capture and tell the server what we send and decode.
+        A listener only gets the CAPS (what it decodes) and its playback prewarmed.
+        Does nothing if audio is already running, e.g. on a SWITCH.
+        """
+        if self.audio_started:
+            return
+        self.audio_started = True
+        self.stop_audio_threads = False
+        if self.listening:
+            self.stream_requests.put(None)
+            self.send_caps()
+            return
+        self.mic_stream = mic_stream = self.devices.open_input()
+
+        self.dsp = None
+        if self.dsp_enabled and DSP_AVAILABLE:
+            self.echo_reference = EchoReference(self.rate)
+            self.dsp = DspChain(self.rate, self.chunk, reference=self.echo_reference, log=self.events.log)
+        elif self.dsp_enabled:
+            self.events.log("[Audio] numpy not installed, echo cancellation off.")
+
+        chunk = self.chunk
+        self.capture = CapturePipeline(
+            read_chunk=lambda: mic_stream.read(chunk, exception_on_overflow=False),
+            send_body=self.send_media_body,
+            frames_per_chunk=chunk,
+            rate=self.rate,
+            dsp=self.dsp.process if self.dsp else None,
+            clock=self.server_clock.now,
+            log=self.events.log)
+        self.capture.redundancy = self.fec_active
+        self.capture.layers = self.layers_active
+        if self.e2e is not None:
+            self.capture.seal = self.seal_media
+        self.capture.start()
+        self.stream_requests.put(None)  # prewarm spare output streams
+        self.send_caps()
+
+    def start_audio_async(self):
+        """ start_audio() on the audio worker, after any stop queued before it. Future of None. """
+        return self.audio_worker.submit(self.start_audio)
+
+    def stop_audio_async(self):
+        """ stop_audio() on the audio worker, so the caller does not wait for playback to end. Future. """
+        return self.audio_worker.submit(self.stop_audio)
+
+    def send_caps(self):
+        """ Once per server session; a rejoin after RESUME_FAILED is a new one. """
+        if self.caps_sent:
+            return
+        self.caps_sent = True
+        caps = [f"rate={self.rate}"]  # for a server recording the room
+        if self.fec:
+            caps.append("fec=red")
+        if self.layers > 1:
+            caps.append(f"layers={self.layers}")
+        self.send_command("CAPS:" + ",".join(caps))
+
+    def stop_audio(self):
+        """ Stop the mic and close every output stream (and idle spares). """
+        if self.capture is not None:
+            self.capture.stop()
+            self.capture = None
+        self.audio_started = False
+        self.stop_audio_threads = True
+        self.echo_reference = None
+        self.dsp = None
+        time.sleep(0.3)  # let playback threads see the flag before their streams close
+
+        streams = list(self.output_streams.values()) + list(self.spare_streams)
+        if self.mic_stream is not None:
+            streams.append(self.mic_stream)
+        for stream in streams:
+            try:
+                stream.stop_stream()
+                stream.close()
+            except Exception:
+                pass
+        self.devices.close()
+        self.mic_stream = None
+        self.output_streams.clear()
+        self.spare_streams.clear()
+        self.jitter_buffers.clear()
+        self.playback_threads.clear()
+
+    ####################################################################
+    #                               STATS                              #
+    ####################################################################
+
+    def stats_lines(self):
+        """ Send-side latency, DSP, and per-speaker receive quality and delay. """
+        lines = []
+        if self.capture is not None:
+            lines.append(f"me: {self.capture.stats_text()}")
+        if self.dsp is not None:
+            lines.append(self.dsp.stats_text())
+        for uid, tracker in list(self.receive_stats.items()):
+            lines.append(f"user {uid}: {tracker.stats_text()}")
+            breakdown = self.latency_stats.get(uid)
+            if breakdown is not None:
+                lines.append(f"user {uid}: {breakdown.stats_text()}")
+        if self.inbox_dropped:
+            lines.append(f"receive inbox dropped {self.inbox_dropped} frame(s)")
+        if self.fec_active:
+            lines.append(f"FEC recovered {self.frames_recovered} frame(s)")
+        if self.tls is not None:
+            lines.append(self.tls.stats_text())
+        if self.e2e is not None:
+            lines.append(self.e2e.stats_text())
+        return lines
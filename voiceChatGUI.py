@@ -1,20 +1,27 @@
+import sys
 import tkinter as tk
 from tkinter import messagebox, ttk
-import threading
-from voiceChatClient import connect_to_server, audio_streaming, stop_audio_threads
+from voiceChatClient import ClientSettings
+from voiceChatEngine import welcome_rooms
+from voiceChatTk import TkApp, TkEvents, fill_speaking_list
 
 
-class VoiceChatApp:
-    def __init__(self, root):
+class VoiceChatApp(TkApp):
+    def __init__(self, root, settings):
         self.root = root
         self.root.title("Voice Chat App")
         self.root.geometry("600x400")
-        self.voiceChatClient = None
+        self.engine = settings.make_engine(TkEvents(self), settings.make_tls())
+        self.connected = False
         self.username = None
         self.current_room = None
-        self.is_room_owner = False
+        self.rooms_listbox = None
+        self.room_names = []
+        self.users_listbox = None
 
         self.setup_first_page()
+        self.start_ui_queue()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     # Page 1: Username Entry
     def setup_first_page(self):
@@ -56,8 +63,10 @@ class VoiceChatApp:
 
         tk.Button(right_frame, text="Create Room", command=self.create_room, font=("Arial", 12), bg="#2196F3", fg="white").pack(pady=5)
         tk.Button(right_frame, text="Attend Room", command=self.attend_room, font=("Arial", 12), bg="#FF9800", fg="white").pack(pady=5)
+        tk.Button(right_frame, text="Listen Only", command=self.listen_room, font=("Arial", 12), bg="#607D8B", fg="white").pack(pady=5)
         tk.Button(right_frame, text="Back", command=self.setup_first_page, font=("Arial", 12), bg="#F44336", fg="white").pack(pady=20)
 
+        self.show_rooms(self.room_names)
         self.refresh_rooms()
 
     # Page 3: Inside Room
@@ -73,18 +82,14 @@ class VoiceChatApp:
 
         self.users_listbox = tk.Listbox(users_frame, font=("Arial", 12), height=15)
         self.users_listbox.pack(expand=True, fill="both", pady=5)
+        self.shown_levels = {}
 
         bottom_frame = tk.Frame(self.root, pady=10)
         bottom_frame.pack(fill="x")
 
+        # no Close Room: the server closes a room once its last member leaves
         tk.Button(bottom_frame, text="Leave Room", command=self.leave_room, font=("Arial", 12), bg="#FF5722", fg="white").pack(side="left", padx=10)
 
-        if self.is_room_owner:
-            tk.Button(bottom_frame, text="Close Room", command=self.close_room, font=("Arial", 12), bg="#D32F2F", fg="white").pack(side="right", padx=10)
-
-        # Start audio streaming
-        threading.Thread(target=audio_streaming, args=(self.voiceChatClient,), daemon=True).start()
-
     # Navigation Functions
     def go_to_room_selection(self):
         username = self.username_entry.get()
@@ -93,82 +98,86 @@ class VoiceChatApp:
             return
 
         self.username = username
-        try:
-            self.voiceChatClient, welcome_message = connect_to_server()
-            print(welcome_message)
+        if self.connected:
             self.setup_second_page()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to connect to server: {e}")
+            return
+        # connect off the Tk thread; the page changes once the welcome is in
+        self.when_done(self.engine.connect_async(), self.on_connected, "connect to server")
+
+    def on_connected(self, welcome_message):
+        self.connected = True
+        print(welcome_message)
+        self.room_names = welcome_rooms(welcome_message)
+        self.setup_second_page()
 
     def create_room(self):
         room_name = self.room_name_entry.get()
         if not room_name:
             messagebox.showerror("Error", "Room name cannot be empty!")
             return
-
-        try:
-            self.voiceChatClient.send(f"NEW:{room_name}".encode('utf-8'))
-            response = self.voiceChatClient.recv(4096).decode('utf-8')
-            if "Joined room:" in response:
-                self.current_room = room_name
-                self.is_room_owner = True
-                self.setup_third_page()
-            else:
-                messagebox.showerror("Error", response)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to create room: {e}")
+        self.when_done(self.engine.join(room_name), self.on_joined_room, "create room")
 
     def attend_room(self):
         room_name = self.room_name_entry.get()
         if not room_name:
             messagebox.showerror("Error", "Please enter a room name to attend!")
             return
+        self.when_done(self.engine.attend(room_name), self.on_joined_room, "attend room")
 
-        try:
-            self.voiceChatClient.send(room_name.encode('utf-8'))
-            response = self.voiceChatClient.recv(4096).decode('utf-8')
-            print("Server response (attend room):", response)
-
-            if "Joined room:" in response:
-                self.current_room = room_name
-                self.is_room_owner = False
-                self.setup_third_page()
-            else:
-                messagebox.showerror("Error", response)
-        except ConnectionResetError:
-            messagebox.showerror("Error", "Connection reset by the server. Please try again.")
-            self.voiceChatClient.close()
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to attend room: {e}")
-
+    def listen_room(self):
+        """ Join without a mic; the choice holds for the rest of this connection. """
+        room_name = self.room_name_entry.get()
+        if not room_name:
+            messagebox.showerror("Error", "Please enter a room name to listen to!")
+            return
+        self.when_done(self.engine.listen(room_name), self.on_joined_room, "listen to room")
 
     def refresh_rooms(self):
-        try:
-            self.voiceChatClient.send(b"LIST")
-            response = self.voiceChatClient.recv(4096).decode('utf-8')
-            self.rooms_listbox.delete(0, tk.END)
-            rooms = response.split("\n")
-            for room in rooms:
-                if room.strip():
-                    self.rooms_listbox.insert(tk.END, room)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to refresh rooms: {e}")
+        """ The list arrives as a room_list event; only failures are handled here. """
+        self.when_done(self.engine.request_room_list(), lambda _: None, "refresh rooms")
+
+    def show_rooms(self, rooms):
+        self.room_names = rooms
+        if self.rooms_listbox is None:
+            return  # not on the room page
+        self.rooms_listbox.delete(0, tk.END)
+        for room in rooms:
+            if room.strip():
+                self.rooms_listbox.insert(tk.END, room)
+
+    def show_speaking(self, levels):
+        """ Users talking right now, each with a level bar, from the server's SPEAKING events. """
+        if self.users_listbox is not None:
+            fill_speaking_list(self.users_listbox, self.engine, levels)
 
     def leave_room(self):
-        self.voiceChatClient.send(b"LEAVE")
-        self.setup_second_page()
+        self.when_done(self.engine.leave(), self.on_left_room, "leave room")
 
-    def close_room(self):
-        self.voiceChatClient.send(b"CLOSE_ROOM")
+    # Request results, on the Tk thread
+    def on_joined_room(self, room_name):
+        self.current_room = room_name
+        self.when_done(self.engine.start_audio_async(), lambda _: None, "open the microphone")
+        self.setup_third_page()
+
+    def on_left_room(self, _room=None):
+        self.current_room = None
+        self.engine.stop_audio_async()
         self.setup_second_page()
 
+    def on_close(self):
+        self.engine.close()
+        self.root.destroy()
+
     def clear_frame(self):
+        self.rooms_listbox = None
+        self.users_listbox = None
         for widget in self.root.winfo_children():
             widget.destroy()
 
 
 # Start GUI
 if __name__ == "__main__":
+    settings = ClientSettings(sys.argv[1:])
     root = tk.Tk()
-    app = VoiceChatApp(root)
+    app = VoiceChatApp(root, settings)
     root.mainloop()
@@ -0,0 +1,121 @@
+"""
+Per-sender audio levels on the server, for speaking indicators and for
+forwarding decisions (silence does not hold a speaker slot, and is not
+worth forwarding while shedding load).
+
+Levels are 0..100 on a dB scale: 0 at LEVEL_FLOOR_DB and below, 100 at full
+scale. Each sender is measured once per capture (not per listener) on the
+primary PCM of its frame. With numpy that is one dot product over the whole
+chunk; without it every LEVEL_STRIDE-th sample is used, which keeps the pure
+Python loop at a few hundred samples and the level within a dB or so.
+
+LevelMeter turns the per-frame levels into "SPEAKING:<id>:<level>" events:
+at most one per SPEAKING_INTERVAL per sender, the loudest level since the
+last one, and only when it moved by LEVEL_STEP or more, crossed silence, or
+SPEAKING_REFRESH went by (so clients can time out a sender that vanished).
+"""
+import array
+import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from voiceChatProtocol import FLAG_RED, MEDIA_HEADER, RED_LENGTH
+
+LEVEL_FLOOR_DB = -60.0
+SILENCE_LEVEL = 20          # below this (about -48 dBFS) a frame counts as silence
+LEVEL_STRIDE = 8            # samples skipped per sample measured, without numpy
+SPEAKING_INTERVAL = 0.2     # seconds between events per sender
+SPEAKING_REFRESH = 1.0      # re-send an unchanged level this often while voiced
+LEVEL_STEP = 5
+QUIET_AFTER = 1.0           # no frames for this long: the sender is shown silent
+
+
+def media_pcm(body):
+    """ Primary PCM of a MEDIA body (RED copy skipped), as a view, not a copy. """
+    view = memoryview(body)
+    start = MEDIA_HEADER.size
+    if len(body) > 1 and body[1] & FLAG_RED:
+        (primary_len,) = RED_LENGTH.unpack_from(body, start)
+        start += RED_LENGTH.size
+        return view[start:start + primary_len]
+    return view[start:]
+
+
+def to_level(amplitude):
+    """ int16 amplitude -> 0..100 """
+    if amplitude <= 0:
+        return 0
+    db = 20.0 * math.log10(amplitude / 32768.0)
+    return max(0, min(100, int(100.0 * (db - LEVEL_FLOOR_DB) / -LEVEL_FLOOR_DB)))
+
+
+def pcm_level(pcm):
+    """ (rms level, peak level) of int16 little-endian PCM. """
+    n = len(pcm) // 2
+    if not n:
+        return 0, 0
+    if np is not None:
+        samples = np.frombuffer(pcm, dtype="<i2", count=n).astype(np.float32)
+        rms = math.sqrt(float(np.dot(samples, samples)) / n)
+        peak = float(np.abs(samples).max())
+    else:
+        samples = array.array('h')
+        samples.frombytes(pcm[:2 * n])
+        if sys.byteorder != "little":
+            samples.byteswap()
+        samples = samples[::LEVEL_STRIDE]
+        rms = math.sqrt(sum(x * x for x in samples) / len(samples))
+        peak = max(max(samples), -min(samples))
+    return to_level(rms), to_level(peak)
+
+
+class LevelMeter:
+    """ One sender's levels; update() runs on its handle_client thread. """
+    __slots__ = ("level", "peak", "voiced", "held", "sent", "sent_at", "updated_at")
+
+    def __init__(self):
+        self.level = 0
+        self.peak = 0
+        self.voiced = False
+        self.held = 0         # loudest level since the last event
+        self.sent = 0         # level in the last event
+        self.sent_at = 0.0
+        self.updated_at = 0.0
+
+    def update(self, pcm, now):
+        """ Measure one frame; returns the level to announce, or None. """
+        level, peak = pcm_level(pcm)
+        return self.report(level, now, peak)
+
+    def report(self, level, now, peak=None):
+        """ A level measured elsewhere (the sender's, from a sealed frame's header); as update(). """
+        self.level = level
+        self.peak = level if peak is None else peak
+        self.voiced = self.level >= SILENCE_LEVEL
+        self.updated_at = now
+        if self.level > self.held:
+            self.held = self.level
+        if now - self.sent_at < SPEAKING_INTERVAL:
+            return None
+        held = self.held if self.held >= SILENCE_LEVEL else 0
+        self.held = 0
+        if held == self.sent == 0:
+            return None
+        if held and self.sent and abs(held - self.sent) < LEVEL_STEP and now - self.sent_at < SPEAKING_REFRESH:
+            return None
+        self.sent = held
+        self.sent_at = now
+        return held
+
+    def went_quiet(self, now):
+        """ Reaper side: True, once, if a sender shown as speaking stopped sending (DTX or gone). """
+        if self.sent and now - self.updated_at > QUIET_AFTER:
+            self.sent = 0
+            self.held = 0
+            self.voiced = False
+            return True
+        return False
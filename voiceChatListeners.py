@@ -0,0 +1,266 @@
+"""
+Listen-only members on one thread.
+
+A member that joined with "LISTEN:<room>" never sends audio, only the odd
+command line (PONG, LEAVE, SWITCH:..., BYE). Giving it a handle_client thread
+and an Outbox writer thread, like a speaker, costs two threads and two
+stacks per audience member for nothing; a big room's audience would spend
+more on context switches than on sending audio.
+
+ListenerHub instead puts every listener socket, non-blocking, on one
+selector thread:
+  - reads: buffered into whole lines, handed to on_line(member, line);
+    AUDIO/MEDIA bodies a listener sends anyway are skipped, not forwarded
+  - writes: the fan-out appends to the member's ListenerOutbox (same put/len
+    as Outbox, same drop-oldest bound) and marks it ready; the hub wakes once
+    for however many outboxes became ready and sends each one's backlog with
+    a single non-blocking send, keeping what did not fit for EVENT_WRITE
+  - EOF, a send error or BYE: the socket is closed and on_gone(member, conn,
+    said_bye) decides what happens to the seat
+"""
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from voiceChatProtocol import AUDIO_TAG, MEDIA_TAG
+from voiceChatRooms import OUTBOX_MAX_FRAMES
+from voiceChatTls import WOULD_BLOCK, pending
+
+# a listener's command lines are short; a longer unterminated line is garbage
+MAX_LINE = 4096
+
+
+class ListenerOutbox:
+    """ Outbox for a listener: drained by the hub, no thread of its own. """
+    __slots__ = ("conn", "frames", "lock", "closed", "dropped", "max_frames",
+                 "hub", "listener", "pending", "scheduled")
+
+    def __init__(self, conn, hub, listener, max_frames=OUTBOX_MAX_FRAMES):
+        self.conn = conn
+        self.listener = listener
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dropped = 0
+        self.max_frames = max_frames
+        self.hub = hub
+        self.pending = b""     # part of the last batch the kernel did not take yet
+        self.scheduled = False  # already in the hub's ready queue
+
+    def __len__(self):
+        return len(self.frames) + (1 if self.pending else 0)
+
+    def put(self, data):
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_frames:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(data)
+            if self.scheduled:
+                return True
+            self.scheduled = True
+        self.hub.schedule(self.listener)
+        return True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+
+class _Listener:
+    __slots__ = ("member", "conn", "outbox", "buffer", "skip", "registered", "want_write")
+
+    def __init__(self, member, conn, hub, buffer):
+        self.member = member
+        self.conn = conn
+        self.outbox = ListenerOutbox(conn, hub, self, hub.max_frames)
+        self.buffer = bytearray(buffer)
+        self.registered = False
+        self.skip = 0            # bytes of an AUDIO/MEDIA body still to throw away
+        self.want_write = False  # registered for EVENT_WRITE (kernel buffer was full)
+
+
+class ListenerHub:
+    """
+    on_line(member, line): a command line from a listener, called on the hub
+        thread; return False to hang up (the client said BYE).
+    on_gone(member, conn, said_bye): the connection is closed.
+    max_frames: each listener's queue, as Outbox.
+    """
+
+    def __init__(self, on_line, on_gone, max_frames=OUTBOX_MAX_FRAMES):
+        self.on_line = on_line
+        self.on_gone = on_gone
+        self.max_frames = max_frames
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.woken = False
+        self.ready = deque()     # _Listener with frames to send
+        self.arriving = deque()  # _Listener to register
+        self.listeners = {}      # conn -> _Listener, hub thread only
+
+    def __len__(self):
+        return len(self.listeners) + len(self.arriving)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def attach(self, member, buffered=b""):
+        """
+        Take over member.conn: gives member a ListenerOutbox, so anything sent
+        to it from now on goes through the hub. buffered is whatever the lobby
+        reader had already read past the join line.
+        """
+        conn = member.conn
+        conn.setblocking(False)
+        listener = _Listener(member, conn, self, buffered)
+        member.outbox = listener.outbox
+        self.arriving.append(listener)
+        self.wake()
+
+    def schedule(self, listener):
+        self.ready.append(listener)
+        self.wake()
+
+    def wake(self):
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wake_w.send(b"x")
+        except OSError:
+            pass  # buffer full: the hub is awake anyway
+
+    def _run(self):
+        while True:
+            for key, events in self.selector.select():
+                listener = key.data
+                if listener is None:
+                    with self.lock:
+                        self.woken = False
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                if events & selectors.EVENT_READ and not self._read(listener):
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._flush(listener)
+
+            while self.arriving:
+                self._register(self.arriving.popleft())
+            while self.ready:
+                listener = self.ready.popleft()
+                # its first frames can overtake its turn in arriving
+                if self._register(listener):
+                    self._flush(listener)
+
+    def _register(self, listener):
+        """ Returns False if the listener is already gone. """
+        if listener.outbox.closed:
+            return False
+        if not listener.registered:
+            listener.registered = True
+            self.listeners[listener.conn] = listener
+            self.selector.register(listener.conn, selectors.EVENT_READ, listener)
+            if listener.buffer:
+                return self._lines(listener)
+        return True
+
+    def _read(self, listener):
+        """ Returns False if the listener is gone. """
+        conn = listener.conn
+        try:
+            data = conn.recv(4096)
+            # a TLS record is decrypted whole; what recv did not return, select will not report
+            while data and pending(conn):
+                data += conn.recv(pending(conn))
+        except WOULD_BLOCK:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            self._close(listener, said_bye=False)
+            return False
+        listener.member.last_seen = time.monotonic()
+        listener.buffer += data
+        return self._lines(listener)
+
+    def _lines(self, listener):
+        buf = listener.buffer
+        while True:
+            if listener.skip:
+                n = min(listener.skip, len(buf))
+                del buf[:n]
+                listener.skip -= n
+                if listener.skip:
+                    return True
+            idx = buf.find(b"\n")
+            if idx < 0:
+                if len(buf) > MAX_LINE:
+                    self._close(listener, said_bye=False)
+                    return False
+                return True
+            line = bytes(buf[:idx])
+            del buf[:idx + 1]
+            if line.startswith((AUDIO_TAG, MEDIA_TAG)):
+                try:
+                    listener.skip = int(line.split(b":", 1)[1])
+                except ValueError:
+                    pass
+                continue
+            line = line.decode('utf-8', errors='replace').strip()
+            if line and self.on_line(listener.member, line) is False:
+                self._close(listener, said_bye=True)
+                return False
+
+    def _flush(self, listener):
+        outbox = listener.outbox
+        with outbox.lock:
+            outbox.scheduled = False
+            if not outbox.pending and outbox.frames:
+                # coalesce everything queued into one syscall
+                outbox.pending = b"".join(outbox.frames)
+                outbox.frames.clear()
+        data = outbox.pending
+        if data:
+            try:
+                sent = listener.conn.send(data)
+            except WOULD_BLOCK:
+                sent = 0  # TLS: retried with the same data, as it requires
+            except OSError:
+                self._close(listener, said_bye=False)
+                return
+            outbox.pending = data[sent:]
+        if outbox.pending or outbox.frames:
+            # more to send once the kernel has room
+            if not listener.want_write:
+                listener.want_write = True
+                self.selector.modify(listener.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, listener)
+        elif listener.want_write:
+            listener.want_write = False
+            self.selector.modify(listener.conn, selectors.EVENT_READ, listener)
+
+    def _close(self, listener, said_bye):
+        conn = listener.conn
+        if self.listeners.pop(conn, None) is None:
+            return
+        listener.outbox.close()
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+        self.on_gone(listener.member, conn, said_bye)
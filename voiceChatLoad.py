@@ -0,0 +1,81 @@
+"""
+Server load levels for overload shedding.
+
+The reaper feeds LoadMonitor once a second with what it already walks
+(every member's outbox depth) and the fan-out's byte counter; the monitor
+turns CPU use, queue depth and forwarded bytes/s into a level:
+
+    NORMAL       forward everything
+    DEGRADED     forward cheaper: simulcast listeners get layer 1 or lower,
+                 RED copies are stripped
+    LISTEN_ONLY  also refuse new talk spurts and new members
+
+Levels go up as soon as one signal crosses its threshold and come down one
+step at a time, only after every signal has been below RECOVER_FRACTION of
+its threshold for RECOVER_HOLD seconds, so the server does not flap.
+"""
+import time
+
+NORMAL = 0
+DEGRADED = 1
+LISTEN_ONLY = 2
+LEVEL_NAMES = ("normal", "degraded", "listen-only")
+
+OVERLOAD_FACTOR = 1.5     # a signal this far over its threshold goes straight to LISTEN_ONLY
+RECOVER_FRACTION = 0.7
+RECOVER_HOLD = 10.0       # seconds
+
+
+class LoadMonitor:
+    """
+    cpu:         process CPU seconds per wall second (1.0 = one core busy, which
+                 under the GIL is about all a Python server gets); 0 disables
+    queue:       mean outbox depth in frames; 0 disables
+    forward_bps: forwarded bytes per second; 0 disables
+    """
+
+    def __init__(self, cpu=0.0, queue=0.0, forward_bps=0.0):
+        self.limits = {"cpu": cpu, "queue": queue, "forward_bps": forward_bps}
+        self.level = NORMAL
+        self.values = {"cpu": 0.0, "queue": 0.0, "forward_bps": 0.0}
+        self.calm_since = None
+        self.last_wall = time.monotonic()
+        self.last_cpu = time.process_time()
+        self.last_bytes = 0
+
+    def sample(self, depths, forwarded_bytes):
+        """
+        depths: outbox depth of every attached member; forwarded_bytes: the
+        fan-out's running total. Returns (level, changed).
+        """
+        now = time.monotonic()
+        cpu_now = time.process_time()
+        elapsed = max(now - self.last_wall, 1e-3)
+        values = self.values
+        values["cpu"] = (cpu_now - self.last_cpu) / elapsed
+        values["queue"] = sum(depths) / len(depths) if depths else 0.0
+        values["forward_bps"] = (forwarded_bytes - self.last_bytes) / elapsed
+        self.last_wall, self.last_cpu, self.last_bytes = now, cpu_now, forwarded_bytes
+
+        ratio = max((values[k] / limit for k, limit in self.limits.items() if limit), default=0.0)
+        old = self.level
+        if ratio >= OVERLOAD_FACTOR:
+            self.level = LISTEN_ONLY
+            self.calm_since = None
+        elif ratio >= 1.0:
+            self.level = max(self.level, DEGRADED)
+            self.calm_since = None
+        elif ratio < RECOVER_FRACTION and self.level > NORMAL:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= RECOVER_HOLD:
+                self.level -= 1
+                self.calm_since = now
+        else:
+            self.calm_since = None
+        return self.level, self.level != old
+
+    def stats_text(self):
+        v = self.values
+        return (f"load {LEVEL_NAMES[self.level]}: cpu {v['cpu'] * 100:.0f}%, "
+                f"queue {v['queue']:.1f} frames, forwarding {v['forward_bps'] * 8 / 1e6:.1f} Mbit/s")
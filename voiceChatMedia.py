@@ -0,0 +1,485 @@
+"""
+Client-side media path shared by the CLI and GUI clients.
+
+Every captured chunk becomes a MediaFrame: a monotonic sequence number, a
+sample-clock timestamp (samples captured since the mic opened) and the wall
+time the chunk was captured and sent. Receivers use seq to spot loss and
+reordering and sample_ts against their own arrival times to spot clock drift.
+
+With FEC negotiated, each frame also carries the previous frame at a quarter
+of the sample rate (RED). A single lost frame is rebuilt from the next one's
+redundant copy before it reaches the jitter buffer.
+
+With simulcast negotiated, each frame is also published at lower sample rates
+(LAYER_DECIMATION); the server picks one layer per listener and the receiver
+brings lower layers back to full rate with expand() before playback.
+
+With end-to-end encryption, pack_media seals the payload and RED copy
+(voiceChatE2E) and the header carries the frame's level in their stead.
+"""
+import array
+import math
+import queue
+import sys
+import threading
+import time
+from collections import deque
+
+from voiceChatLevels import pcm_level
+from voiceChatProtocol import FLAG_E2E, FLAG_RED, MEDIA_HEADER, MEDIA_VERSION, RED_LENGTH
+
+# Wall clock is re-anchored to the sample clock if they disagree by more than
+# this (mic overflow dropped samples, device restarted, ...).
+CLOCK_RESYNC_THRESHOLD = 0.5   # seconds
+SEND_QUEUE_MAX = 8             # frames; oldest dropped if the socket stalls
+LATENCY_WINDOW = 200           # frames kept for capture-to-send stats
+RED_DECIMATION = 4             # redundant copy keeps every 4th sample (~1/4 the bytes)
+LAYER_DECIMATION = (1, 2, 4)   # simulcast ladder: layer -> sample rate divisor
+CLOCK_WINDOW = 30              # PINGs kept for the server clock offset estimate
+
+
+class MediaFrame:
+    __slots__ = ("seq", "sample_ts", "capture_time", "send_time", "flags", "layer", "level",
+                 "payload", "redundant", "captured_at", "lower_layers", "received_at")
+
+    def __init__(self, seq, sample_ts, capture_time, payload, flags=0, layer=0,
+                 send_time=0.0, redundant=None, level=0):
+        self.seq = seq
+        self.sample_ts = sample_ts
+        self.capture_time = capture_time
+        self.send_time = send_time
+        self.flags = flags
+        self.layer = layer
+        self.level = level       # 0..100, in the header of sealed frames (voiceChatLevels)
+        self.payload = payload
+        self.redundant = redundant  # low-rate copy of frame seq-1 (RED), or None
+        self.captured_at = None  # local monotonic, never on the wire
+        self.lower_layers = ()   # simulcast payloads for layers 1.., sent as separate frames
+        self.received_at = None  # receiver's monotonic arrival time, never on the wire
+
+
+def pack_media(frame, seal=None):
+    """
+    seal(frame, block, data): end-to-end encryption of the payload (block 0)
+    and RED copy (block 1); returns None, and so do we, while it has no key.
+    """
+    flags = frame.flags & ~(FLAG_RED | FLAG_E2E)
+    payload, redundant = frame.payload, frame.redundant
+    if seal is not None:
+        flags |= FLAG_E2E
+        payload = seal(frame, 0, payload)
+        if payload is None:
+            return None
+        if redundant is not None:
+            redundant = seal(frame, 1, redundant)
+    body = payload
+    if redundant is not None:
+        flags |= FLAG_RED
+        body = RED_LENGTH.pack(len(payload)) + payload + redundant
+    return MEDIA_HEADER.pack(MEDIA_VERSION, flags, frame.layer, frame.level, frame.seq & 0xFFFFFFFF,
+                             frame.sample_ts, frame.capture_time, frame.send_time) + body
+
+
+def unpack_media(body):
+    """ Parse a MEDIA body; raises ValueError for an unknown version. Sealed blocks stay sealed. """
+    version, flags, layer, level, seq, sample_ts, capture_time, send_time = MEDIA_HEADER.unpack_from(body)
+    if version != MEDIA_VERSION:
+        raise ValueError(f"unsupported media version {version}")
+    payload = body[MEDIA_HEADER.size:]
+    redundant = None
+    if flags & FLAG_RED:
+        (primary_len,) = RED_LENGTH.unpack_from(payload)
+        redundant = payload[RED_LENGTH.size + primary_len:]
+        payload = payload[RED_LENGTH.size:RED_LENGTH.size + primary_len]
+    return MediaFrame(seq, sample_ts, capture_time, payload, flags, layer, send_time, redundant, level)
+
+
+def pcm_samples(pcm):
+    """ int16 little-endian PCM as an array('h') in native order. """
+    samples = array.array('h')
+    samples.frombytes(pcm)
+    if sys.byteorder != "little":
+        samples.byteswap()
+    return samples
+
+
+def pcm_rms(pcm):
+    samples = pcm_samples(pcm)
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(x * x for x in samples) / len(samples))
+
+
+def apply_gain(pcm, gain):
+    samples = pcm_samples(pcm)
+    out = array.array('h', (max(-32768, min(32767, int(x * gain))) for x in samples))
+    if sys.byteorder != "little":
+        out.byteswap()
+    return out.tobytes()
+
+
+def decimate(pcm, factor):
+    """ Keep every factor-th sample (no filtering: good enough to conceal a hole). """
+    samples = pcm_samples(pcm)[::factor]
+    if sys.byteorder != "little":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def expand(pcm, factor, nframes):
+    """ Undo decimate() by sample repetition, padded/truncated to nframes samples. """
+    src = pcm_samples(pcm)
+    out = array.array('h', bytes(2 * len(src) * factor))
+    for k in range(factor):
+        out[k::factor] = src
+    if len(out) < nframes:
+        out.extend(array.array('h', bytes(2 * (nframes - len(out)))))
+    del out[nframes:]
+    if sys.byteorder != "little":
+        out.byteswap()
+    return out.tobytes()
+
+
+def average_down(pcm, factor):
+    """ Downsample by averaging each run of factor samples (cheap low-pass, unlike decimate). """
+    if factor == 1:
+        return pcm
+    samples = pcm_samples(pcm)
+    n = len(samples) - len(samples) % factor
+    out = array.array('h', (sum(samples[i:i + factor]) // factor for i in range(0, n, factor)))
+    if sys.byteorder != "little":
+        out.byteswap()
+    return out.tobytes()
+
+
+def full_rate_payload(frame, nframes):
+    """ PCM at the full rate for any simulcast layer (layer 0 is returned as is). """
+    if frame.layer == 0 or frame.layer >= len(LAYER_DECIMATION):
+        return frame.payload
+    return expand(frame.payload, LAYER_DECIMATION[frame.layer], nframes)
+
+
+def recover_lost_frame(frame, gap, nframes):
+    """
+    Called with a frame that arrived after gap missing ones. Returns the PCM
+    to play for the missing frame just before it, if it can be rebuilt
+    (exactly one lost and frame carries RED), else None.
+    """
+    if gap != 1 or frame.redundant is None:
+        return None
+    return expand(frame.redundant, RED_DECIMATION, nframes)
+
+
+class CapturePipeline:
+    """
+    mic -> [capture] -> [process: gain / VAD / encode] -> [send] -> socket
+
+    Three threads joined by bounded queues, so a slow socket write never makes
+    us miss mic reads (overflow) and processing never delays the read.
+
+    read_chunk():  blocking read of one chunk of PCM from the device
+    send_body(b):  write one packed MEDIA body; raises OSError, also when there
+                   is no connection to write to (frame dropped), and nothing else
+    vad_threshold: RMS below which a chunk counts as silence; after
+                   vad_hangover silent chunks we stop sending until speech
+                   resumes (seq stays contiguous, sample_ts jumps: DTX, not loss)
+    encoder:       optional bytes -> bytes, e.g. a codec
+    clock:         wall clock for the stamps; ServerClock.now puts them on the
+                   server's clock so receivers can split out network delay
+    dsp:           optional (pcm, start) -> pcm run first on the process thread,
+                   start being the monotonic time of the chunk's first sample
+                   (voiceChatDsp.DspChain.process: echo cancel / denoise / AGC)
+    redundancy:    attach a RED copy of the previous frame (set it once the
+                   server has acknowledged "CAPS:fec=red")
+    layers:        simulcast layers to publish (set from "CAPS_OK:layers=<n>");
+                   lower layers go out as extra frames right after the full one
+    seal:          end-to-end encryption, see pack_media (set for E2E); frames
+                   are dropped while it has no key, never sent in the clear
+    log:           where the pipeline's own notes go
+    """
+
+    def __init__(self, read_chunk, send_body, frames_per_chunk, rate,
+                 gain=1.0, vad_threshold=None, vad_hangover=5, encoder=None, dsp=None,
+                 clock=time.time, log=print):
+        self.read_chunk = read_chunk
+        self.send_body = send_body
+        self.frames_per_chunk = frames_per_chunk
+        self.rate = rate
+        self.gain = gain
+        self.vad_threshold = vad_threshold
+        self.vad_hangover = vad_hangover
+        self.encoder = encoder
+        self.dsp = dsp
+        self.clock = clock
+        self.log = log
+        self.redundancy = False
+        self.previous_red = None
+        self.layers = 1
+        self.seal = None
+
+        self.process_queue = queue.Queue(maxsize=SEND_QUEUE_MAX)
+        self.send_queue = queue.Queue(maxsize=SEND_QUEUE_MAX)
+        self.stopped = threading.Event()
+        self.threads = []
+
+        self.seq = 0
+        self.sample_ts = 0
+        self.clock_base = None
+        self.silent_run = 0
+
+        self.frames_captured = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.frames_suppressed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # capture -> socket write, seconds
+
+    def start(self):
+        for target in (self._capture_loop, self._process_loop, self._send_loop):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        # unblock the stages waiting on empty queues
+        for q in (self.process_queue, self.send_queue):
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _offer(self, q, item):
+        """ Put without blocking; drop the oldest queued frame if full. """
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                    self.frames_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _capture_loop(self):
+        while not self.stopped.is_set():
+            try:
+                pcm = self.read_chunk()
+            except Exception:
+                break
+            if not pcm:
+                continue
+            now = self.clock()
+            nframes = len(pcm) // 2
+            # the chunk's first sample was captured nframes/rate before now
+            expected = None if self.clock_base is None else self.clock_base + self.sample_ts / self.rate
+            actual = now - nframes / self.rate
+            if expected is None or abs(actual - expected) > CLOCK_RESYNC_THRESHOLD:
+                self.clock_base = actual - self.sample_ts / self.rate
+                expected = actual
+            frame = MediaFrame(0, self.sample_ts, expected, pcm)
+            frame.captured_at = time.monotonic()
+            self.sample_ts += nframes
+            self.frames_captured += 1
+            self._offer(self.process_queue, frame)
+        self.stop()
+        self.log("[CapturePipeline] capture ended.")
+
+    def _process_loop(self):
+        while not self.stopped.is_set():
+            frame = self.process_queue.get()
+            if frame is None:
+                break
+            if self.dsp is not None:
+                start = frame.captured_at - len(frame.payload) / 2 / self.rate
+                frame.payload = self.dsp(frame.payload, start)
+            if self.gain != 1.0:
+                frame.payload = apply_gain(frame.payload, self.gain)
+            if self.vad_threshold is not None:
+                if pcm_rms(frame.payload) < self.vad_threshold:
+                    self.silent_run += 1
+                    if self.silent_run > self.vad_hangover:
+                        self.frames_suppressed += 1
+                        self.previous_red = None
+                        continue
+                else:
+                    self.silent_run = 0
+            red_source = frame.payload
+            if self.seal is not None:
+                frame.level = pcm_level(red_source)[0]  # the server cannot measure a sealed frame
+            if self.layers > 1:
+                frame.lower_layers = tuple(average_down(red_source, factor)
+                                           for factor in LAYER_DECIMATION[1:self.layers])
+            if self.encoder is not None:
+                frame.payload = self.encoder(frame.payload)
+            if self.redundancy:
+                frame.redundant = self.previous_red
+                self.previous_red = decimate(red_source, RED_DECIMATION)
+            frame.seq = self.seq
+            self.seq += 1
+            self._offer(self.send_queue, frame)
+
+    def _send_loop(self):
+        while not self.stopped.is_set():
+            frame = self.send_queue.get()
+            if frame is None:
+                break
+            frame.send_time = self.clock()
+            seal = self.seal
+            body = pack_media(frame, seal)
+            if body is None:
+                self.frames_dropped += 1  # no room key yet
+                continue
+            try:
+                self.send_body(body)
+                for layer, payload in enumerate(frame.lower_layers, 1):
+                    body = pack_media(MediaFrame(frame.seq, frame.sample_ts, frame.capture_time,
+                                                 payload, layer=layer, send_time=frame.send_time,
+                                                 level=frame.level), seal)
+                    if body is not None:  # the room key went away since layer 0 was sealed
+                        self.send_body(body)
+            except OSError:
+                self.frames_dropped += 1  # link down; we come back in real time
+                continue
+            self.frames_sent += 1
+            self.latencies.append(time.monotonic() - frame.captured_at)
+
+    def latency_stats(self):
+        """ (avg, p95, max) capture-to-send latency in ms over the recent window. """
+        values = sorted(self.latencies)
+        if not values:
+            return 0.0, 0.0, 0.0
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        return (sum(values) / len(values) * 1000.0, p95 * 1000.0, values[-1] * 1000.0)
+
+    def stats_text(self):
+        avg, p95, worst = self.latency_stats()
+        return (f"capture->send avg {avg:.1f} ms, p95 {p95:.1f} ms, max {worst:.1f} ms; "
+                f"captured {self.frames_captured}, sent {self.frames_sent}, "
+                f"dropped {self.frames_dropped}, silent {self.frames_suppressed}")
+
+
+class ServerClock:
+    """
+    Our estimate of the server's wall clock, from its "PING:<ms>" stamps.
+    local - server over recent PINGs is clock offset plus downlink delay;
+    the minimum is the best estimate of the offset. Senders stamp frames and
+    receivers time arrivals with now(), so per-hop delays make sense across
+    machines whose clocks disagree (to within the one-way delay asymmetry).
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_WINDOW)
+        self.offset = 0.0
+
+    def update(self, server_ms):
+        self.samples.append(time.time() - server_ms / 1000.0)
+        self.offset = min(self.samples)
+
+    def now(self):
+        return time.time() - self.offset
+
+
+class LatencyBreakdown:
+    """
+    Mouth-to-ear delay of one remote speaker, split by stage (recent averages):
+      capture  - chunk buffering at the sender (first sample waits a whole chunk)
+      send     - sender processing and send queue (send_time - end of chunk)
+      network  - send_time to our socket reader, server fan-out included
+      jitter   - our inbox, demux and jitter buffer, until playback starts writing it
+      device   - output device buffering (PyAudio's reported output latency)
+    The sender's input device latency is not visible from here and is not included.
+    """
+    STAGES = ("capture", "send", "network", "jitter", "device")
+
+    def __init__(self, rate, window=LATENCY_WINDOW):
+        self.rate = rate
+        self.values = {stage: deque(maxlen=window) for stage in self.STAGES}
+
+    def on_arrival(self, frame, arrival, nframes):
+        """ frame: MediaFrame of nframes samples; arrival on the same clock as its stamps. """
+        chunk = nframes / self.rate
+        self.values["capture"].append(chunk)
+        self.values["send"].append(max(0.0, frame.send_time - frame.capture_time - chunk))
+        self.values["network"].append(max(0.0, arrival - frame.send_time))
+
+    def on_playout(self, waited, device_latency):
+        self.values["jitter"].append(waited)
+        self.values["device"].append(device_latency)
+
+    def averages(self):
+        return {stage: (sum(v) / len(v) if v else 0.0) for stage, v in self.values.items()}
+
+    def total(self):
+        return sum(self.averages().values())
+
+    def stats_text(self):
+        avg = self.averages()
+        parts = ", ".join(f"{stage} {avg[stage] * 1000:.0f}" for stage in self.STAGES)
+        return f"mouth-to-ear ~{sum(avg.values()) * 1000:.0f} ms ({parts} ms)"
+
+
+class SequenceTracker:
+    """
+    Per remote speaker: counts lost, reordered and duplicate frames from seq,
+    and estimates drift between the sender's sample clock and our arrival clock.
+    """
+    __slots__ = ("rate", "expected", "received", "lost", "reordered", "duplicates",
+                 "first_ts", "first_arrival", "min_offset", "offset")
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.expected = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.first_ts = None
+        self.first_arrival = None
+        self.min_offset = None
+        self.offset = 0.0
+
+    def update(self, frame, arrival=None):
+        """
+        Account for frame. Returns the number of frames missing right before it
+        (0 if in order, negative if it is late/reordered).
+        """
+        arrival = time.monotonic() if arrival is None else arrival
+        self.received += 1
+        if self.first_ts is None:
+            self.first_ts = frame.sample_ts
+            self.first_arrival = arrival
+        # arrival time minus media time: grows if the sender's clock runs slow
+        self.offset = (arrival - self.first_arrival) - (frame.sample_ts - self.first_ts) / self.rate
+        if self.min_offset is None or self.offset < self.min_offset:
+            self.min_offset = self.offset
+
+        if self.expected is None:
+            self.expected = (frame.seq + 1) & 0xFFFFFFFF
+            return 0
+        gap = (frame.seq - self.expected) & 0xFFFFFFFF
+        if gap == 0:
+            self.expected = (frame.seq + 1) & 0xFFFFFFFF
+            return 0
+        if gap < 0x80000000:
+            self.lost += gap
+            self.expected = (frame.seq + 1) & 0xFFFFFFFF
+            return gap
+        # behind expected: late arrival of a frame we counted lost, or a duplicate
+        if self.lost > 0:
+            self.lost -= 1
+            self.reordered += 1
+        else:
+            self.duplicates += 1
+        return -1
+
+    def drift_ms(self):
+        """ Current arrival offset above the best seen (queueing + clock drift). """
+        if self.min_offset is None:
+            return 0.0
+        return (self.offset - self.min_offset) * 1000.0
+
+    def stats_text(self):
+        return (f"received {self.received}, lost {self.lost}, reordered {self.reordered}, "
+                f"dup {self.duplicates}, drift {self.drift_ms():.0f} ms")
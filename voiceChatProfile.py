@@ -0,0 +1,213 @@
+"""
+Opt-in instrumentation for the server's hot path.
+
+    VOICECHAT_PROFILE=1 python newServer.py
+
+turns on per-stage timers (recv -> parse -> fan-out -> taps, outbox send,
+room commands, reaper), lock wait times for the room registry and the
+outboxes, and two signals:
+
+    kill -USR1 <pid>   start / stop the sampling profiler; on stop the
+                       collapsed stacks go to PROFILE_DIR (flamegraph.pl,
+                       speedscope, ...)
+    kill -USR2 <pid>   print the histograms and save them to PROFILE_DIR
+
+Disabled, the cost is one module attribute check per frame: callers test
+profile.enabled before reading the clock, and locks are plain threading locks.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+enabled = False
+PROFILE_DIR = "profiles"
+SAMPLE_INTERVAL = 0.005       # seconds between stack samples
+HISTOGRAM_BUCKETS = 24        # powers of two from 1 us up to ~8 s
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_sampler = None
+
+
+class Histogram:
+    """ Log2 buckets of microseconds, plus count / total / max. """
+    __slots__ = ("name", "buckets", "count", "total", "max", "lock")
+
+    def __init__(self, name):
+        self.name = name
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        idx = min(HISTOGRAM_BUCKETS - 1, int(seconds * 1e6).bit_length())
+        with self.lock:
+            self.buckets[idx] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, pct):
+        """ Upper bound (seconds) of the bucket holding the pct-th percentile. """
+        target = self.count * pct / 100.0
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << idx) / 1e6
+        return 0.0
+
+    def summary(self):
+        if not self.count:
+            return f"{self.name:<18} (no samples)"
+        return (f"{self.name:<18} n={self.count:<9} avg={self.total / self.count * 1e6:9.1f}us "
+                f"p50<={self.percentile(50) * 1e6:8.0f}us p99<={self.percentile(99) * 1e6:8.0f}us "
+                f"max={self.max * 1e6:9.0f}us total={self.total:8.2f}s")
+
+
+def histogram(name):
+    h = _histograms.get(name)
+    if h is None:
+        with _histograms_lock:
+            h = _histograms.setdefault(name, Histogram(name))
+    return h
+
+
+def record(name, seconds):
+    histogram(name).add(seconds)
+
+
+class TimedLock:
+    """ threading.Lock that records how long blocking acquires waited. """
+    __slots__ = ("lock", "wait")
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.wait = histogram("lock:" + name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.wait.add(0.0)
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        got = self.lock.acquire(True, timeout)
+        self.wait.add(time.perf_counter() - t0)
+        return got
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def new_lock(name):
+    """ Lock for a hot structure; timed only if profiling was enabled first. """
+    return TimedLock(name) if enabled else threading.Lock()
+
+
+class TimedCall:
+    """ Wraps e.g. conn.recv and accumulates the time spent inside it. """
+    __slots__ = ("func", "elapsed")
+
+    def __init__(self, func):
+        self.func = func
+        self.elapsed = 0.0
+
+    def __call__(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return self.func(*args)
+        finally:
+            self.elapsed += time.perf_counter() - t0
+
+
+class StackSampler:
+    """ Samples every thread's stack; counts collapsed stacks "a;b;c". """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.started = time.time()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})"
+                         for fs in traceback.extract_stack(frame)]
+                self.stacks[names.get(ident, str(ident)) + ";" + ";".join(stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, time.strftime("stacks-%Y%m%d-%H%M%S.folded"))
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def toggle_sampler(*_):
+    global _sampler
+    if _sampler is None:
+        _sampler = StackSampler().start()
+        print(f"[Profile] sampling every {SAMPLE_INTERVAL * 1000:.0f} ms")
+    else:
+        sampler, _sampler = _sampler, None
+        path = sampler.stop()
+        print(f"[Profile] {sampler.samples} samples over {time.time() - sampler.started:.1f}s -> {path}")
+
+
+def report():
+    with _histograms_lock:
+        hists = sorted(_histograms.values(), key=lambda h: h.name)
+    return "\n".join(h.summary() for h in hists)
+
+
+def dump(*_):
+    text = report()
+    print("[Profile] stage and lock timings:\n" + text)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, time.strftime("histograms-%Y%m%d-%H%M%S.txt"))
+    with open(path, "w") as f:
+        f.write(text + "\n")
+
+
+def enable(directory=None):
+    """ Turn instrumentation on; call before creating the structures to time. """
+    global enabled, PROFILE_DIR
+    enabled = True
+    if directory:
+        PROFILE_DIR = directory
+    if hasattr(signal, "SIGUSR1"):  # not on Windows
+        signal.signal(signal.SIGUSR1, toggle_sampler)
+        signal.signal(signal.SIGUSR2, dump)
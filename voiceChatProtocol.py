@@ -0,0 +1,342 @@
+"""
+Wire helpers shared by the server and the clients.
+
+Text messages are newline-terminated UTF-8 lines ("NEW:<room>", "ID:<id>", ...).
+Server -> client audio is "DATA:<client_id>:<length>\\n" followed by <length> bytes.
+Client -> server audio is "AUDIO:<length>\\n" followed by <length> bytes, so that
+commands sent mid-call ("SWITCH:<room>", "LEAVE", ...) can never be mistaken
+for (or glued onto) a chunk of PCM. Older clients that stream bare PCM still
+work through the legacy path in ClientStreamReader.read_message.
+
+Clients that stamp their audio send "MEDIA:<length>\\n" instead; the body starts
+with MEDIA_HEADER (sequence number, sample-clock timestamp, capture and send
+wall time, see voiceChatMedia) and the server forwards it untouched as
+"MEDIA:<client_id>:<length>\\n".
+
+Forward error correction (RED): a client that sent "CAPS:fec=red" (answered
+with "CAPS_OK:fec=red") may set FLAG_RED; the body after the header is then
+<primary length:u16><primary><low-rate copy of the previous frame>. Listeners
+that did not negotiate FEC get the frame with the redundant block stripped.
+
+Simulcast: a client that sent "CAPS:layers=<n>" (answered "CAPS_OK:layers=<n>")
+sends every capture n times, as layer 0 (full rate) up to layer n-1 (cheapest,
+see voiceChatMedia.LAYER_DECIMATION), all with the same seq and timestamps. The
+server forwards exactly one layer per listener: layer 0 to listeners that did
+not negotiate layers, otherwise whichever its downlink currently sustains.
+
+With TLS on (voiceChatTls) all of this runs unchanged inside the TLS stream.
+
+The server sends "PING:<ms>" every few seconds; clients answer "PONG:<ms>".
+
+After joining, the server hands out "TOKEN:<token>". A client whose connection
+drops reconnects and sends "RESUME:<token>" as its first line; within the
+server's grace window it gets "Resumed room: <room>" and keeps its old id,
+otherwise "RESUME_FAILED" and it has to join again.
+
+Requests: any command may be sent as "RQ:<id>:<command>". The server then
+answers exactly as it would the bare command and follows that with
+"RE:<id>:OK:<detail>" or "RE:<id>:ERR:<message>" on the same path (so after
+the reply proper), letting a client match answers to commands instead of
+guessing from the next line it reads. <detail> is the room for joins and
+leaves, the accepted caps for CAPS, empty otherwise. Untagged commands get no
+RE line, so older clients see no difference.
+
+End-to-end encryption (voiceChatE2E): clients exchange a room key through
+"E2E_PUB:" / "E2E_KEY:" lines the server only relays, and send MEDIA with
+FLAG_E2E, the payload and RED copy sealed and the sender's level in the
+header. The server forwards those frames untouched, only to members that
+sent "E2E_PUB:", and tells the room "E2E_GONE:<id>" when a member goes.
+
+Listeners: "LISTEN:<room>" instead of the room name joins an existing room
+listen-only for the whole session (the server has no receive loop for it,
+only a shared write path); it gets audio like anyone else and may send
+commands, but its audio is never forwarded.
+
+Speaking indicators: the server measures every sender's level (0..100,
+voiceChatLevels) and sends the room "SPEAKING:<client_id>:<level>" at a
+limited rate while it talks, and a final level 0 when it stops.
+
+Restarts (voiceChatDrain): a draining server may send "RECONNECT:<ms>" or
+"REDIRECT:<host>:<port>:<ms>". The client then opens a connection (to the
+same address, or host:port) after <ms>, resumes its session there with
+"RESUME:<token>", and only then drops the old one. A RESUME_FAILED there
+means joining the room again, as after an expired session.
+
+Admission: a server at its connection or member limit (or shedding load)
+answers "SERVER_BUSY:<reason>" and closes the connection; joining a room that
+is at its member limit gets "ROOM_FULL:<room>" and leaves the client where it
+was. Audio sent while the room is at its speaker limit, or the server is in
+listen-only shedding, is not forwarded; the sender hears about it once per
+talk spurt with "LISTEN_ONLY:<reason>".
+"""
+import random
+import socket
+import struct
+import time
+
+AUDIO = "audio"
+MEDIA = "media"
+COMMAND = "command"
+
+# line tags a client may send once it is in a room
+CLIENT_COMMAND_TAGS = (b"REQ:", b"NEW:", b"SWITCH:", b"LEAVE", b"BYE", b"PONG:", b"CAPS:", b"RQ:",
+                       b"E2E_PUB:", b"E2E_KEY:")
+AUDIO_TAG = b"AUDIO:"
+MEDIA_TAG = b"MEDIA:"
+_ALL_TAGS = (AUDIO_TAG, MEDIA_TAG) + CLIENT_COMMAND_TAGS
+# only clients that end every line with "\n" send these
+_FRAMED_TAGS = (AUDIO_TAG, MEDIA_TAG, b"RQ:")
+
+# version, flags, layer, level, seq, sample_ts, capture_time, send_time
+# (level: the sender's own 0..100 measure, set on FLAG_E2E frames, else 0)
+MEDIA_HEADER = struct.Struct("!BBBBIQdd")
+MEDIA_VERSION = 1
+FLAG_RED = 0x01       # body carries a redundant copy of the previous frame
+FLAG_E2E = 0x02       # payload (and RED copy) sealed end to end, see voiceChatE2E
+RED_LENGTH = struct.Struct("!H")
+MAX_LAYERS = 3        # simulcast layers a client may publish
+
+# The server PINGs every few seconds; a client that hears nothing at all for
+# this long treats the connection as dead and reconnects.
+SERVER_IDLE_TIMEOUT = 20.0
+
+RECONNECT_INITIAL_DELAY = 0.2   # seconds
+RECONNECT_MAX_DELAY = 5.0
+RECONNECT_GIVE_UP = 60.0        # stop retrying after this long
+
+# bare-PCM clients: anything shorter than this that decodes as text is a command
+LEGACY_COMMAND_MAX = 300
+
+
+def encode_line(text):
+    return (text + "\n").encode('utf-8')
+
+
+def encode_audio(payload):
+    """ Client -> server audio frame. """
+    return f"AUDIO:{len(payload)}\n".encode('utf-8') + payload
+
+
+def encode_media(body):
+    """ Client -> server stamped frame (MEDIA_HEADER + payload). """
+    return f"MEDIA:{len(body)}\n".encode('utf-8') + body
+
+
+def encode_request(request_id, command):
+    return encode_line(f"RQ:{request_id}:{command}")
+
+
+def split_request(line):
+    """ "RQ:<id>:<command>" -> (id, command); any other line -> (None, line). """
+    if line.startswith("RQ:"):
+        parts = line.split(":", 2)
+        if len(parts) == 3 and parts[1].isdigit():
+            return int(parts[1]), parts[2].strip()
+    return None, line
+
+
+def encode_response(request_id, ok, detail=""):
+    return encode_line(f"RE:{request_id}:{'OK' if ok else 'ERR'}:{detail}")
+
+
+def parse_response(text):
+    """ "RE:<id>:OK:<detail>" -> (id, True, detail); None if text is not a response. """
+    parts = text.split(":", 3)
+    if len(parts) < 3 or parts[0] != "RE" or not parts[1].isdigit():
+        return None
+    return int(parts[1]), parts[2] == "OK", parts[3] if len(parts) > 3 else ""
+
+
+def parse_caps(text):
+    """ "fec=red,foo=bar" -> {"fec": "red", "foo": "bar"} """
+    caps = {}
+    for item in text.split(","):
+        key, _, value = item.partition("=")
+        if key.strip():
+            caps[key.strip()] = value.strip()
+    return caps
+
+
+def strip_redundancy(body):
+    """ MEDIA body without its RED block, for listeners that did not ask for FEC. """
+    if len(body) <= MEDIA_HEADER.size or not body[1] & FLAG_RED:
+        return body
+    (primary_len,) = RED_LENGTH.unpack_from(body, MEDIA_HEADER.size)
+    start = MEDIA_HEADER.size + RED_LENGTH.size
+    return body[:1] + bytes((body[1] & ~FLAG_RED,)) + body[2:MEDIA_HEADER.size] + body[start:start + primary_len]
+
+
+def reconnect_with_backoff(host, port, token, should_stop=lambda: False, log=print, wrap=None):
+    """
+    Open a new connection and pipeline "RESUME:<token>" (or nothing if we never
+    got a token). Retries with exponential backoff plus jitter, so a room full
+    of clients behind the same flaky AP does not retry in lockstep.
+    wrap(sock) -> sock runs on each new connection first (TLS handshake).
+    Returns the connected socket, or None if should_stop() or we gave up.
+    """
+    delay = RECONNECT_INITIAL_DELAY
+    deadline = time.monotonic() + RECONNECT_GIVE_UP
+    attempt = 0
+    while not should_stop() and time.monotonic() < deadline:
+        attempt += 1
+        try:
+            sock = socket.create_connection((host, port), timeout=RECONNECT_MAX_DELAY)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if wrap is not None:
+                sock = wrap(sock)
+            if token:
+                sock.sendall(encode_line(f"RESUME:{token}"))
+            log(f"Reconnected after {attempt} attempt(s).")
+            return sock
+        except OSError as e:
+            log(f"Reconnect attempt {attempt} failed: {e}")
+        time.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+    return None
+
+
+class LineReader:
+    """
+    Buffered line reader over a blocking socket.
+
+    Several newline-terminated lines arriving in one packet are split apart,
+    so a client may pipeline "NEW:<room>\\n" right after connect() without
+    waiting for the welcome. Older clients send one bare command per send()
+    with no newline; a packet with no newline that arrives on an empty buffer
+    is taken as one whole line for them. Once the connection has sent a
+    newline-terminated line or an AUDIO:/MEDIA:/RQ: frame it is framed, and
+    a line split across TCP segments is always waited for up to its "\n".
+    """
+
+    def __init__(self, conn, bufsize=4096):
+        self.conn = conn
+        self.recv = conn.recv  # may be wrapped, e.g. to time it (voiceChatProfile.TimedCall)
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+        self.framed = False
+
+    def legacy_packet(self):
+        """ True if the buffer is a whole bare command from an unframed (legacy) client. """
+        if self.framed or self.buffer.startswith(_FRAMED_TAGS):
+            self.framed = True
+            return False
+        return b"\n" not in self.buffer
+
+    def pending(self):
+        """ True if a complete line is already buffered (no recv needed). """
+        return b"\n" in self.buffer
+
+    def read_line(self):
+        """
+        Return the next line (decoded, stripped), or None on disconnect.
+        socket.timeout from the underlying recv is passed through.
+        """
+        while True:
+            idx = self.buffer.find(b"\n")
+            if idx >= 0:
+                line = bytes(self.buffer[:idx])
+                del self.buffer[:idx + 1]
+                self.framed = True
+                return line.decode('utf-8', errors='replace').strip()
+
+            was_empty = not self.buffer
+            data = self.recv(self.bufsize)
+            if not data:
+                return None
+            self.buffer += data
+            if was_empty and self.legacy_packet():
+                # legacy client: one bare command per packet
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line.decode('utf-8', errors='replace').strip()
+
+    def take_buffer(self):
+        """ Hand over whatever was read past the last line (e.g. early audio). """
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ClientStreamReader(LineReader):
+    """
+    Server-side reader for an in-room connection: yields whole audio frames
+    and command lines, whatever the TCP segmentation was.
+    """
+
+    def read_exact(self, n):
+        """ Return exactly n bytes, or None on disconnect. """
+        while len(self.buffer) < n:
+            data = self.recv(max(self.bufsize, n - len(self.buffer)))
+            if not data:
+                return None
+            self.buffer += data
+        chunk = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return chunk
+
+    def read_command(self):
+        """
+        The next line, skipping AUDIO:/MEDIA: frames by their length: a client
+        in the lobby may still be sending audio, e.g. after RESUME_FAILED.
+        None on disconnect.
+        """
+        while True:
+            line = self.read_line()
+            if line is None or not line.startswith(("AUDIO:", "MEDIA:")):
+                return line
+            try:
+                length = int(line.split(":", 1)[1])
+            except ValueError:
+                continue
+            if self.read_exact(length) is None:
+                return None
+
+    def read_message(self):
+        """
+        Return (AUDIO, bytes), (MEDIA, bytes) or (COMMAND, str);
+        (None, None) on disconnect.
+        """
+        while True:
+            if not self.buffer:
+                data = self.recv(self.bufsize)
+                if not data:
+                    return None, None
+                self.buffer += data
+
+            head = bytes(self.buffer[:8])
+            if any(tag.startswith(head) for tag in _ALL_TAGS if len(head) < len(tag)):
+                # only a piece of a tag so far ("AUD"), wait for the rest
+                data = self.recv(self.bufsize)
+                if not data:
+                    return None, None
+                self.buffer += data
+                continue
+
+            if self.buffer.startswith(AUDIO_TAG) or self.buffer.startswith(MEDIA_TAG):
+                kind = AUDIO if self.buffer.startswith(AUDIO_TAG) else MEDIA
+                line = self.read_line()
+                if line is None:
+                    return None, None
+                payload = self.read_exact(int(line.split(":", 1)[1]))
+                if payload is None:
+                    return None, None
+                return kind, payload
+
+            if self.buffer.startswith(CLIENT_COMMAND_TAGS):
+                if self.legacy_packet():
+                    # legacy client: the whole packet is the command
+                    return COMMAND, self.take_buffer().decode('utf-8', errors='replace').strip()
+                line = self.read_line()
+                if line is None:
+                    return None, None
+                return COMMAND, line
+
+            # legacy client: bare PCM, with short decodable packets being commands
+            data = self.take_buffer()
+            if len(data) < LEGACY_COMMAND_MAX:
+                try:
+                    return COMMAND, data.decode('utf-8').strip()
+                except UnicodeDecodeError:
+                    pass
+            return AUDIO, data
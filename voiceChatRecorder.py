@@ -0,0 +1,265 @@
+"""
+Server-side room recorder.
+
+Rooms are opted in by name (or "*" for all). The server's fan-out hands every
+forwarded frame to RoomRecorder.offer, which only appends to a bounded queue;
+a background thread does all parsing, compression and disk I/O in batches,
+so a slow disk can cost us recorded frames but never delays forwarding.
+
+Layout, one directory per recording session of a room:
+
+    <dir>/<room>/<YYYYmmdd-HHMMSS>/    <room> as safe_name() writes it
+        meta.json                      sample format and rate per speaker, room, start time
+        speaker-<id>-<chunk>.pcm.gz    s16le mono PCM, a new chunk every CHUNK_SECONDS
+        index.tsv                      one line per frame, see INDEX_COLUMNS
+
+Clients capture at different rates (their rate setting). Each one tells the
+server its rate in CAPS ("rate=<Hz>"), which hands it to set_rate(); a
+speaker's rate goes into meta.json's speaker_rates when its first chunk is
+opened. Speakers that never said (older clients) are at meta.json's rate,
+the recorder's default.
+
+Only the primary full-rate layer of MEDIA frames is kept (no RED copies, no
+simulcast layers). Bare AUDIO frames carry no stamps, so the server's arrival
+time stands in for the capture time and seq counts frames per speaker.
+
+Open chunks are flushed every SYNC_INTERVAL. If the server dies, the last
+chunk of each speaker has no gzip trailer; zlib.decompressobj(31) still reads it.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from voiceChatProtocol import FLAG_E2E, MEDIA, MEDIA_HEADER, MEDIA_VERSION, strip_redundancy
+
+RECORD_RATE = 44100            # what a client that does not send its rate captures at
+RECORD_QUEUE_MAX = 4096        # frames waiting for the writer; oldest dropped beyond
+FLUSH_INTERVAL = 0.5           # seconds between writer batches
+CHUNK_SECONDS = 60.0           # start a new .pcm.gz per speaker after this much wall time
+SYNC_INTERVAL = 5.0            # flush compressed data to disk; at most this much is lost on a crash
+SPEAKER_IDLE_CLOSE = 30.0      # close a speaker's chunk after this long without audio
+SESSION_IDLE_CLOSE = 120.0     # a room silent this long gets a new session directory next time
+GZIP_LEVEL = 5
+INDEX_COLUMNS = ("arrival", "speaker", "seq", "sample_ts", "capture_time", "file", "offset", "length")
+
+
+def safe_name(name):
+    """
+    Room names come from clients; keep them from escaping the directory.
+    A name that had to be changed gets a hash of the original, so "a b" and
+    "a/b" do not share "a_b".
+    """
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", name).strip(".") or "_"
+    if safe != name:
+        safe += "-" + hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+    return safe
+
+
+class SpeakerTrack:
+    __slots__ = ("speaker", "chunk", "file", "name", "offset", "opened_at", "last_frame", "seq")
+
+    def __init__(self, speaker):
+        self.speaker = speaker
+        self.chunk = 0
+        self.file = None
+        self.name = None
+        self.offset = 0
+        self.opened_at = 0.0
+        self.last_frame = 0.0
+        self.seq = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RoomSession:
+    """ Open files of one room's current recording. """
+
+    def __init__(self, base_dir, room, rate=RECORD_RATE):
+        self.room = room
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(base_dir, safe_name(room), stamp)
+        os.makedirs(self.path, exist_ok=True)
+        self.meta = {"room": room, "started": time.time(), "format": "s16le",
+                     "rate": rate, "speaker_rates": {}, "channels": 1, "chunk_seconds": CHUNK_SECONDS,
+                     "index_columns": INDEX_COLUMNS}
+        self.write_meta()
+        self.index = open(os.path.join(self.path, "index.tsv"), "a", buffering=1 << 16)
+        self.index.write("\t".join(INDEX_COLUMNS) + "\n")
+        self.tracks = {}
+        self.last_frame = time.monotonic()
+
+    def write_meta(self):
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=1)
+
+    def write(self, speaker, arrival, payload, seq, sample_ts, capture_time, rate):
+        now = time.monotonic()
+        track = self.tracks.get(speaker)
+        if track is None:
+            track = self.tracks[speaker] = SpeakerTrack(speaker)
+            self.meta["speaker_rates"][str(speaker)] = rate
+            self.write_meta()
+        if track.file is not None and now - track.opened_at > CHUNK_SECONDS:
+            track.close()
+            track.chunk += 1
+        if track.file is None:
+            track.name = f"speaker-{speaker}-{track.chunk:04d}.pcm.gz"
+            track.file = gzip.open(os.path.join(self.path, track.name), "ab", compresslevel=GZIP_LEVEL)
+            track.offset = 0
+            track.opened_at = now
+        if seq is None:
+            seq = track.seq
+        track.seq = seq + 1
+        track.file.write(payload)
+        self.index.write(f"{arrival:.6f}\t{speaker}\t{seq}\t{sample_ts}\t{capture_time:.6f}\t"
+                         f"{track.name}\t{track.offset}\t{len(payload)}\n")
+        track.offset += len(payload)
+        track.last_frame = now
+        self.last_frame = now
+
+    def close_idle_tracks(self, now):
+        for track in self.tracks.values():
+            if track.file is not None and now - track.last_frame > SPEAKER_IDLE_CLOSE:
+                track.close()
+                track.chunk += 1
+
+    def flush(self):
+        for track in self.tracks.values():
+            if track.file is not None:
+                track.file.flush()
+        self.index.flush()
+
+    def close(self):
+        for track in self.tracks.values():
+            track.close()
+        self.index.close()
+
+
+class RoomRecorder:
+    """
+    rooms: names to record, or {"*"} for every room; enable()/disable() at runtime.
+    rate: what speakers that never called set_rate() capture at.
+    offer() is the media tap: O(1), never blocks, never raises.
+    """
+
+    def __init__(self, base_dir, rooms=(), rate=RECORD_RATE, log=print):
+        self.base_dir = base_dir
+        self.log = log
+        self.rooms = set(rooms)
+        self.rate = rate
+        self.rates = {}          # speaker id -> its capture rate, from its CAPS
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.sessions = {}       # room -> RoomSession (writer thread only)
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.bytes_written = 0
+        self.last_sync = time.monotonic()
+        self.thread = None
+
+    def enable(self, room):
+        self.rooms.add(room)
+
+    def disable(self, room):
+        self.rooms.discard(room)
+
+    def set_rate(self, speaker, rate):
+        self.rates[speaker] = rate
+
+    def recording(self, room):
+        return room in self.rooms or "*" in self.rooms
+
+    def offer(self, room, speaker, kind, data):
+        if not self.recording(room):
+            return
+        if len(self.queue) >= RECORD_QUEUE_MAX:
+            try:
+                self.queue.popleft()
+                self.frames_dropped += 1
+            except IndexError:
+                pass
+        # deque append/popleft are atomic, no lock needed against the writer
+        self.queue.append((time.time(), room, speaker, kind, data))
+        if len(self.queue) > RECORD_QUEUE_MAX // 2:
+            self.wakeup.set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _writer(self):
+        while True:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            try:
+                for item in batch:
+                    self._write_frame(*item)
+                self._housekeeping()
+            except OSError as e:
+                # disk full, permissions, ...: lose this batch, keep serving
+                self.frames_dropped += len(batch)
+                self.log(f"[Recorder] write failed: {e}")
+            if self.stopped:
+                for session in self.sessions.values():
+                    session.close()
+                self.sessions.clear()
+                return
+
+    def _write_frame(self, arrival, room, speaker, kind, data):
+        seq = None
+        sample_ts = ""
+        capture_time = arrival
+        if kind == MEDIA:
+            if len(data) < MEDIA_HEADER.size or data[0] != MEDIA_VERSION or data[2] != 0:
+                return  # unknown version, or a lower simulcast layer
+            if data[1] & FLAG_E2E:
+                return  # sealed end to end: nothing we could play back
+            data = strip_redundancy(data)
+            _, _, _, _, seq, sample_ts, capture_time, _ = MEDIA_HEADER.unpack_from(data)
+            data = data[MEDIA_HEADER.size:]
+        if not data:
+            return
+        session = self.sessions.get(room)
+        if session is None:
+            session = self.sessions[room] = RoomSession(self.base_dir, room, self.rate)
+            self.log(f"[Recorder] recording room {room!r} to {session.path}")
+        session.write(speaker, arrival, data, seq, sample_ts, capture_time, self.rates.get(speaker, self.rate))
+        self.frames_written += 1
+        self.bytes_written += len(data)
+
+    def _housekeeping(self):
+        now = time.monotonic()
+        sync = now - self.last_sync > SYNC_INTERVAL
+        if sync:
+            self.last_sync = now
+        for room, session in list(self.sessions.items()):
+            if not self.recording(room) or now - session.last_frame > SESSION_IDLE_CLOSE:
+                session.close()
+                del self.sessions[room]
+                continue
+            session.close_idle_tracks(now)
+            if sync:
+                session.flush()
+
+    def stats_text(self):
+        return (f"recording {len(self.sessions)} room(s): {self.frames_written} frames, "
+                f"{self.bytes_written / 1e6:.1f} MB raw, {self.frames_dropped} dropped")
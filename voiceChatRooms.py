@@ -0,0 +1,351 @@
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+
+import voiceChatProfile as profile
+from voiceChatLevels import LevelMeter
+
+# Frames a slow listener may have queued before we start dropping the oldest.
+# At ~11 frames/s per speaker this is a couple of seconds of audio for a
+# small room; anything older is useless for a live call anyway.
+OUTBOX_MAX_FRAMES = 64
+
+
+class RoomFull(Exception):
+    """ join()/move() with max_members: the room already has that many members. """
+
+
+class Outbox:
+    """
+    Bounded send queue for one connection, drained by its own writer thread.
+
+    The fan-out only ever appends here, so a slow or dead peer (kernel send
+    buffer full, no FIN) can no longer block the broadcast for the whole room.
+    When the queue is full the oldest frame is dropped.
+    """
+    __slots__ = ("conn", "frames", "cond", "closed", "dropped", "max_frames")
+
+    def __init__(self, conn, max_frames=OUTBOX_MAX_FRAMES):
+        self.conn = conn
+        self.frames = deque()
+        self.cond = threading.Condition(profile.new_lock("outbox"))
+        self.closed = False
+        self.dropped = 0
+        self.max_frames = max_frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, data):
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_frames:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(data)
+            self.cond.notify()
+            return True
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def start(self):
+        t = threading.Thread(target=self._writer, daemon=True)
+        t.start()
+        return self
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.frames and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                # coalesce everything queued into one syscall
+                batch = b"".join(self.frames)
+                self.frames.clear()
+            try:
+                if profile.enabled:
+                    t0 = time.perf_counter()
+                    self.conn.sendall(batch)
+                    profile.record("send", time.perf_counter() - t0)
+                else:
+                    self.conn.sendall(batch)
+            except OSError:
+                self.close()
+                try:
+                    # make the reader side notice too
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+
+class Member:
+    """
+    One connected client's seat in a room.
+    Kept small on purpose: the fan-out touches one of these per listener per frame.
+
+    conn is None while the client is detached (connection dropped, session
+    token still valid); detached_at is then the monotonic time of the drop.
+    Everything sent to the client goes through outbox, never conn directly.
+    last_seen is the monotonic time we last heard anything from the client.
+    spoke_at / refused_at are the monotonic times its audio was last forwarded /
+    last held back by the speaker limit (0.0 = never).
+    listener is set for the whole session by joining with LISTEN:<room>: no
+    audio from it is forwarded and its socket lives on the ListenerHub.
+    meter holds its audio levels (voiceChatLevels) as a sender.
+    e2e_pub is its end-to-end public key once it sent "E2E_PUB:" (voiceChatE2E);
+    only such members get FLAG_E2E frames. e2e_missed maps the E2E senders in
+    its room whose sealed frames it did not get to when that started, or to
+    None once both sides have been told (newServer.e2e_mismatch).
+    """
+    __slots__ = ("conn", "client_id", "room", "token", "detached_at",
+                 "outbox", "last_seen", "rtt", "fec", "layers", "layer", "layer_since",
+                 "spoke_at", "refused_at", "listener", "meter", "e2e_pub", "e2e_missed")
+
+    def __init__(self, conn, client_id, room=None):
+        self.conn = conn
+        self.client_id = client_id
+        self.room = room
+        self.token = None
+        self.detached_at = None
+        self.outbox = None
+        self.last_seen = time.monotonic()
+        self.rtt = None  # seconds, from PING/PONG
+        self.fec = False  # wants RED blocks forwarded (CAPS:fec=red)
+        self.layers = 1   # simulcast layers it publishes and can decode (CAPS:layers=<n>)
+        self.layer = 0    # layer we currently forward to it: 0 = full rate, higher = cheaper
+        self.layer_since = time.monotonic()
+        self.spoke_at = 0.0
+        self.refused_at = 0.0
+        self.listener = False
+        self.meter = LevelMeter()
+        self.e2e_pub = None
+        self.e2e_missed = {}
+
+    def send(self, data):
+        """ Queue bytes for the client; dropped silently while detached. """
+        outbox = self.outbox
+        if outbox is not None:
+            outbox.put(data)
+
+    def __repr__(self):
+        return f"Member(client_id={self.client_id}, room={self.room!r})"
+
+
+class RoomRegistry:
+    """
+    Thread-safe room bookkeeping:
+      rooms: { room_name: { client_id: Member, ... }, ... }
+
+    Join/leave are dict operations under a single lock (O(1)).
+    Fan-out never iterates the live dicts; it gets an immutable tuple snapshot
+    that is rebuilt lazily, only after the membership of that room changed.
+    """
+
+    def __init__(self):
+        self._lock = profile.new_lock("registry")
+        self._rooms = {}
+        self._snapshots = {}  # room_name -> tuple of Member, or missing if stale
+        self._sessions = {}   # token -> Member
+        self._next_id = 1
+
+    def allocate_id(self):
+        """ Return a fresh, never reused client id. """
+        with self._lock:
+            client_id = self._next_id
+            self._next_id += 1
+            return client_id
+
+    def reserve_ids(self, next_id):
+        """ Ids below next_id are taken (by the process we replace); never hand them out. """
+        with self._lock:
+            self._next_id = max(self._next_id, next_id)
+
+    def next_id(self):
+        with self._lock:
+            return self._next_id
+
+    def adopt(self, member):
+        """
+        Take over a detached session from the process we replace (voiceChatDrain):
+        member has its token, id and room, conn None and detached_at set. Returns
+        False if that token is already a session here.
+        """
+        with self._lock:
+            if member.token in self._sessions:
+                return False
+            self._sessions[member.token] = member
+            self._next_id = max(self._next_id, member.client_id + 1)
+            if member.room is not None:
+                self._rooms.setdefault(member.room, {})[member.client_id] = member
+                self._snapshots.pop(member.room, None)
+            return True
+
+    def __contains__(self, room_name):
+        return room_name in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def room_names(self):
+        with self._lock:
+            return list(self._rooms)
+
+    def session_count(self):
+        """ Members holding a session, attached or waiting to resume. """
+        return len(self._sessions)
+
+    def join(self, member, room_name, create=False, max_members=0):
+        """
+        Put member into room_name (creating it if create=True).
+        Returns False if the room does not exist (e.g. it emptied and was
+        closed between the user picking it and us getting here).
+        Raises RoomFull if max_members is set and the room already has that many.
+        """
+        with self._lock:
+            members = self._rooms.get(room_name)
+            if members is None:
+                if not create:
+                    return False
+                members = self._rooms[room_name] = {}
+            elif max_members and len(members) >= max_members:
+                raise RoomFull(room_name)
+            members[member.client_id] = member
+            member.room = room_name
+            self._snapshots.pop(room_name, None)
+            return True
+
+    def leave(self, member):
+        """
+        Remove member from its room. If the room is now empty => close it.
+        Safe to call more than once.
+        """
+        with self._lock:
+            self._remove_locked(member)
+
+    def end_session(self, member):
+        """ Leave for good: drop the room seat and invalidate the token. """
+        with self._lock:
+            self._remove_locked(member)
+            if member.token is not None:
+                self._sessions.pop(member.token, None)
+
+    def issue_token(self, member):
+        """ Give member a session token it can RESUME with after a drop. """
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            if member.token is not None:
+                self._sessions.pop(member.token, None)
+            member.token = token
+            self._sessions[token] = member
+        return token
+
+    def detach(self, member, conn):
+        """
+        The connection conn of member died. Keep the seat (and id) for a grace
+        window instead of leaving the room. Does nothing if member has already
+        been resumed on a newer connection.
+        Returns True if member is now detached.
+        """
+        with self._lock:
+            if member.conn is not conn or member.token not in self._sessions:
+                return False
+            member.conn = None
+            member.outbox = None
+            member.detached_at = time.monotonic()
+            return True
+
+    def resume(self, token, conn):
+        """
+        Re-attach the session for token to conn. If the old connection is still
+        attached (server has not noticed the drop yet) it is taken over.
+        The caller gives it a fresh outbox for conn.
+        Returns (member, old_conn) or (None, None) if the token is unknown/expired.
+        """
+        with self._lock:
+            member = self._sessions.get(token)
+            if member is None:
+                return None, None
+            old_conn = member.conn
+            member.conn = conn
+            member.outbox = None
+            member.detached_at = None
+            member.last_seen = time.monotonic()
+            return member, old_conn
+
+    def sessions(self):
+        """ Snapshot of every member with a live session (attached or detached). """
+        with self._lock:
+            return list(self._sessions.values())
+
+    def expire_detached(self, grace):
+        """
+        End every session that has been detached for longer than grace seconds.
+        Returns a list of (member, room it was in).
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for member in list(self._sessions.values()):
+                if member.conn is None and now - member.detached_at > grace:
+                    room_name = member.room
+                    self._remove_locked(member)
+                    del self._sessions[member.token]
+                    expired.append((member, room_name))
+        return expired
+
+    def move(self, member, room_name, create=False, max_members=0):
+        """
+        Atomically take member out of its current room and into room_name,
+        so no fan-out ever sees it in both rooms or in none.
+        Returns False (member stays where it was) if room_name does not exist;
+        raises RoomFull (likewise) if it is at max_members.
+        """
+        with self._lock:
+            if member.room == room_name:
+                return True
+            if room_name not in self._rooms and not create:
+                return False
+            if max_members and len(self._rooms.get(room_name, ())) >= max_members:
+                raise RoomFull(room_name)
+            self._remove_locked(member)
+            members = self._rooms.setdefault(room_name, {})
+            members[member.client_id] = member
+            member.room = room_name
+            self._snapshots.pop(room_name, None)
+            return True
+
+    def _remove_locked(self, member):
+        room_name = member.room
+        member.room = None
+        members = self._rooms.get(room_name)
+        if members is None:
+            return
+        if members.get(member.client_id) is member:
+            del members[member.client_id]
+            self._snapshots.pop(room_name, None)
+        if not members:
+            del self._rooms[room_name]  # auto-close empty room
+
+    def members(self, room_name):
+        """
+        Return a tuple snapshot of the room's members for lock-free iteration.
+        An unknown (or just closed) room yields an empty tuple, never KeyError.
+        """
+        snap = self._snapshots.get(room_name)
+        if snap is not None:
+            return snap
+        with self._lock:
+            members = self._rooms.get(room_name)
+            if members is None:
+                return ()
+            snap = tuple(members.values())
+            self._snapshots[room_name] = snap
+            return snap
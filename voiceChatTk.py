@@ -0,0 +1,152 @@
+"""
+The Tk side of the GUIs (voiceChatGUI, voiceChatClientGui, newClient).
+
+The engine's threads never touch Tk. TkEvents posts every engine event to the
+app's queue and the Tk thread drains it every UI_REFRESH_MS: first all pending
+log lines in one insert, then the posted calls in order, and every
+SPEAKING_REFRESH_TICKS drains the who-is-talking display, if it changed.
+"""
+import queue
+import tkinter as tk
+from tkinter import messagebox
+
+from voiceChatEngine import EngineEvents, level_bar
+
+UI_REFRESH_MS = 50
+MAX_LOG_LINES = 1000
+SPEAKING_REFRESH_TICKS = 4   # 200 ms
+
+
+class TkEvents(EngineEvents):
+    """ Engine events, handed over to the app's Tk thread. """
+
+    def __init__(self, app):
+        self.app = app
+
+    def log(self, text):
+        self.app.append_log(text)
+
+    def room_list(self, rooms_text):
+        self.app.post(self.app.show_rooms, rooms_text.split("\n"))
+
+    def joined(self, room):
+        self.app.post(self.app.room_joined, room)
+
+    def resumed(self, room):
+        self.app.post(self.app.room_resumed, room)
+
+    def left(self, room):
+        self.app.post(self.app.room_left, room)
+
+
+class TkApp:
+    """
+    Mixin for a GUI with self.root, self.engine and self.current_room.
+    Call start_ui_queue() once the widgets are built; override show_rooms and
+    show_speaking, and set log_text to a Text widget to show the log there
+    instead of printing it.
+    """
+    log_text = None
+
+    def start_ui_queue(self):
+        # filled from any thread, drained on the Tk thread
+        self.ui_calls = queue.SimpleQueue()
+        self.log_lines = queue.SimpleQueue()
+        self.ticks = 0
+        self.shown_levels = {}
+        self.drain_ui_queue()
+
+    def post(self, func, *args):
+        """ Run func(*args) on the Tk thread. Safe to call from any thread. """
+        self.ui_calls.put((func, args))
+
+    def append_log(self, text):
+        """ Thread-safe; the line shows up on the next drain_ui_queue tick. """
+        self.log_lines.put(text)
+
+    def when_done(self, future, on_result, what):
+        """
+        Run on_result(result) on the Tk thread once an engine request completes;
+        a refusal, timeout or lost connection goes to show_error instead.
+        """
+        def done(f):
+            error = f.exception()
+            if error is not None:
+                self.post(self.show_error, f"Failed to {what}: {error}")
+            else:
+                self.post(on_result, f.result())
+        future.add_done_callback(done)
+
+    def show_error(self, text):
+        messagebox.showerror("Error", text)
+
+    def drain_ui_queue(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.log_lines.get_nowait())
+            except queue.Empty:
+                break
+        if lines:
+            self.flush_log(lines)
+
+        while True:
+            try:
+                func, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                print("Error in UI callback:", e)
+
+        self.ticks += 1
+        if self.ticks % SPEAKING_REFRESH_TICKS == 0:
+            levels = self.engine.speaking_now() if self.current_room is not None else {}
+            if levels != self.shown_levels:
+                self.shown_levels = levels
+                self.show_speaking(levels)
+
+        self.root.after(UI_REFRESH_MS, self.drain_ui_queue)
+
+    def flush_log(self, lines):
+        if self.log_text is None:
+            for line in lines:
+                print(line)
+            return
+        if len(lines) > MAX_LOG_LINES:
+            lines = lines[-MAX_LOG_LINES:]
+        self.log_text.config(state='normal')
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        # Text always ends with one empty line, hence the -1
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+        self.log_text.see(tk.END)
+        self.log_text.config(state='disabled')
+
+    def show_rooms(self, rooms):
+        pass
+
+    def show_speaking(self, levels):
+        """ {client id: level} of who is talking, on the Tk thread, when it changed. """
+        pass
+
+    # Room events from the server; a SWITCH or a resume can change the room
+    # without a request of ours.
+    def room_joined(self, room):
+        self.current_room = room
+
+    def room_resumed(self, room):
+        self.current_room = room
+
+    def room_left(self, room):
+        self.current_room = None
+
+
+def fill_speaking_list(listbox, engine, levels):
+    """ One line per member talking, with a level bar. """
+    listbox.delete(0, tk.END)
+    for uid, level in sorted(levels.items()):
+        name = "You" if uid == engine.client_id else f"User {uid}"
+        listbox.insert(tk.END, f"{name}  {level_bar(level)}")
@@ -0,0 +1,228 @@
+"""
+Optional TLS on the client <-> server connection (ssl module only).
+
+The server turns it on with VOICECHAT_TLS_CERT / VOICECHAT_TLS_KEY; every
+accepted socket is then wrapped on its own worker thread, before the
+welcome, so a slow handshake never holds up the accept loop. Everything
+above the socket (lines, AUDIO/MEDIA frames, the ListenerHub) is unchanged.
+
+Reconnects stay cheap through session resumption: TlsClient keeps the
+session (TLS 1.3 ticket) of the last connection and offers it on the next
+handshake, which then skips the certificate exchange and signature.
+
+For local testing, make_self_signed() (or "python voiceChatTls.py cert.pem
+key.pem") writes a certificate for TLS_SERVER_NAME; clients given that file
+as their CA trust only it and check the server against that name, whatever
+IP they dial. tlsOverheadBench.py measures what encryption costs the
+fan-out's send path.
+
+An SSL object must not be read and written by two threads at once, yet a
+speaker's connection is read by its worker while its Outbox writer sends,
+and the client engine's reader shares its socket with the capture thread.
+Those connections go through SerializedTls, which does every SSL call under
+one lock and waits for the socket outside it. A listener's socket has only
+the ListenerHub thread and stays as it is.
+"""
+import io
+import select
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+TLS_SERVER_NAME = "voicechat"   # name in the self-signed certificate
+SELF_SIGNED_DAYS = 365
+# Sockets that would block: the ssl module raises its own, not BlockingIOError,
+# when a non-blocking TLS socket needs the peer (a partial record, a full buffer).
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+# SerializedTls: a send that needs the peer's data (or a recv that needs to
+# write) waits at most this long before trying again, since the thread on the
+# other direction may be the one that deals with it.
+CROSS_WAIT = 0.05
+
+
+def make_self_signed(certfile, keyfile, name=TLS_SERVER_NAME, days=SELF_SIGNED_DAYS):
+    """ P-256 key and a self-signed certificate for name, via the openssl tool. """
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                        "-nodes", "-keyout", keyfile, "-out", certfile, "-days", str(days),
+                        "-subj", f"/CN={name}", "-addext", f"subjectAltName=DNS:{name}"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("the openssl command line tool is needed to make a certificate") from None
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"openssl failed: {e.stderr.decode('utf-8', errors='replace').strip()}") from None
+
+
+def server_context(certfile, keyfile):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def client_context(cafile=None):
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+def pending(conn):
+    """ Bytes already decrypted and buffered in a TLS socket, which select() cannot see. """
+    return conn.pending() if isinstance(conn, (ssl.SSLSocket, SerializedTls)) else 0
+
+
+def serialized(conn):
+    """ conn made safe to read and write from two threads: SerializedTls for TLS, else conn itself. """
+    return SerializedTls(conn) if isinstance(conn, ssl.SSLSocket) else conn
+
+
+class SerializedTls:
+    """
+    A TLS socket for one reading and one writing thread. The SSL socket is
+    made non-blocking; recv and send run under a lock, and a call the socket
+    is not ready for waits in select() without it, so a reader waiting for
+    data never holds up a send. settimeout() applies to those waits as it
+    would to a blocking socket (socket.timeout). Anything else (session,
+    shutdown, getpeername, ...) is passed to the SSL socket.
+    """
+
+    def __init__(self, tls_sock):
+        self.sock = tls_sock
+        self.timeout = tls_sock.gettimeout()
+        self.lock = threading.Lock()
+        tls_sock.setblocking(False)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def _call(self, reading, op, *args):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return op(*args)
+                except ssl.SSLWantReadError:
+                    want_read = True
+                except ssl.SSLWantWriteError:
+                    want_read = False
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                raise socket.timeout("timed out")
+            if want_read != reading:
+                wait = CROSS_WAIT if wait is None else min(wait, CROSS_WAIT)
+            try:
+                ready = select.select([self.sock] if want_read else [], [] if want_read else [self.sock], [], wait)
+            except ValueError:  # closed under us
+                raise OSError("socket closed") from None
+            if not any(ready) and deadline is not None and time.monotonic() >= deadline:
+                raise socket.timeout("timed out")
+
+    def recv(self, bufsize):
+        return self._call(True, self.sock.recv, bufsize)
+
+    def recv_into(self, buffer, nbytes=0):
+        return self._call(True, self.sock.recv_into, buffer, nbytes)
+
+    def send(self, data):
+        return self._call(False, self.sock.send, data)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self._call(False, self.sock.send, view):]
+
+    def pending(self):
+        with self.lock:
+            return self.sock.pending()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def makefile(self, mode="rb"):
+        """ A buffered binary reader, as socket.makefile('rb'). """
+        if mode != "rb":
+            raise ValueError("only 'rb' is supported")
+        return io.BufferedReader(socket.SocketIO(self, "rb"))
+
+    def _decref_socketios(self):
+        pass  # SocketIO.close(); the socket stays open until close()
+
+    def close(self):
+        self.sock.close()
+
+
+class TlsClient:
+    """
+    Client side of TLS for one server: wrap() each new connection (into a
+    SerializedTls), remember() it once it has read something (TLS 1.3 tickets
+    arrive after the handshake), and the next wrap() resumes that session.
+
+    cafile: the server's self-signed certificate (checked against
+    TLS_SERVER_NAME); None trusts the system CAs and checks host itself.
+    """
+
+    def __init__(self, host, cafile=None):
+        self.context = client_context(cafile)
+        self.pinned = bool(cafile)
+        self.server_name = TLS_SERVER_NAME if cafile else host
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+
+    def wrap(self, sock):
+        """ Handshake on a connected socket; raises OSError (ssl.SSLError) on failure. """
+        try:
+            tls_sock = self.context.wrap_socket(sock, server_hostname=self.server_name, session=self.session)
+        except BaseException:
+            sock.close()
+            raise
+        self.handshakes += 1
+        if tls_sock.session_reused:
+            self.resumed += 1
+        return SerializedTls(tls_sock)  # the engine's reader and capture thread share it
+
+    def retarget(self, host):
+        """ REDIRECT to another server: check its name from now on (unless pinned to a cafile). """
+        if not self.pinned:
+            self.server_name = host
+
+    def remember(self, tls_sock):
+        session = tls_sock.session
+        if session is not None and session.has_ticket:
+            self.session = session
+
+    def stats_text(self):
+        return f"TLS: {self.handshakes} handshake(s), {self.resumed} resumed"
+
+
+def accept(conn, context, timeout, log=print):
+    """ Server side handshake; returns the TLS socket, or None (conn closed) if it failed. """
+    try:
+        conn.settimeout(timeout)
+        return context.wrap_socket(conn, server_side=True)
+    except (OSError, ValueError) as e:
+        log(f"TLS handshake failed: {e}")
+        conn.close()
+        return None
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: python voiceChatTls.py <cert.pem> <key.pem>")
+        sys.exit(2)
+    make_self_signed(sys.argv[1], sys.argv[2])
+    print(f"Wrote {sys.argv[1]} and {sys.argv[2]} for '{TLS_SERVER_NAME}'; "
+          f"give clients {sys.argv[1]} as their CA.")
+
+
+if __name__ == "__main__":
+    main()
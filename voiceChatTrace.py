@@ -0,0 +1,202 @@
+"""
+Compact binary trace of server traffic, for replaying real sessions as a
+load test (see traceReplay.py).
+
+A trace file is TRACE_MAGIC followed by records:
+
+    RECORD header: type, flags, room id, time (unix seconds), client id, size
+    then `size` bytes if flags & FLAG_PAYLOAD,
+    or the first min(size, MEDIA_PREFIX) bytes if flags & FLAG_PREFIX
+
+ROOM records (always with payload) name a room id before its first use in
+the file; every file of a rotation defines its own ids, so each file replays
+on its own. JOIN/LISTEN/LEAVE/GONE records follow membership so that
+listeners who never speak are replayed too, listen-only ones (LISTEN) as
+such. CAPS records (always with payload) hold what the server accepted from
+a client's CAPS ("fec=red,layers=3"). AUDIO/MEDIA records are the forwarded
+frames, with their payload only if the trace was started with payloads on.
+Without payloads MEDIA frames still keep their header (seq, layer, RED
+length). So a replay joins the same way, negotiates the same RED and
+simulcast forwarding and sends the same layers and flags; only a client that
+joined or sent CAPS before the file began is replayed as a plain speaker.
+
+Like the recorder, the server side only appends to a bounded deque from the
+fan-out; a background thread encodes and writes in batches.
+"""
+import glob
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from voiceChatProtocol import AUDIO, MEDIA, MEDIA_HEADER, RED_LENGTH
+
+TRACE_MAGIC = b"VCTRACE1"
+RECORD = struct.Struct("!BBHdII")   # type, flags, room id, time, client id, size
+
+T_ROOM = 1
+T_AUDIO = 2
+T_MEDIA = 3
+T_JOIN = 4
+T_LEAVE = 5
+T_GONE = 6
+T_LISTEN = 7
+T_CAPS = 8
+FLAG_PAYLOAD = 0x01
+FLAG_PREFIX = 0x02
+MEDIA_PREFIX = MEDIA_HEADER.size + RED_LENGTH.size
+
+TRACE_QUEUE_MAX = 16384       # records waiting for the writer; oldest dropped beyond
+TRACE_FLUSH_INTERVAL = 0.5    # seconds between writer batches
+TRACE_MAX_BYTES = 64 << 20    # rotate to a new file beyond this
+TRACE_KEEP_FILES = 8          # oldest trace files deleted beyond this many
+
+_KIND_TYPES = {AUDIO: T_AUDIO, MEDIA: T_MEDIA}
+
+
+class TraceWriter:
+    """
+    offer(room, client_id, kind, data) is a media tap; event(type, room,
+    client_id[, data]) records membership and CAPS. Both are O(1) and never block.
+    """
+
+    def __init__(self, directory, payload=False, max_bytes=TRACE_MAX_BYTES, keep=TRACE_KEEP_FILES, log=print):
+        self.directory = directory
+        self.log = log
+        self.payload = payload
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.file = None
+        self.path = None
+        self.file_bytes = 0
+        self.room_ids = {}
+        self.records_written = 0
+        self.records_dropped = 0
+        self.thread = None
+
+    def _enqueue(self, record):
+        if len(self.queue) >= TRACE_QUEUE_MAX:
+            try:
+                self.queue.popleft()
+                self.records_dropped += 1
+            except IndexError:
+                pass
+        self.queue.append(record)
+
+    def offer(self, room, client_id, kind, data):
+        self._enqueue((_KIND_TYPES.get(kind, T_AUDIO), time.time(), room, client_id, data))
+
+    def event(self, record_type, room, client_id, data=None):
+        self._enqueue((record_type, time.time(), room, client_id, data))
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _writer(self):
+        while True:
+            self.wakeup.wait(TRACE_FLUSH_INTERVAL)
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            try:
+                if batch:
+                    self._write_batch(batch)
+            except OSError as e:
+                self.records_dropped += len(batch)
+                self.log(f"[Trace] write failed: {e}")
+            if self.stopped:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def _write_batch(self, batch):
+        out = bytearray()
+        for record_type, t, room, client_id, data in batch:
+            if self.file is None or self.file_bytes + len(out) > self.max_bytes:
+                self._flush(out)
+                self._rotate()
+            room_id = 0
+            if room is not None:
+                room_id = self.room_ids.get(room)
+                if room_id is None:
+                    room_id = self.room_ids[room] = len(self.room_ids) + 1
+                    name = room.encode('utf-8')
+                    out += RECORD.pack(T_ROOM, FLAG_PAYLOAD, room_id, t, 0, len(name)) + name
+            if data is None:
+                out += RECORD.pack(record_type, 0, room_id, t, client_id, 0)
+            elif self.payload or record_type == T_CAPS:
+                out += RECORD.pack(record_type, FLAG_PAYLOAD, room_id, t, client_id, len(data)) + data
+            elif record_type == T_MEDIA:
+                out += RECORD.pack(record_type, FLAG_PREFIX, room_id, t, client_id, len(data)) + data[:MEDIA_PREFIX]
+            else:
+                out += RECORD.pack(record_type, 0, room_id, t, client_id, len(data))
+            self.records_written += 1
+        self._flush(out)
+
+    def _flush(self, out):
+        if out and self.file is not None:
+            self.file.write(out)
+            self.file.flush()
+            self.file_bytes += len(out)
+            out.clear()
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+        self.path = os.path.join(self.directory, time.strftime("trace-%Y%m%d-%H%M%S")
+                                 + f"-{int(time.time() * 1000) % 1000:03d}.vct")
+        self.file = open(self.path, "wb", buffering=1 << 16)
+        self.file.write(TRACE_MAGIC)
+        self.file_bytes = len(TRACE_MAGIC)
+        self.room_ids = {}
+        old = sorted(glob.glob(os.path.join(self.directory, "trace-*.vct")))
+        for path in old[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats_text(self):
+        return f"trace {self.path}: {self.records_written} records, {self.records_dropped} dropped"
+
+
+def read_trace(path):
+    """
+    Yield (type, time, room, client_id, size, payload) for every record in
+    one trace file; payload is None if it was not captured, or shorter than
+    size if only its prefix was (pad with zeros to replay). Room definitions
+    are resolved, not yielded. A record cut off at the end (server killed
+    mid-write) ends the iteration.
+    """
+    rooms = {}
+    with open(path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path}: not a voice chat trace")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            record_type, flags, room_id, t, client_id, size = RECORD.unpack(head)
+            payload = None
+            if flags & (FLAG_PAYLOAD | FLAG_PREFIX):
+                stored = size if flags & FLAG_PAYLOAD else min(size, MEDIA_PREFIX)
+                payload = f.read(stored)
+                if len(payload) < stored:
+                    return
+            if record_type == T_ROOM:
+                rooms[room_id] = payload.decode('utf-8', errors='replace')
+                continue
+            yield record_type, t, rooms.get(room_id), client_id, size, payload